@@ -179,6 +179,9 @@ class SCHP:
         elif isinstance(image, Image.Image):
             # to cv2 format
             img = np.array(image)
+        elif isinstance(image, np.ndarray):
+            # already cv2 (BGR) format
+            img = image
 
         h, w, _ = img.shape
         # Get person center and scale
@@ -204,38 +207,43 @@ class SCHP:
         }
         return input, meta
 
-    def __call__(self, image_or_path):
-        if isinstance(image_or_path, list):
-            image_list = []
-            meta_list = []
-            for image in image_or_path:
-                image, meta = self.preprocess(image)
-                image_list.append(image)
-                meta_list.append(meta)
-            image = torch.cat(image_list, dim=0)
-        else:
-            image, meta = self.preprocess(image_or_path)
-            meta_list = [meta]
-
-        output = self.model(image)
-        # upsample_outputs = self.upsample(output[0][-1])
-        upsample_outputs = self.upsample(output)
-        upsample_outputs = upsample_outputs.permute(0, 2, 3, 1)  # BCHW -> BHWC
-
-        output_img_list = []
-        for upsample_output, meta in zip(upsample_outputs, meta_list):
+    def postprocess(self, upsample_outputs, meta_list):
+        """
+        Inverse-affine warp and argmax of a (B, C, h, w) batch of upsampled logits,
+        on the compute device (see transform_logits). Samples sharing a transform
+        are warped together.
+        """
+        groups = {}
+        for i, meta in enumerate(meta_list):
+            key = (meta["width"], meta["height"], tuple(meta["center"]), tuple(meta["scale"]))
+            groups.setdefault(key, []).append(i)
+
+        parsing_results = [None] * len(meta_list)
+        for indices in groups.values():
+            meta = meta_list[indices[0]]
             c, s, w, h = meta["center"], meta["scale"], meta["width"], meta["height"]
-            logits_result = transform_logits(
-                upsample_output.data.cpu().numpy(),
-                c,
-                s,
-                w,
-                h,
-                input_size=self.input_size,
+            labels = transform_logits(
+                upsample_outputs[indices], c, s, w, h, input_size=self.input_size, labels=True
             )
-            parsing_result = np.argmax(logits_result, axis=2)
-            output_img = Image.fromarray(np.asarray(parsing_result, dtype=np.uint8))
-            output_img.putpalette(self.palette)
-            output_img_list.append(output_img)
+            for i, label in zip(indices, labels):
+                parsing_results[i] = label
+        return parsing_results
+
+    @torch.no_grad()
+    def __call__(self, image_or_path, batch_size=8):
+        images = image_or_path if isinstance(image_or_path, list) else [image_or_path]
+
+        output_img_list = []
+        for start in range(0, len(images), batch_size):
+            # every image is warped to input_size, so a batch needs no padding
+            image_list, meta_list = zip(*[self.preprocess(image) for image in images[start : start + batch_size]])
+            output = self.model(torch.cat(image_list, dim=0))
+            # upsample_outputs = self.upsample(output[0][-1])
+            upsample_outputs = self.upsample(output)
+
+            for parsing_result in self.postprocess(upsample_outputs, meta_list):
+                output_img = Image.fromarray(parsing_result)
+                output_img.putpalette(self.palette)
+                output_img_list.append(output_img)
 
         return output_img_list[0] if len(output_img_list) == 1 else output_img_list
@@ -10,6 +10,7 @@ import cv2
 
 import numpy as np
 import torch
+import torch.nn.functional as F
 
 
 class BRG2Tensor_transform(object):
@@ -88,22 +89,52 @@ def transform_parsing(pred, center, scale, width, height, input_size):
     return target_pred
 
 
-def transform_logits(logits, center, scale, width, height, input_size):
+def transform_logits(logits, center, scale, width, height, input_size, labels=False):
+    """
+    Warp network-space logits back onto the (width, height) image.
+
+    `logits` is an HxWxC array, or a torch tensor (HxWxC, or BxCxHxW sharing one
+    transform, giving BxHxW(xC) results). Tensors on an accelerator are warped there in one grid_sample call;
+    everything else goes through cv2.warpAffine, 4 channels per call. With
+    `labels=True` the argmax is taken before anything leaves the device and a uint8
+    label map is returned instead of the warped logits.
+    """
+    if isinstance(logits, torch.Tensor) and logits.device.type != "cpu":
+        x = logits if logits.dim() == 4 else logits.permute(2, 0, 1).unsqueeze(0)
+        target_logits = transform_logits_torch(x, center, scale, width, height, input_size)
+        if labels:
+            result = target_logits.argmax(dim=1).to(torch.uint8).cpu().numpy()
+        else:
+            result = target_logits.permute(0, 2, 3, 1).cpu().numpy()
+        return result if logits.dim() == 4 else result[0]
+    if isinstance(logits, torch.Tensor):
+        if logits.dim() == 4:
+            return np.stack([
+                transform_logits(l.permute(1, 2, 0), center, scale, width, height, input_size, labels)
+                for l in logits
+            ])
+        logits = logits.numpy()
 
     trans = get_affine_transform(center, scale, 0, input_size, inv=1)
     channel = logits.shape[2]
     target_logits = []
-    for i in range(channel):
+    # warpAffine interpolates each channel independently, so groups of 4 give the
+    # same result as the per-channel loop in a quarter of the calls
+    for i in range(0, channel, 4):
         target_logit = cv2.warpAffine(
-            logits[:, :, i],
+            np.ascontiguousarray(logits[:, :, i : i + 4]),
             trans,
             (int(width), int(height)),  # (int(width), int(height)),
             flags=cv2.INTER_LINEAR,
             borderMode=cv2.BORDER_CONSTANT,
             borderValue=(0),
         )
+        if target_logit.ndim == 2:
+            target_logit = target_logit[:, :, None]
         target_logits.append(target_logit)
-    target_logits = np.stack(target_logits, axis=2)
+    target_logits = np.concatenate(target_logits, axis=2)
+    if labels:
+        return np.argmax(target_logits, axis=2).astype(np.uint8)
 
     return target_logits
 
@@ -172,3 +203,28 @@ def crop(img, center, scale, output_size, rot=0):
     )
 
     return dst_img
+
+
+def transform_logits_torch(logits, center, scale, width, height, input_size):
+    """
+    transform_logits for a (B, C, h, w) tensor of logits sharing one transform,
+    done with grid_sample on the device the logits are already on.
+    Returns (B, C, height, width).
+    """
+    # grid_sample wants, for every output pixel, where to read in the network
+    # input, i.e. the forward transform (cv2.warpAffine inverts `inv=1` itself)
+    trans = get_affine_transform(center, scale, 0, input_size)
+    trans = torch.as_tensor(trans, dtype=torch.float32, device=logits.device)
+    ys, xs = torch.meshgrid(
+        torch.arange(int(height), dtype=torch.float32, device=logits.device),
+        torch.arange(int(width), dtype=torch.float32, device=logits.device),
+        indexing="ij",
+    )
+    src_x = trans[0, 0] * xs + trans[0, 1] * ys + trans[0, 2]
+    src_y = trans[1, 0] * xs + trans[1, 1] * ys + trans[1, 2]
+    in_h, in_w = logits.shape[-2:]
+    grid = torch.stack([src_x * 2 / (in_w - 1) - 1, src_y * 2 / (in_h - 1) - 1], dim=-1)
+    grid = grid.unsqueeze(0).expand(logits.shape[0], -1, -1, -1)
+    return F.grid_sample(
+        logits.float(), grid, mode="bilinear", padding_mode="zeros", align_corners=True
+    )
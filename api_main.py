@@ -1,8 +1,21 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, Header
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, File, Form, UploadFile, HTTPException, Header, Request
+from fastapi.responses import FileResponse, Response, StreamingResponse
 from io import BytesIO
+from typing import List
+import asyncio
+import base64
+import functools
+import json
 import os
+import time
+from functools import lru_cache
 from vton_script import LeffaVirtualTryOn
+from leffa_utils.image_io import ImageTooLarge, load_image
+from leffa_utils.inference_worker import InferenceWorker, QueueFull, DeadlineExceeded
+from leffa_utils.job_store import DONE, QUEUED, TERMINAL, JobRunner, JobStore
+from leffa_utils.preprocess_cache import image_digest
+from leffa_utils.result_cache import HIT, MISS, WAIT, ResultCache
+from leffa_utils.metrics import CONTENT_TYPE, REGISTRY, collect_memory
 from fastapi.middleware.cors import CORSMiddleware
 
 print("api 실행")
@@ -17,7 +30,132 @@ def api_key_auth(api_key: str = Header(...)):
     if api_key != API_KEY:
         raise HTTPException(status_code=403, detail="Forbidden: Invalid API Key")
 
-vton = LeffaVirtualTryOn(ckpt_dir="./ckpts")
+# 미리 계산된 의상 저장소 (python -m leffa_utils.garment_store 로 생성)
+vton = LeffaVirtualTryOn(ckpt_dir="./ckpts", garment_store_dir=os.environ.get("LEFFA_GARMENT_STORE"))
+
+# 요청 처리 시간 제한(초)과 대기열 크기
+REQUEST_TIMEOUT = float(os.environ.get("LEFFA_REQUEST_TIMEOUT", 300))
+MAX_QUEUE = int(os.environ.get("LEFFA_MAX_QUEUE", 8))
+MAX_BATCH = int(os.environ.get("LEFFA_MAX_BATCH", 4))
+BATCH_WINDOW = float(os.environ.get("LEFFA_BATCH_WINDOW", 0.05))
+# 업로드 파일 크기 제한(바이트)
+MAX_UPLOAD_BYTES = int(os.environ.get("LEFFA_MAX_UPLOAD_BYTES", 20 * 2**20))
+# 카탈로그 요청 한 번에 받을 수 있는 의상 수
+MAX_CATALOG = int(os.environ.get("LEFFA_MAX_CATALOG", 50))
+# 비동기 작업(/jobs) 저장 위치, 결과 보관 시간(초), 대기 작업 수 제한
+JOB_DIR = os.environ.get("LEFFA_JOB_DIR", "./jobs")
+JOB_TTL = float(os.environ.get("LEFFA_JOB_TTL", 3600))
+MAX_QUEUED_JOBS = int(os.environ.get("LEFFA_MAX_QUEUED_JOBS", 1000))
+# 작업(/jobs)이 채울 수 없는, 동기 요청 전용 대기열 자리 수
+INTERACTIVE_SLOTS = int(os.environ.get("LEFFA_INTERACTIVE_SLOTS", max(1, MAX_QUEUE // 2)))
+# 결과 캐시: 메모리/디스크 용량(MB), 디스크 위치, 결과 이미지 형식(jpeg/webp)과 품질
+RESULT_CACHE_MB = float(os.environ.get("LEFFA_RESULT_CACHE_MB", 256))
+RESULT_CACHE_DIR = os.environ.get("LEFFA_RESULT_CACHE_DIR")
+RESULT_CACHE_DISK_MB = float(os.environ.get("LEFFA_RESULT_CACHE_DISK_MB", 1024))
+RESULT_FORMAT = os.environ.get("LEFFA_RESULT_FORMAT", "jpeg").lower()
+RESULT_QUALITY = int(os.environ.get("LEFFA_RESULT_QUALITY", 75))
+
+
+REQUESTS = REGISTRY.counter("leffa_http_requests_total", "HTTP requests by route and status.", ["route", "method", "status"])
+REQUEST_SECONDS = REGISTRY.histogram("leffa_http_request_seconds", "HTTP request latency by route.", ["route"])
+TRYONS = REGISTRY.counter(
+    "leffa_tryons_total", "Try-ons run on the inference worker.", ["kind", "vt_model_type", "vt_garment_type"]
+)
+BATCH_SIZE = REGISTRY.histogram(
+    "leffa_worker_batch_size", "Requests per inference worker batch.", buckets=(1, 2, 4, 8, 16, 32)
+)
+WORKER = REGISTRY.gauge("leffa_worker", "Inference worker queue depth, state and lifetime counters.", ["name"])
+JOBS = REGISTRY.gauge("leffa_jobs", "Jobs in the job store by status.", ["status"])
+CACHE = REGISTRY.gauge("leffa_cache", "Result and preprocessing cache counters, sizes and hit ratios.", ["cache", "name"])
+MEMORY = REGISTRY.gauge("leffa_memory_bytes", "Process, device allocator and model residency memory.", ["kind", "device"])
+
+
+def predict_batch(payloads):
+    """Runs on the worker thread; every payload in a batch has the same model/garment type and steps."""
+    BATCH_SIZE.observe(len(payloads))
+    # catalog steps have a batch key of their own, so a batch is all one kind
+    if "catalog" in payloads[0]:
+        return [catalog_step(payload) for payload in payloads]
+    for payload in payloads:
+        TRYONS.inc(
+            kind="single",
+            vt_model_type=payload.get("vt_model_type", "viton_hd"),
+            vt_garment_type=payload.get("vt_garment_type", "upper_body"),
+        )
+    # person-side stages per request, then one batched denoising run for the group;
+    # a request that failed comes back as its exception and fails only its own future
+    return [result if isinstance(result, Exception) else result[0] for result in vton.predict_batch(payloads)]
+
+
+def catalog_step(payload):
+    """Next denoising batch of a catalog request as [(index, image)], or None once it is done."""
+    batch = next(payload["catalog"], None)
+    if batch is None:
+        return None
+    TRYONS.inc(
+        len(batch), kind="catalog",
+        vt_model_type=payload["vt_model_type"], vt_garment_type=payload["vt_garment_type"],
+    )
+    return [(index, gen_image) for index, gen_image, mask, densepose, agnostic_image in batch]
+
+
+# the model runs on one worker thread behind a bounded queue, so the event loop
+# stays free to accept, reject (429), time out and health-check requests
+worker = InferenceWorker(
+    predict_batch,
+    max_queue=MAX_QUEUE,
+    max_batch=MAX_BATCH,
+    batch_window=BATCH_WINDOW,
+    default_timeout=REQUEST_TIMEOUT,
+)
+
+
+def encode_jpeg(image):
+    img_io = BytesIO()
+    image.save(img_io, format="JPEG")
+    return img_io.getvalue()
+
+
+def encode_result(image):
+    img_io = BytesIO()
+    image.save(img_io, format=RESULT_FORMAT.upper(), quality=RESULT_QUALITY)
+    return img_io.getvalue()
+
+
+# identical requests (retries, repeated clicks) are served from here or joined
+# onto the generation already running for them
+result_cache = ResultCache(
+    memory_bytes=int(RESULT_CACHE_MB * 2**20),
+    disk_bytes=int(RESULT_CACHE_DISK_MB * 2**20),
+    cache_dir=RESULT_CACHE_DIR,
+)
+
+
+def job_payload(job, inputs):
+    params = job["params"]
+    ref = inputs.get("ref_image")
+    return dict(
+        src_image_path=load_image(inputs["src_image"]),
+        ref_image_path=load_image(ref) if ref is not None else default_ref_image(),
+        control_type="virtual_tryon",
+        vt_model_type=params["vt_model_type"],
+        vt_garment_type=params["vt_garment_type"],
+        step=params["step"],
+        vt_repaint=True,
+    )
+
+
+# queued jobs live in SQLite, so they survive a restart; the runner's dispatchers
+# feed them to the inference worker but leave INTERACTIVE_SLOTS of its queue free,
+# so a job backlog never turns /virtual-tryon into 429s
+jobs = JobStore(os.path.join(JOB_DIR, "jobs.sqlite3"), os.path.join(JOB_DIR, "results"), ttl=JOB_TTL)
+job_runner = JobRunner(
+    jobs,
+    functools.partial(worker.submit, reserve=INTERACTIVE_SLOTS),
+    job_payload,
+    encode_jpeg,
+    workers=max(1, MAX_QUEUE - INTERACTIVE_SLOTS),
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -27,47 +165,338 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def record_request(request: Request, call_next):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # the route template, not the raw path, keeps job ids out of the label values
+        route = getattr(request.scope.get("route"), "path", "unmatched")
+        REQUESTS.inc(route=route, method=request.method, status=str(status))
+        # streamed responses are timed to their first byte
+        REQUEST_SECONDS.observe(time.perf_counter() - start, route=route)
+
+
+@REGISTRY.on_collect
+def collect_service_state():
+    for name, value in worker.stats().items():
+        WORKER.set(float(value), name=name)
+    for status in (QUEUED, "running", DONE, "failed", "cancelled"):
+        JOBS.set(jobs.count(status), status=status)
+    for name, value in result_cache.stats().items():
+        CACHE.set(value, cache="result", name=name)
+    preprocess = vton.preprocess_cache
+    lookups = preprocess.hits + preprocess.misses
+    CACHE.set(preprocess.hits, cache="preprocess", name="hits")
+    CACHE.set(preprocess.misses, cache="preprocess", name="misses")
+    CACHE.set(preprocess.hits / lookups if lookups else 0.0, cache="preprocess", name="hit_rate")
+    collect_memory(MEMORY, residency=vton.residency)
+
+
+@app.get("/metrics")
+def metrics():
+    return Response(REGISTRY.render(), media_type=CONTENT_TYPE)
+
+
+@app.on_event("startup")
+def start_worker():
+    worker.start()
+    job_runner.start()
+
+
+@app.on_event("shutdown")
+def stop_worker():
+    job_runner.stop(timeout=5)
+    worker.stop(timeout=5)
+
+
+@app.get("/health")
+def health():
+    return {**worker.stats(), "jobs_queued": jobs.count(QUEUED), "result_cache": result_cache.stats()}
+
+
+async def read_upload_bytes(upload: UploadFile) -> bytes:
+    data = await upload.read(MAX_UPLOAD_BYTES + 1)
+    if len(data) > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"{upload.filename} is larger than {MAX_UPLOAD_BYTES} bytes")
+    return data
+
+
+async def read_upload(upload: UploadFile, data: bytes = None):
+    """Upload -> RGB PIL image, decoded in memory off the event loop (see load_image)."""
+    if data is None:
+        data = await read_upload_bytes(upload)
+    try:
+        return await asyncio.get_running_loop().run_in_executor(None, load_image, data)
+    except ImageTooLarge as e:
+        raise HTTPException(status_code=413, detail=f"{upload.filename}: {e}")
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Cannot decode {upload.filename}: {e}")
+
+
+@lru_cache(maxsize=1)
+def default_ref_image():
+    return load_image(os.path.join("default_images", "default_ref_image.jpg"))
+
+
 @app.post("/virtual-tryon")
 async def virtual_tryon(src_image: UploadFile = File(...), ref_image: UploadFile = File(...)):
     if not src_image or not ref_image:
         raise HTTPException(status_code=422, detail="Both src_image and ref_image must be provided.")
 
-    temp_dir = "temp"
-    os.makedirs(temp_dir, exist_ok=True)
+    src = await read_upload(src_image)
+    # 기본 참조 이미지 처리
+    if ref_image.filename == "default_ref_image.jpg":
+        ref = default_ref_image()
+    else:
+        ref = await read_upload(ref_image)
 
-    src_img_path = os.path.join(temp_dir, src_image.filename)
-    ref_img_path = os.path.join(temp_dir, ref_image.filename)
+    params = dict(
+        control_type="virtual_tryon",
+        vt_model_type="viton_hd",
+        vt_garment_type="upper_body",
+        vt_repaint=True,
+        step=20,
+        seed=42,
+    )
+    media_type = f"image/{RESULT_FORMAT}"
+    loop = asyncio.get_running_loop()
+    src_digest, ref_digest = await loop.run_in_executor(None, lambda: (image_digest(src), image_digest(ref)))
+    key = ResultCache.key(
+        src=src_digest, ref=ref_digest, versions=vton.model_versions,
+        format=RESULT_FORMAT, quality=RESULT_QUALITY, **params,
+    )
 
+    # claim/resolve may read or write the disk tier: keep them off the event loop
+    claim = loop.run_in_executor(None, result_cache.claim, key)
     try:
-        with open(src_img_path, "wb") as f:
-            f.write(await src_image.read())
-
-        # 기본 참조 이미지 처리
-        if ref_image.filename == "default_ref_image.jpg":
-            ref_img_path = os.path.join("default_images", "default_ref_image.jpg")
-        else:
-            with open(ref_img_path, "wb") as f:
-                f.write(await ref_image.read())
-
-        output_image, mask, densepose, full_body_mask, agnostic_image, skin_image = vton.leffa_predict(
-            src_image_path=src_img_path,
-            ref_image_path=ref_img_path,
-            control_type="virtual_tryon",
-            vt_model_type="viton_hd",
-            vt_garment_type="upper_body",
-            vt_repaint=True,
-            output_path="output/virtual_tryon_result.jpg"
-        )
+        status, value = await asyncio.shield(claim)
+    except asyncio.CancelledError:
+        # the claim still finishes in its thread; a key it takes over must not stay owned
+        claim.add_done_callback(functools.partial(release_claim, key))
+        raise
+    if status == HIT:
+        return Response(value, media_type=media_type, headers={"X-Cache": "hit"})
+    if status == WAIT:
+        try:
+            data = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(value)), timeout=REQUEST_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=504, detail="Request deadline exceeded")
+        return Response(data, media_type=media_type, headers={"X-Cache": "coalesced"})
+
+    # this request owns the key: identical ones now wait for (and share) its outcome
+    try:
+        data = await generate(dict(src_image_path=src, ref_image_path=ref, **params))
+    except BaseException as e:
+        result_cache.abandon(key, e if isinstance(e, Exception) else HTTPException(status_code=503, detail="Cancelled"))
+        raise
+    await loop.run_in_executor(None, result_cache.resolve, key, data)
+    return Response(data, media_type=media_type, headers={"X-Cache": "miss"})
+
+
+def release_claim(key, claim):
+    """Done callback of a claim whose request was cancelled before it saw the outcome."""
+    if not claim.cancelled() and claim.exception() is None and claim.result()[0] == MISS:
+        result_cache.abandon(key, HTTPException(status_code=503, detail="Cancelled"))
+
+
+def tryon_batch_key(params):
+    """Worker batch key of a single try-on; shared by /virtual-tryon and /jobs so they batch together."""
+    return (params["vt_model_type"], params["vt_garment_type"], params["step"])
+
 
-        img_io = BytesIO()
-        output_image.save(img_io, format="JPEG")
-        img_io.seek(0)
+async def generate(payload):
+    """Run one try-on on the inference worker and return the encoded result."""
+    try:
+        future = worker.submit(payload, batch_key=tryon_batch_key(payload), timeout=REQUEST_TIMEOUT)
+    except QueueFull:
+        raise HTTPException(status_code=429, detail="Too many requests in queue", headers={"Retry-After": "10"})
 
-        return StreamingResponse(img_io, media_type="image/jpeg")
+    try:
+        output_image = await asyncio.wait_for(asyncio.wrap_future(future), timeout=REQUEST_TIMEOUT)
+    except (asyncio.TimeoutError, DeadlineExceeded):
+        future.cancel()
+        raise HTTPException(status_code=504, detail="Request deadline exceeded")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing images: {str(e)}")
-    finally:
-        if os.path.exists(src_img_path):
-            os.remove(src_img_path)
-        if os.path.exists(ref_img_path) and ref_image.filename != "default_ref_image.jpg":
-            os.remove(ref_img_path)
\ No newline at end of file
+
+    return await asyncio.get_running_loop().run_in_executor(None, encode_result, output_image)
+
+
+@app.post("/virtual-tryon/batch")
+async def virtual_tryon_batch(
+    src_image: UploadFile = File(...),
+    ref_images: List[UploadFile] = File(...),
+    vt_model_type: str = Form("viton_hd"),
+    vt_garment_type: str = Form("upper_body"),
+    step: int = Form(20),
+):
+    """
+    One person against up to MAX_CATALOG garments. The person is preprocessed once
+    and the garments are denoised in batches; results stream back as NDJSON lines
+    {"index": position in ref_images, "image": base64 JPEG} as they complete, ending
+    with {"done": count} or {"error": message}.
+
+    Every denoising batch is a worker request of its own, queued behind whatever
+    arrived during the previous one, so a long catalog does not hold the worker
+    while interactive requests time out.
+    """
+    if len(ref_images) > MAX_CATALOG:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_CATALOG} garments per request")
+    src = await read_upload(src_image)
+    refs = [
+        default_ref_image() if ref.filename == "default_ref_image.jpg" else await read_upload(ref)
+        for ref in ref_images
+    ]
+
+    loop = asyncio.get_running_loop()
+    # a generator of denoising batches; the worker advances it one batch per request
+    batches = vton.predict_many_batches(
+        src,
+        refs,
+        vt_model_type=vt_model_type,
+        vt_garment_type=vt_garment_type,
+        step=step,
+        vt_repaint=True,
+        batch_size=MAX_BATCH,
+    )
+    payload = dict(catalog=batches, vt_model_type=vt_model_type, vt_garment_type=vt_garment_type)
+
+    def submit():
+        # a catalog request is already batched internally: give it its own batch key
+        return worker.submit(payload, batch_key=("catalog", id(payload)), timeout=REQUEST_TIMEOUT)
+
+    async def submit_next():
+        # the stream is already under way: wait for room rather than failing it
+        give_up = loop.time() + REQUEST_TIMEOUT
+        while True:
+            try:
+                return submit()
+            except QueueFull:
+                if loop.time() > give_up:
+                    raise
+                await asyncio.sleep(0.5)
+
+    try:
+        future = submit()
+    except QueueFull:
+        raise HTTPException(status_code=429, detail="Too many requests in queue", headers={"Retry-After": "10"})
+
+    async def stream():
+        nonlocal future
+        count = 0
+        try:
+            while True:
+                try:
+                    batch = await asyncio.wrap_future(future)
+                    if batch is not None:
+                        # queue the next batch before encoding this one, so the worker
+                        # can start it (or serve a request that came in meanwhile)
+                        future = await submit_next()
+                except Exception as e:
+                    yield json.dumps({"error": str(e) or type(e).__name__}) + "\n"
+                    return
+                if batch is None:
+                    yield json.dumps({"done": count}) + "\n"
+                    return
+                for index, image in batch:
+                    data = await loop.run_in_executor(None, encode_jpeg, image)
+                    yield json.dumps({"index": index, "image": base64.b64encode(data).decode()}) + "\n"
+                    count += 1
+        finally:
+            # the client went away or the stream ended: drop the next batch if still queued
+            future.cancel()
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+def get_job(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired job")
+    return job
+
+
+def job_status(job):
+    return {k: job[k] for k in ("id", "status", "stage", "progress", "error", "created", "updated", "expires")}
+
+
+@app.post("/jobs", status_code=202)
+async def create_job(
+    src_image: UploadFile = File(...),
+    ref_image: UploadFile = File(...),
+    vt_model_type: str = Form("viton_hd"),
+    vt_garment_type: str = Form("upper_body"),
+    step: int = Form(20),
+):
+    """Queue a try-on and return its id right away; poll /jobs/{id} or follow /jobs/{id}/events."""
+    if vt_model_type not in ("viton_hd", "dress_code"):
+        raise HTTPException(status_code=422, detail=f"Invalid vt_model_type: {vt_model_type}")
+    if vt_garment_type not in ("upper_body", "lower_body", "dresses"):
+        raise HTTPException(status_code=422, detail=f"Invalid vt_garment_type: {vt_garment_type}")
+    if jobs.count(QUEUED) >= MAX_QUEUED_JOBS:
+        raise HTTPException(status_code=429, detail="Too many jobs in queue", headers={"Retry-After": "30"})
+
+    # 입력은 인코딩된 그대로 저장하고, 디코딩 가능한지만 미리 확인
+    inputs = {"src_image": await read_upload_bytes(src_image)}
+    await read_upload(src_image, inputs["src_image"])
+    if ref_image.filename != "default_ref_image.jpg":
+        inputs["ref_image"] = await read_upload_bytes(ref_image)
+        await read_upload(ref_image, inputs["ref_image"])
+
+    params = dict(vt_model_type=vt_model_type, vt_garment_type=vt_garment_type, step=step)
+    job_id = await asyncio.get_running_loop().run_in_executor(
+        None, lambda: jobs.create(params, inputs, batch_key=tryon_batch_key(params))
+    )
+    job_runner.notify()
+    return {"id": job_id, "status": QUEUED}
+
+
+@app.get("/jobs/{job_id}")
+def read_job(job_id: str):
+    return job_status(get_job(job_id))
+
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str, interval: float = 0.5):
+    """Server-sent events: the job status whenever it changes, until it is done, failed or cancelled."""
+    get_job(job_id)
+
+    async def stream():
+        last = None
+        while True:
+            job = jobs.get(job_id)
+            if job is None:
+                yield "event: expired\ndata: {}\n\n"
+                return
+            status = job_status(job)
+            if status != last:
+                yield f"data: {json.dumps(status)}\n\n"
+                last = status
+            if job["status"] in TERMINAL:
+                return
+            await asyncio.sleep(max(interval, 0.1))
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@app.get("/jobs/{job_id}/result")
+def job_result(job_id: str):
+    job = get_job(job_id)
+    if job["status"] != DONE:
+        raise HTTPException(status_code=409, detail=f"Job is {job['status']}")
+    if not os.path.exists(job["result_path"]):
+        raise HTTPException(status_code=404, detail="Result expired")
+    return FileResponse(job["result_path"], media_type="image/jpeg")
+
+
+@app.delete("/jobs/{job_id}")
+def cancel_job(job_id: str):
+    job = get_job(job_id)
+    if not jobs.cancel(job_id):
+        raise HTTPException(status_code=409, detail=f"Job is {job['status']}, only queued jobs can be cancelled")
+    return job_status(jobs.get(job_id))
@@ -4,10 +4,12 @@ from huggingface_hub import snapshot_download
 from leffa.transform import LeffaTransform
 from leffa.model import LeffaModel
 from leffa.inference import LeffaInference
+from leffa.checkpoint import resolve_checkpoint
 from leffa_utils.garment_agnostic_mask_predictor import AutoMasker
 from leffa_utils.densepose_predictor import DensePosePredictor
 from leffa_utils.utils import resize_and_center, list_dir, get_agnostic_mask_hd, get_agnostic_mask_dc, preprocess_garment_image
-from preprocess.humanparsing.run_parsing import Parsing
+from leffa_utils.human_parsing import HumanParsing
+from leffa_utils.threads import ThreadBudget, set_thread_budget
 from preprocess.openpose.run_openpose import OpenPose
 
 import gradio as gr
@@ -17,9 +19,18 @@ snapshot_download(repo_id="franciszzj/Leffa", local_dir="./ckpts")
 
 class LeffaPredictor(object):
     def __init__(self):
+        set_thread_budget(ThreadBudget())
+
+        # ATR/LIP parsing on CPU, shared with AutoMasker
+        self.parsing = HumanParsing(
+            backend="onnx",
+            onnx_path="./ckpts/humanparsing",
+        )
+
         self.mask_predictor = AutoMasker(
             densepose_path="./ckpts/densepose",
             schp_path="./ckpts/schp",
+            parsing_processor=self.parsing,
         )
 
         self.densepose_predictor = DensePosePredictor(
@@ -27,32 +38,27 @@ class LeffaPredictor(object):
             weights_path="./ckpts/densepose/model_final_162be9.pkl",
         )
 
-        self.parsing = Parsing(
-            atr_path="./ckpts/humanparsing/parsing_atr.onnx",
-            lip_path="./ckpts/humanparsing/parsing_lip.onnx",
-        )
-
         self.openpose = OpenPose(
             body_model_path="./ckpts/openpose/body_pose_model.pth",
         )
 
         vt_model_hd = LeffaModel(
             pretrained_model_name_or_path="./ckpts/stable-diffusion-inpainting",
-            pretrained_model="./ckpts/virtual_tryon.pth",
+            pretrained_model=resolve_checkpoint("./ckpts/virtual_tryon.pth"),
             dtype="float16",
         )
         self.vt_inference_hd = LeffaInference(model=vt_model_hd)
 
         vt_model_dc = LeffaModel(
             pretrained_model_name_or_path="./ckpts/stable-diffusion-inpainting",
-            pretrained_model="./ckpts/virtual_tryon_dc.pth",
+            pretrained_model=resolve_checkpoint("./ckpts/virtual_tryon_dc.pth"),
             dtype="float16",
         )
         self.vt_inference_dc = LeffaInference(model=vt_model_dc)
 
         pt_model = LeffaModel(
             pretrained_model_name_or_path="./ckpts/stable-diffusion-xl-1.0-inpainting-0.1",
-            pretrained_model="./ckpts/pose_transfer.pth",
+            pretrained_model=resolve_checkpoint("./ckpts/pose_transfer.pth"),
             dtype="float16",
         )
         self.pt_inference = LeffaInference(model=pt_model)
@@ -92,7 +98,7 @@ class LeffaPredictor(object):
 
         if control_type == "virtual_tryon":
             src_image = src_image.convert("RGB")
-            model_parse, _ = self.parsing(src_image.resize((384, 512)))
+            model_parse = self.parsing(src_image.resize((384, 512)))["parsing"]
             keypoints = self.openpose(src_image.resize((384, 512)))
             if vt_model_type == "viton_hd":
                 mask = get_agnostic_mask_hd(model_parse, keypoints, vt_garment_type)
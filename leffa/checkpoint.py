@@ -0,0 +1,119 @@
+import argparse
+import json
+import logging
+import mmap
+import os
+import struct
+from collections import OrderedDict
+from typing import Dict
+
+import torch
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+# safetensors dtype tags -> torch dtypes
+_SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+def strip_module_prefix(state_dict: Dict[str, torch.Tensor]) -> "OrderedDict[str, torch.Tensor]":
+    """Remove the `module.` prefix left behind by DataParallel/DDP training."""
+    new_state_dict = OrderedDict()
+    for k, v in state_dict.items():
+        name = k[7:] if k.startswith("module.") else k
+        new_state_dict[name] = v
+    return new_state_dict
+
+
+def resolve_checkpoint(path: str) -> str:
+    """Return the converted `.safetensors` sibling of `path` if one exists."""
+    root, ext = os.path.splitext(path)
+    if ext != ".safetensors" and os.path.isfile(root + ".safetensors"):
+        return root + ".safetensors"
+    return path
+
+
+def load_file_mmap(path: str) -> Dict[str, torch.Tensor]:
+    """
+    Load a safetensors file as CPU tensors backed directly by a memory map.
+
+    Nothing is read up front: pages are faulted in when a tensor is first touched
+    (typically by the `.to(device)` copy), so building a model from this dict costs
+    neither a full read nor a second host copy. The map is copy-on-write, so tensors
+    are writable without ever modifying the file.
+    """
+    with open(path, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    data_start = 8 + header_size
+    state_dict = OrderedDict()
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        dtype = _SAFETENSORS_DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        numel = 1
+        for dim in info["shape"]:
+            numel *= dim
+        if numel == 0:
+            tensor = torch.empty(info["shape"], dtype=dtype)
+        else:
+            tensor = torch.frombuffer(
+                buffer, dtype=dtype, count=numel, offset=data_start + begin
+            ).view(info["shape"])
+            assert tensor.numel() * tensor.element_size() == end - begin, name
+        state_dict[name] = tensor
+    return state_dict
+
+
+def convert_checkpoint(src_path: str, dst_path: str, dtype: str = "float16") -> None:
+    """
+    One-time conversion of a training `.pth` checkpoint into a safetensors file
+    that `LeffaModel` can load straight from a memory map: `module.` prefixes are
+    stripped and floating point tensors are cast to `dtype` ahead of time.
+    """
+    import safetensors.torch
+
+    torch_dtype = getattr(torch, dtype)
+    state_dict = torch.load(src_path, map_location="cpu", weights_only=False)
+    state_dict = strip_module_prefix(state_dict)
+
+    tensors = OrderedDict()
+    for k, v in state_dict.items():
+        if not isinstance(v, torch.Tensor):
+            logger.warning(f"Skipping non-tensor entry {k}")
+            continue
+        if v.is_floating_point():
+            v = v.to(torch_dtype)
+        # clone() breaks shared storages, which safetensors refuses to serialize
+        tensors[k] = v.contiguous().clone()
+
+    safetensors.torch.save_file(
+        tensors, dst_path, metadata={"format": "pt", "source": os.path.basename(src_path)}
+    )
+    logger.info(f"Converted {src_path} -> {dst_path} ({len(tensors)} tensors, {dtype})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert Leffa .pth checkpoints into mmap-loadable safetensors files."
+    )
+    parser.add_argument("src", nargs="+", help=".pth checkpoint(s) to convert")
+    parser.add_argument("--dtype", default="float16", choices=["float16", "bfloat16", "float32"])
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    for src in args.src:
+        convert_checkpoint(src, os.path.splitext(src)[0] + ".safetensors", args.dtype)
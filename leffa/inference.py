@@ -16,10 +16,13 @@ class LeffaInference(object):
     def __init__(
         self,
         model: nn.Module,
+        load_device: Optional[str] = None,
     ) -> None:
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
 
-        self.model = model.to(self.device)
+        # load_device="cpu" leaves the model on the host for a residency manager,
+        # which moves it onto self.device before each use
+        self.model = model.to(load_device or self.device)
         self.model.eval()
 
         self.pipe = LeffaPipeline(model=self.model)
@@ -38,7 +41,11 @@ class LeffaInference(object):
         guidance_scale = kwargs.get("guidance_scale", 2.5)
         seed = kwargs.get("seed", 42)
         repaint = kwargs.get("repaint", False)
-        generator = torch.Generator(self.pipe.device).manual_seed(seed)
+        # one generator per sample, all seeded alike: a result depends on its seed,
+        # not on its position in the batch or on what it was batched with
+        generator = [
+            torch.Generator(self.pipe.device).manual_seed(seed) for _ in range(data["src_image"].shape[0])
+        ]
         
         # Extract prompt and negative_prompt if provided
         prompt = kwargs.get("prompt", None)
@@ -54,6 +61,8 @@ class LeffaInference(object):
             guidance_scale=guidance_scale,
             generator=generator,
             repaint=repaint,
+            ref_latents=kwargs.get("ref_latents", None),
+            ref_features=kwargs.get("ref_features", None),
             # Only pass if not None
             prompt=prompt,
             negative_prompt=negative_prompt
@@ -1,3 +1,4 @@
+import contextlib
 import logging
 import torch
 import torch.nn as nn
@@ -11,9 +12,11 @@ from leffa.diffusion_model.unet_gen import (
     UNet2DConditionModel as GenerativeUNet,
 )
 
-from collections import OrderedDict  # Add this at the top
 import safetensors  # safetensors 지원 추가
 import safetensors.torch
+from accelerate import init_empty_weights
+
+from leffa.checkpoint import load_file_mmap, strip_module_prefix
 
 logger: logging.Logger = logging.getLogger(__name__)
 
@@ -26,6 +29,7 @@ class LeffaModel(nn.Module):
         height: int = 1024,
         width: int = 768,
         dtype: str = "float16",
+        low_cpu_mem_usage: bool = True,
     ):
         super().__init__()
 
@@ -36,6 +40,7 @@ class LeffaModel(nn.Module):
             pretrained_model_name_or_path,
             pretrained_model,
             new_in_channels,
+            low_cpu_mem_usage,
         )
 
         if dtype == "float16":
@@ -46,7 +51,28 @@ class LeffaModel(nn.Module):
         pretrained_model_name_or_path: str = "",
         pretrained_model: str = "",
         new_in_channels: int = 12,
+        low_cpu_mem_usage: bool = True,
     ):
+        # Converted checkpoints (see leffa/checkpoint.py) hold every weight already
+        # stripped and cast, so modules are built on the meta device and their
+        # parameters assigned straight from the memory-mapped file.
+        fast_load = (
+            low_cpu_mem_usage
+            and pretrained_model is not None
+            and pretrained_model.endswith(".safetensors")
+        )
+        init_context = (
+            init_empty_weights(include_buffers=False) if fast_load else contextlib.nullcontext()
+        )
+        with init_context:
+            self._build_modules(pretrained_model_name_or_path, new_in_channels)
+
+        if fast_load:
+            self.load_pretrained_mmap(pretrained_model)
+        else:
+            self.load_pretrained(pretrained_model)
+
+    def _build_modules(self, pretrained_model_name_or_path, new_in_channels):
         diffusion_model_type = ""
         if "stable-diffusion-inpainting" in pretrained_model_name_or_path:
             diffusion_model_type = "sd15"
@@ -121,6 +147,7 @@ class LeffaModel(nn.Module):
         remove_cross_attention(self.unet)
         remove_cross_attention(self.unet_encoder, model_type="unet_encoder")
 
+    def load_pretrained(self, pretrained_model: str):
         # Load pretrained model (safetensors 및 torch 모두 지원)
         if pretrained_model != "" and pretrained_model is not None:
             try:
@@ -130,10 +157,7 @@ class LeffaModel(nn.Module):
                     state_dict = torch.load(pretrained_model, map_location="cpu", weights_only=False)
                 
                 # Remove module. prefix
-                new_state_dict = OrderedDict()
-                for k, v in state_dict.items():
-                    name = k[7:] if k.startswith('module.') else k
-                    new_state_dict[name] = v
+                new_state_dict = strip_module_prefix(state_dict)
                 
                 # **중요: strict=False 사용**
                 missing_keys = self.load_state_dict(new_state_dict, strict=False)
@@ -145,6 +169,23 @@ class LeffaModel(nn.Module):
                 logger.error(f"Failed to load pretrained model: {e}")
                 logger.info("Using default initialization")
 
+    def load_pretrained_mmap(self, pretrained_model: str):
+        state_dict = strip_module_prefix(load_file_mmap(pretrained_model))
+        keys = self.load_state_dict(state_dict, strict=False, assign=True)
+        # Anything the checkpoint did not cover is still a meta tensor and has no
+        # data to fall back on, unlike the randomly initialized slow path.
+        uninitialized = [
+            name for name, tensor in list(self.named_parameters()) + list(self.named_buffers())
+            if tensor.is_meta
+        ]
+        if uninitialized:
+            raise RuntimeError(
+                f"{pretrained_model} does not cover {len(uninitialized)} tensors "
+                f"(e.g. {uninitialized[:5]}); load it with low_cpu_mem_usage=False"
+            )
+        logger.info(f"Loaded pretrained model from {pretrained_model} (mmap)")
+        logger.info(f"Unexpected keys: {keys.unexpected_keys}")
+
     def replace_conv_in_layer(self, unet_model, new_in_channels):
         original_conv_in = unet_model.conv_in
         if original_conv_in.in_channels == new_in_channels:
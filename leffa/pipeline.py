@@ -1,10 +1,12 @@
 import inspect
+import time
 
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import tqdm
+from diffusers.utils.torch_utils import randn_tensor
 from PIL import Image, ImageFilter
 
 
@@ -19,6 +21,14 @@ class LeffaPipeline(object):
         self.unet = model.unet
         self.noise_scheduler = model.noise_scheduler
         self.device = device
+        # seconds spent in VAE encode / denoising / VAE decode by the last call
+        self.last_timings = {}
+
+    def _clock(self):
+        # the phases are queued asynchronously on the GPU: wait for them to finish
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        return time.perf_counter()
 
     def prepare_extra_step_kwargs(self, generator, eta):
         # prepare extra kwargs for the scheduler step, since not all schedulers have the same signature
@@ -55,30 +65,49 @@ class LeffaPipeline(object):
         generator=None,
         eta=1.0,
         repaint=False,  # used for virtual try-on
+        ref_latents=None,
+        ref_features=None,
         **kwargs,
     ):
+        """
+        generator: a torch.Generator, or a list with one per sample so that each sample's
+            noise (VAE sampling, initial latent and scheduler steps) does not depend on
+            the rest of the batch
+        ref_latents: optional precomputed (scaled) VAE latents of ref_image, skips its encode
+        ref_features: optional {timestep: [conditional reference features]} from the
+            garment store; timesteps not in it are computed with unet_encoder as usual
+        """
         src_image = src_image.to(device=self.vae.device, dtype=self.vae.dtype)
         ref_image = ref_image.to(device=self.vae.device, dtype=self.vae.dtype)
         mask = mask.to(device=self.vae.device, dtype=self.vae.dtype)
         densepose = densepose.to(device=self.vae.device, dtype=self.vae.dtype)
         masked_image = src_image * (mask < 0.5)
+        started = self._clock()
 
         # 1. VAE encoding
         with torch.no_grad():
             # src_image_latent = self.vae.encode(src_image).latent_dist.sample()
             masked_image_latent = self.vae.encode(
-                masked_image).latent_dist.sample()
-            ref_image_latent = self.vae.encode(ref_image).latent_dist.sample()
+                masked_image).latent_dist.sample(generator=generator)
+            if ref_latents is None:
+                ref_image_latent = self.vae.encode(ref_image).latent_dist.sample(generator=generator)
+                ref_image_latent = ref_image_latent * self.vae.config.scaling_factor
+            else:
+                ref_image_latent = ref_latents.to(device=self.vae.device, dtype=self.vae.dtype)
         # src_image_latent = src_image_latent * self.vae.config.scaling_factor
         masked_image_latent = masked_image_latent * self.vae.config.scaling_factor
-        ref_image_latent = ref_image_latent * self.vae.config.scaling_factor
         mask_latent = F.interpolate(
             mask, size=masked_image_latent.shape[-2:], mode="nearest")
         densepose_latent = F.interpolate(
             densepose, size=masked_image_latent.shape[-2:], mode="nearest")
 
+        encoded = self._clock()
+
         # 2. prepare noise
-        noise = torch.randn_like(masked_image_latent)
+        noise = randn_tensor(
+            masked_image_latent.shape, generator=generator,
+            device=masked_image_latent.device, dtype=masked_image_latent.dtype,
+        )
         self.noise_scheduler.set_timesteps(
             num_inference_steps, device=self.device)
         timesteps = self.noise_scheduler.timesteps
@@ -101,10 +130,9 @@ class LeffaPipeline(object):
         )
 
         if ref_acceleration:
-            down, reference_features = self.unet_encoder(
-                ref_image_latent, timesteps[num_inference_steps//2], encoder_hidden_states=None, return_dict=False
+            reference_features = self.reference_features(
+                ref_image_latent, timesteps[num_inference_steps//2], ref_features, do_classifier_free_guidance
             )
-            reference_features = list(reference_features)
 
         with tqdm.tqdm(total=num_inference_steps) as progress_bar:
             for i, t in enumerate(timesteps):
@@ -129,10 +157,9 @@ class LeffaPipeline(object):
                 )
 
                 if not ref_acceleration:
-                    down, reference_features = self.unet_encoder(
-                        ref_image_latent, t, encoder_hidden_states=None, return_dict=False
+                    reference_features = self.reference_features(
+                        ref_image_latent, t, ref_features, do_classifier_free_guidance
                     )
-                    reference_features = list(reference_features)
 
                 # predict the noise residual
                 noise_pred = self.unet(
@@ -170,8 +197,15 @@ class LeffaPipeline(object):
                 ):
                     progress_bar.update()
 
+        denoised = self._clock()
+
         # Decode the final latent
         gen_image = latent_to_image(latent, self.vae)
+        self.last_timings = {
+            "vae_encode": encoded - started,
+            "denoise": denoised - encoded,
+            "vae_decode": time.perf_counter() - denoised,
+        }
 
         if repaint:
             src_image = (src_image / 2 + 0.5).clamp(0, 1)
@@ -187,6 +221,29 @@ class LeffaPipeline(object):
 
         return (gen_image,)
 
+    def reference_features(self, ref_image_latent, t, ref_features=None, do_classifier_free_guidance=True):
+        """
+        Reference UNet features at timestep `t`. Precomputed features only cover the
+        conditional half of the guidance batch; the unconditional half (a zero latent,
+        the same for every garment) is computed here at batch size 1.
+        """
+        cond = ref_features.get(int(t)) if ref_features else None
+        if cond is None:
+            down, reference_features = self.unet_encoder(
+                ref_image_latent, t, encoder_hidden_states=None, return_dict=False
+            )
+            return list(reference_features)
+        cond = [f.to(device=self.vae.device, dtype=self.vae.dtype, non_blocking=True) for f in cond]
+        if not do_classifier_free_guidance:
+            return cond
+        down, uncond = self.unet_encoder(
+            torch.zeros_like(ref_image_latent[:1]), t, encoder_hidden_states=None, return_dict=False
+        )
+        return [
+            torch.cat([u.expand(c.shape[0], *u.shape[1:]), c])
+            for u, c in zip(uncond, cond)
+        ]
+
 
 def latent_to_image(latent, vae):
     latent = 1 / vae.config.scaling_factor * latent
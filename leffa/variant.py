@@ -0,0 +1,191 @@
+import argparse
+import contextlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import torch
+import torch.nn as nn
+
+from leffa.checkpoint import load_file_mmap, strip_module_prefix
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+# A delta file stores, per state dict key, one of:
+#   "<key>.delta"                          full fp32 difference
+#   "<key>.lora_up" and "<key>.lora_down"  rank-r factors of the difference (fp16)
+#   "<key>.full"                           the variant tensor itself (key absent in base)
+DELTA_SUFFIXES = (".delta", ".lora_up", ".lora_down", ".full")
+
+
+def _load_state_dict(path: str) -> Dict[str, torch.Tensor]:
+    if path.endswith(".safetensors"):
+        return strip_module_prefix(load_file_mmap(path))
+    return strip_module_prefix(torch.load(path, map_location="cpu", weights_only=False))
+
+
+def build_variant_delta(
+    base_path: str,
+    variant_path: str,
+    output_path: str,
+    rank: int = 0,
+    atol: float = 0.0,
+) -> None:
+    """
+    Store the checkpoint at `variant_path` as a difference against `base_path`.
+
+    With `rank=0` every changed tensor is kept as an exact fp32 delta. With `rank>0`
+    matrices and conv kernels are replaced by their rank-`rank` SVD factors whenever
+    that is smaller than the full delta; the result is then approximate.
+    """
+    import safetensors.torch
+
+    base = _load_state_dict(base_path)
+    variant = _load_state_dict(variant_path)
+
+    tensors = OrderedDict()
+    shapes = {}
+    skipped = 0
+    for key, v in variant.items():
+        if not isinstance(v, torch.Tensor):
+            continue
+        b = base.get(key)
+        if b is None or b.shape != v.shape:
+            tensors[key + ".full"] = v.contiguous().clone()
+            continue
+        if not v.is_floating_point():
+            if not torch.equal(b, v):
+                tensors[key + ".full"] = v.contiguous().clone()
+            continue
+        delta = v.float() - b.float()
+        if delta.abs().max().item() <= atol:
+            skipped += 1
+            continue
+
+        matrix = delta.reshape(delta.shape[0], -1) if delta.ndim >= 2 else None
+        if rank > 0 and matrix is not None and rank * sum(matrix.shape) < matrix.numel():
+            u, s, vh = torch.linalg.svd(matrix, full_matrices=False)
+            tensors[key + ".lora_up"] = (u[:, :rank] * s[:rank]).half().contiguous()
+            tensors[key + ".lora_down"] = vh[:rank].half().contiguous()
+            shapes[key] = list(delta.shape)
+        else:
+            tensors[key + ".delta"] = delta.contiguous()
+
+    metadata = {"base": base_path, "variant": variant_path, "rank": str(rank), "shapes": json.dumps(shapes)}
+    safetensors.torch.save_file(tensors, output_path, metadata=metadata)
+    logger.info(
+        f"Wrote {output_path}: {len(tensors)} tensors, {skipped} unchanged keys skipped, rank={rank}"
+    )
+
+
+class VariantSwitcher(object):
+    """
+    Serves several fine-tuned variants from one resident model by applying and
+    reverting weight deltas in place.
+
+    Deltas stay in host memory; only the tensor currently being patched is moved
+    to the device. Every tensor a variant touches is backed up to host memory when
+    it is applied and restored from there when it is reverted: adding a delta to
+    fp16 weights rounds, so subtracting it again would not give the base weights
+    back and each swap would drift further. `session(name)` holds a lock for the
+    duration of the block so a swap can never happen under a running inference.
+    """
+
+    def __init__(self, model: nn.Module, base_name: str, deltas: Optional[Dict[str, str]] = None):
+        self.model = model
+        self.base_name = base_name
+        self.active = base_name
+        self.deltas: Dict[str, Dict[str, torch.Tensor]] = {}
+        self._shapes: Dict[str, Dict[str, List[int]]] = {}
+        # base copies of the tensors the active variant changed
+        self._backup: Dict[str, torch.Tensor] = {}
+        self._lock = threading.RLock()
+        for name, path in (deltas or {}).items():
+            self.add_variant(name, path)
+
+    @property
+    def variants(self) -> List[str]:
+        return [self.base_name] + list(self.deltas.keys())
+
+    def add_variant(self, name: str, path: str) -> None:
+        from safetensors import safe_open
+
+        with safe_open(path, framework="pt") as f:
+            metadata = f.metadata() or {}
+        tensors = load_file_mmap(path)
+        if torch.cuda.is_available():
+            tensors = OrderedDict((k, v.pin_memory()) for k, v in tensors.items())
+        self.deltas[name] = tensors
+        self._shapes[name] = json.loads(metadata.get("shapes", "{}"))
+
+    def _entries(self, name: str):
+        delta = self.deltas[name]
+        for k in delta:
+            for suffix in DELTA_SUFFIXES:
+                if k.endswith(suffix):
+                    key = k[: -len(suffix)]
+                    if suffix == ".delta":
+                        yield key, "delta", delta[k]
+                    elif suffix == ".lora_up":
+                        yield key, "lora", (delta[k], delta[key + ".lora_down"])
+                    elif suffix == ".full":
+                        yield key, "full", delta[k]
+                    break
+
+    @torch.no_grad()
+    def _patch(self, name: str, sign: int) -> None:
+        state = self.model.state_dict(keep_vars=True)
+        shapes = self._shapes[name]
+        for key, kind, value in self._entries(name):
+            if key not in state:
+                continue
+            target = state[key]
+            if sign < 0:
+                target.copy_(self._backup.pop(key).to(target.device))
+                continue
+            if kind == "full" and target.shape != value.shape:
+                raise ValueError(f"Variant {name} changes the shape of {key}, cannot patch in place")
+            self._backup[key] = target.detach().to("cpu", copy=True)
+            if kind == "full":
+                target.copy_(value.to(target.device, target.dtype))
+            elif kind == "delta":
+                delta = value.to(target.device, non_blocking=True)
+                target.copy_((target.float() + delta).to(target.dtype))
+            else:
+                up, down = (t.to(target.device, torch.float32, non_blocking=True) for t in value)
+                delta = (up @ down).view(shapes[key])
+                target.copy_((target.float() + delta).to(target.dtype))
+
+    def activate(self, name: str) -> None:
+        assert name in self.variants, f"Unknown variant {name}, expected one of {self.variants}"
+        with self._lock:
+            if name == self.active:
+                return
+            if self.active != self.base_name:
+                self._patch(self.active, -1)
+                self.active = self.base_name
+            if name != self.base_name:
+                self._patch(name, +1)
+                self.active = name
+            logger.info(f"Activated variant {name}")
+
+    @contextlib.contextmanager
+    def session(self, name: str):
+        with self._lock:
+            self.activate(name)
+            yield self.model
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Store a fine-tuned variant as a delta against a base checkpoint.")
+    parser.add_argument("base", help="base checkpoint, e.g. virtual_tryon.pth")
+    parser.add_argument("variant", help="variant checkpoint, e.g. virtual_tryon_dc.pth")
+    parser.add_argument("output", help="output .safetensors delta file")
+    parser.add_argument("--rank", type=int, default=0, help="low-rank factorization rank (0 = exact delta)")
+    parser.add_argument("--atol", type=float, default=0.0, help="skip tensors whose delta is below this")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    build_variant_delta(args.base, args.variant, args.output, rank=args.rank, atol=args.atol)
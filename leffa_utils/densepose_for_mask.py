@@ -1,8 +1,5 @@
-import glob
 import os
-import shutil
-import time
-from random import randint
+from typing import List
 
 import cv2
 import numpy as np
@@ -39,6 +36,7 @@ class DensePose:
         self.cfg = self.setup_config()
         self.predictor = DefaultPredictor(self.cfg)
         self.predictor.model.to(self.device)
+        self.context = self.create_context(self.cfg)
 
     def setup_config(self):
         opts = ["MODEL.ROI_HEADS.SCORE_THRESH_TEST", str(self.min_score)]
@@ -50,21 +48,7 @@ class DensePose:
         cfg.freeze()
         return cfg
 
-    @staticmethod
-    def _get_input_file_list(input_spec: str):
-        if os.path.isdir(input_spec):
-            file_list = [
-                os.path.join(input_spec, fname)
-                for fname in os.listdir(input_spec)
-                if os.path.isfile(os.path.join(input_spec, fname))
-            ]
-        elif os.path.isfile(input_spec):
-            file_list = [input_spec]
-        else:
-            file_list = glob.glob(input_spec)
-        return file_list
-
-    def create_context(self, cfg, output_path):
+    def create_context(self, cfg):
         vis_specs = self.visualizations
         visualizers = []
         extractors = []
@@ -84,86 +68,84 @@ class DensePose:
         context = {
             "extractor": extractor,
             "visualizer": visualizer,
-            "out_fname": output_path,
-            "entry_idx": 0,
         }
         return context
 
-    def execute_on_outputs(self, context, entry, outputs):
-        extractor = context["extractor"]
-
-        data = extractor(outputs)
-
-        H, W, _ = entry["image"].shape
+    def i_map_from_outputs(self, outputs, shape) -> np.ndarray:
+        """I-label map (0~24) of the top scoring person, zeros if nobody was found."""
+        H, W = shape[:2]
         result = np.zeros((H, W), dtype=np.uint8)
+        try:
+            data, box = self.context["extractor"](outputs)[0]
+            x, y, w, h = [int(_) for _ in box[0].cpu().numpy()]
+            i_array = data[0].labels[None].cpu().numpy()[0]
+            result[y : y + h, x : x + w] = i_array
+        except Exception:
+            result[:] = 0
+        return result
 
-        data, box = data[0]
-        x, y, w, h = [int(_) for _ in box[0].cpu().numpy()]
-        i_array = data[0].labels[None].cpu().numpy()[0]
-        result[y : y + h, x : x + w] = i_array
-        result = Image.fromarray(result)
-        result.save(context["out_fname"])
-
-    def __call__(self, image_or_path, resize=512) -> Image.Image:
+    @staticmethod
+    def to_bgr(image) -> np.ndarray:
+        if isinstance(image, str):
+            assert image.split(".")[-1] in ["jpg", "png"], "Only support jpg and png images."
+            return read_image(image, format="BGR")
+        if isinstance(image, Image.Image):
+            return np.asarray(image.convert("RGB"))[:, :, ::-1]
+        if isinstance(image, np.ndarray):
+            # ndarrays follow the PIL convention used throughout the project: RGB
+            return image[:, :, ::-1]
+        raise TypeError("image must be str, PIL.Image.Image or np.ndarray")
+
+    def predict_i_maps(self, images, resize=512) -> List[np.ndarray]:
         """
-        :param image_or_path: Path of the input image.
-        :param resize: Resize the input image if its max size is larger than this value.
-        :return: Dense pose image.
+        Run DensePose on a batch of images in a single forward pass.
+
+        :param images: Paths, PIL images or RGB ndarrays.
+        :param resize: Resize each input if its max size is larger than this value.
+        :return: One uint8 I-label map per image, at the image's original size.
         """
-        # random tmp path with timestamp
-        tmp_path = f"./densepose_/tmp/"
-        if not os.path.exists(tmp_path):
-            os.makedirs(tmp_path)
-
-        image_path = os.path.join(
-            tmp_path, f"{int(time.time())}-{self.device}-{randint(0, 100000)}.png"
-        )
-        if isinstance(image_or_path, str):
-            assert image_or_path.split(".")[-1] in [
-                "jpg",
-                "png",
-            ], "Only support jpg and png images."
-            shutil.copy(image_or_path, image_path)
-        elif isinstance(image_or_path, Image.Image):
-            image_or_path.save(image_path)
-        else:
-            shutil.rmtree(tmp_path)
-            raise TypeError("image_path must be str or PIL.Image.Image")
-
-        output_path = image_path.replace(".png", "_dense.png").replace(
-            ".jpg", "_dense.png"
-        )
-        w, h = Image.open(image_path).size
-
-        file_list = self._get_input_file_list(image_path)
-        assert len(file_list), "No input images found!"
-        context = self.create_context(self.cfg, output_path)
-        for file_name in file_list:
-            img = read_image(file_name, format="BGR")  # predictor expects BGR image.
+        predictor = self.predictor
+        inputs = []
+        sizes = []
+        resized_shapes = []
+        for image in images:
+            img = self.to_bgr(image)  # predictor expects BGR image.
+            sizes.append(img.shape[:2])
             # resize
             if (_ := max(img.shape)) > resize:
                 scale = resize / _
                 img = cv2.resize(
                     img, (int(img.shape[1] * scale), int(img.shape[0] * scale))
                 )
+            resized_shapes.append(img.shape)
+            # same preprocessing as DefaultPredictor.__call__, batched
+            if predictor.input_format == "RGB":
+                img = img[:, :, ::-1]
+            height, width = img.shape[:2]
+            tensor = predictor.aug.get_transform(img).apply_image(img)
+            tensor = torch.as_tensor(tensor.astype("float32").transpose(2, 0, 1))
+            inputs.append({"image": tensor, "height": height, "width": width})
+
+        with torch.no_grad():
+            outputs = predictor.model(inputs)
+
+        i_maps = []
+        for output, shape, (h, w) in zip(outputs, resized_shapes, sizes):
+            i_map = self.i_map_from_outputs(output["instances"], shape)
+            if i_map.shape != (h, w):
+                i_map = np.asarray(Image.fromarray(i_map).resize((w, h), Image.NEAREST))
+            i_maps.append(i_map)
+        return i_maps
 
-            with torch.no_grad():
-                outputs = self.predictor(img)["instances"]
-                try:
-                    self.execute_on_outputs(
-                        context, {"file_name": file_name, "image": img}, outputs
-                    )
-                except Exception as e:
-                    null_gray = Image.new("L", (1, 1))
-                    null_gray.save(output_path)
-
-        dense_gray = Image.open(output_path).convert("L")
-        dense_gray = dense_gray.resize((w, h), Image.NEAREST)
-        # remove image_path and output_path
-        os.remove(image_path)
-        os.remove(output_path)
-
-        return dense_gray
+    def __call__(self, image_or_path, resize=512) -> Image.Image:
+        """
+        :param image_or_path: Path, PIL image or RGB ndarray, or a list of them.
+        :param resize: Resize the input image if its max size is larger than this value.
+        :return: Dense pose image (a list of them for list input).
+        """
+        if isinstance(image_or_path, list):
+            return [Image.fromarray(_) for _ in self.predict_i_maps(image_or_path, resize)]
+        return Image.fromarray(self.predict_i_maps([image_or_path], resize)[0])
 
 
 if __name__ == "__main__":
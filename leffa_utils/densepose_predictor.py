@@ -1,3 +1,4 @@
+import cv2
 import numpy as np
 import torch
 from densepose import add_densepose_config
@@ -7,12 +8,14 @@ from densepose.vis.densepose_results import (
 from densepose.vis.extractor import DensePoseResultExtractor
 from detectron2.config import get_cfg
 from detectron2.engine import DefaultPredictor
+from PIL import Image
 
 
 class DensePosePredictor(object):
     def __init__(self,
                  config_path="./ckpts/densepose/densepose_rcnn_R_50_FPN_s1x.yaml",
-                 weights_path="./ckpts/densepose/model_final_162be9.pkl"
+                 weights_path="./ckpts/densepose/model_final_162be9.pkl",
+                 mask_min_score=0.8,
                  ):
         cfg = get_cfg()
         add_densepose_config(cfg)
@@ -24,6 +27,8 @@ class DensePosePredictor(object):
         self.predictor = DefaultPredictor(cfg)
         self.extractor = DensePoseResultExtractor()
         self.visualizer = Visualizer()
+        # AutoMasker's I-map only trusts detections above this score
+        self.mask_min_score = mask_min_score
 
     def predict(self, image):
         if isinstance(image, str):
@@ -33,9 +38,8 @@ class DensePosePredictor(object):
         outputs = self.extractor(outputs)
         return outputs
 
-    def predict_iuv(self, image):
-        outputs = self.predict(image)
-
+    @staticmethod
+    def iuv_from_outputs(outputs, image):
         img_i = outputs[0][0].labels[None, ...]
         img_uv = outputs[0][0].uv
         img_uv = (img_uv - img_uv.min()) / (img_uv.max() - img_uv.min())
@@ -54,20 +58,81 @@ class DensePosePredictor(object):
 
         return image_iuv
 
-    def predict_seg(self, image):
-        outputs = self.predict(image)
-
+    def seg_from_outputs(self, outputs, image):
         image_seg = np.zeros(image.shape, dtype=image.dtype)
         self.visualizer.visualize(image_seg, outputs)
 
         return image_seg
 
+    @staticmethod
+    def i_map_from_outputs(outputs, scores, shape, min_score):
+        H, W = shape[:2]
+        result = np.zeros((H, W), dtype=np.uint8)
+        try:
+            # instances come sorted by score, the first one is the person
+            if scores is None or len(scores) == 0 or float(scores[0]) < min_score:
+                return result
+            data, box = outputs
+            x, y, w, h = [int(_) for _ in box[0].cpu().numpy()]
+            i_array = data[0].labels[None].cpu().numpy()[0]
+            result[y : y + h, x : x + w] = i_array
+        except Exception:
+            result[:] = 0
+        return result
+
+    def predict_iuv(self, image):
+        return self.iuv_from_outputs(self.predict(image), image)
+
+    def predict_seg(self, image):
+        return self.seg_from_outputs(self.predict(image), image)
+
+    def analyze(self, image):
+        """
+        Everything the pipeline needs from DensePose, from a single forward pass.
+
+        :param image: RGB ndarray.
+        :return: dict with the I-label map used by AutoMasker ("i_map"), the colormapped
+            segmentation ("seg", BGR like predict_seg) and the IUV array ("iuv", None
+            when nobody was detected).
+        """
+        image_bgr = np.ascontiguousarray(image[:, :, ::-1])
+        with torch.no_grad():
+            instances = self.predictor(image_bgr)["instances"]
+        outputs = self.extractor(instances)
+        scores = instances.scores.cpu().numpy() if instances.has("scores") else None
+
+        try:
+            iuv = self.iuv_from_outputs(outputs, image)
+        except Exception:
+            iuv = None
+        return {
+            "i_map": self.i_map_from_outputs(outputs, scores, image.shape, self.mask_min_score),
+            "seg": self.seg_from_outputs(outputs, image),
+            "iuv": iuv,
+        }
+
+    def __call__(self, image_or_path, resize=1024):
+        """
+        Drop-in replacement for densepose_for_mask.DensePose, so AutoMasker can share
+        this predictor's model instead of loading its own copy.
+        """
+        if isinstance(image_or_path, list):
+            return [self(_, resize) for _ in image_or_path]
+        if isinstance(image_or_path, str):
+            image = np.asarray(Image.open(image_or_path).convert("RGB"))
+        else:
+            image = np.asarray(image_or_path.convert("RGB") if isinstance(image_or_path, Image.Image) else image_or_path)
+        h, w = image.shape[:2]
+        if (_ := max(image.shape)) > resize:
+            scale = resize / _
+            image = cv2.resize(image, (int(image.shape[1] * scale), int(image.shape[0] * scale)))
+        i_map = Image.fromarray(self.analyze(image)["i_map"])
+        return i_map.resize((w, h), Image.NEAREST)
+
 
 if __name__ == "__main__":
     import sys
 
-    import cv2
-
     image_path = sys.argv[1]
     image = cv2.imread(image_path)
     predictor = DensePosePredictor()
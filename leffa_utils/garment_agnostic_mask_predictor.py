@@ -6,9 +6,10 @@ import numpy as np
 import torch
 from diffusers.image_processor import VaeImageProcessor
 from PIL import Image
-from SCHP import SCHP  # type: ignore
 
 from leffa_utils.densepose_for_mask import DensePose  # type: ignore
+from leffa_utils.human_parsing import HumanParsing
+from leffa_utils.morphology import BLUR_SCALE_MAX_MISMATCH, blur_threshold, dilate, mismatch
 
 DENSE_INDEX_MAP = {
     "background": [0],
@@ -175,6 +176,18 @@ schp_mask_parts = {
 # Fixed: Forearms removed from short_sleeve masking
 dense_mask_parts = MASK_DENSE_PARTS.copy()
 
+LIMB_PARTS = ["Left-arm", "Right-arm", "Left-leg", "Right-leg"]
+ACCESSORY_PARTS = [
+    "Hat",
+    "Glove",
+    "Sunglasses",
+    "Bag",
+    "Left-shoe",
+    "Right-shoe",
+    "Scarf",
+    "Socks",
+]
+
 
 def vis_mask(image, mask):
     image = np.array(image).astype(np.uint8)
@@ -201,6 +214,63 @@ def part_mask_of(part: Union[str, list], parse: np.ndarray, mapping: dict):
             mask += parse == mapping[_]
     return mask
 
+def part_lut_of(part: Union[str, list], mapping: dict):
+    """part_mask_of as a 256-entry table: part_mask_of(part, parse, mapping) == lut[parse]."""
+    if isinstance(part, str):
+        part = [part]
+    lut = np.zeros(256, dtype=np.uint8)
+    for _ in part:
+        if _ not in mapping:
+            continue
+        for i in mapping[_] if isinstance(mapping[_], list) else [mapping[_]]:
+            lut[i] += 1
+    assert lut.max() <= 1, f"Label listed twice in {part}"
+    return lut
+
+
+def pack_luts(*luts):
+    """Stack 0/1 tables into the bits of one table, so a single lookup yields all of them."""
+    packed = np.zeros(256, dtype=np.uint8)
+    for bit, lut in enumerate(luts):
+        packed |= lut << bit
+    return packed
+
+
+def build_mask_tables(part: str):
+    """
+    (densepose, lip, atr) lookup tables of `part` for cloth_agnostic_mask.
+
+    densepose bits: 0 hands+feet, 1 forearms, 2 hands, 3 dense mask parts
+    lip/atr bits:   0 limbs, 1 face (LIP only), 2 weak protect (body, hair, other
+                    clothes, accessories), 3 cloth mask parts, 4 background
+    """
+    dense = pack_luts(
+        part_lut_of(["hands", "feet"], DENSE_INDEX_MAP),
+        part_lut_of(["forearms"], DENSE_INDEX_MAP),
+        part_lut_of(["hands"], DENSE_INDEX_MAP),
+        part_lut_of(MASK_DENSE_PARTS[part], DENSE_INDEX_MAP),
+    )
+    parse_tables = []
+    for source, mapping in (("LIP", LIP_MAPPING), ("ATR", ATR_MAPPING)):
+        weak = (
+            part_lut_of(PROTECT_BODY_PARTS[part], mapping)
+            | part_lut_of(["Hair"], mapping)
+            | part_lut_of(PROTECT_CLOTH_PARTS[part][source], mapping)
+            | part_lut_of(ACCESSORY_PARTS, mapping)
+        )
+        parse_tables.append(pack_luts(
+            part_lut_of(LIMB_PARTS, mapping),
+            part_lut_of("Face", mapping) if source == "LIP" else np.zeros(256, dtype=np.uint8),
+            weak,
+            part_lut_of(MASK_CLOTH_PARTS[part], mapping),
+            part_lut_of(["Background"], mapping),
+        ))
+    return (dense, *parse_tables)
+
+
+MASK_TABLES = {part: build_mask_tables(part) for part in MASK_CLOTH_PARTS}
+
+
 def hull_mask(mask_area: np.ndarray):
     ret, binary = cv2.threshold(mask_area, 127, 255, cv2.THRESH_BINARY)
     contours, hierarchy = cv2.findContours(
@@ -219,20 +289,22 @@ class AutoMasker:
         densepose_path: str = "./ckpts/densepose",
         schp_path: str = "./ckpts/schp",
         device="cuda",
+        densepose_processor=None,
+        parsing_processor=None,
     ):
         np.random.seed(0)
         torch.manual_seed(0)
         torch.cuda.manual_seed(0)
 
-        self.densepose_processor = DensePose(densepose_path, device)
-        self.schp_processor_atr = SCHP(
-            ckpt_path=os.path.join(schp_path, "exp-schp-201908301523-atr.pth"),
-            device=device,
-        )
-        self.schp_processor_lip = SCHP(
-            ckpt_path=os.path.join(schp_path, "exp-schp-201908261155-lip.pth"),
-            device=device,
-        )
+        # densepose_processor: any callable(image, resize=...) -> I-map, e.g. a shared
+        # DensePosePredictor, so the DensePose model is not loaded a second time
+        if densepose_processor is None:
+            densepose_processor = DensePose(densepose_path, device)
+        self.densepose_processor = densepose_processor
+        # ATR/LIP parsing, shareable with the rest of the pipeline (see HumanParsing)
+        if parsing_processor is None:
+            parsing_processor = HumanParsing(backend="torch", schp_path=schp_path, device=device)
+        self.parsing_processor = parsing_processor
 
         self.mask_processor = VaeImageProcessor(
             vae_scale_factor=8,
@@ -245,26 +317,122 @@ class AutoMasker:
         return self.densepose_processor(image_or_path, resize=1024)
 
     def process_schp_lip(self, image_or_path):
-        return self.schp_processor_lip(image_or_path)
+        return self.parsing_processor(image_or_path)["schp_lip"]
 
     def process_schp_atr(self, image_or_path):
-        return self.schp_processor_atr(image_or_path)
-
-    def preprocess_image(self, image_or_path):
+        return self.parsing_processor(image_or_path)["schp_atr"]
+
+    def preprocess_image(self, image_or_path, densepose=None, parsing=None):
+        """
+        `densepose` takes an I-map and `parsing` a HumanParsing result already
+        computed for this image. A list of images is parsed as one batch and gives
+        lists under the same keys.
+        """
+        if parsing is None:
+            parsing = self.parsing_processor(image_or_path)
+        if densepose is None:
+            densepose = self.densepose_processor(image_or_path, resize=1024)
+        if isinstance(image_or_path, list):
+            return {
+                "densepose": densepose,
+                "schp_atr": [_["schp_atr"] for _ in parsing],
+                "schp_lip": [_["schp_lip"] for _ in parsing],
+            }
         return {
-            "densepose": self.densepose_processor(image_or_path, resize=1024),
-            "schp_atr": self.schp_processor_atr(image_or_path),
-            "schp_lip": self.schp_processor_lip(image_or_path),
+            "densepose": densepose,
+            "schp_atr": parsing["schp_atr"],
+            "schp_lip": parsing["schp_lip"],
         }
 
     @staticmethod
     def cloth_agnostic_mask(
+        densepose_mask: Image.Image,
+        schp_lip_mask: Image.Image,
+        schp_atr_mask: Image.Image,
+        part: str = "overall",
+        blur_scale: int = 1,
+        **kwargs,
+    ):
+        """
+        blur_scale=1 (default) gives exactly the mask of cloth_agnostic_mask_reference.
+        blur_scale > 1 runs the large Gaussian blur at 1/blur_scale resolution: faster,
+        but approximate, with up to BLUR_SCALE_MAX_MISMATCH of the pixels flipped
+        along the mask boundary.
+        """
+        assert part in ["upper", "lower", "overall", "inner", "outer", "short_sleeve", "shorts"], f"Invalid part: {part}"
+        w, h = densepose_mask.size
+
+        dilate_kernel = max(w, h) // 250
+        dilate_kernel = dilate_kernel if dilate_kernel % 2 == 1 else dilate_kernel + 1
+
+        kernal_size = max(w, h) // 25
+        kernal_size = kernal_size if kernal_size % 2 == 1 else kernal_size + 1
+
+        # one lookup per label source, every area below is a bit of these (see build_mask_tables)
+        dense_table, lip_table, atr_table = MASK_TABLES[part]
+        dense = np.take(dense_table, np.asarray(densepose_mask), mode="clip")
+        lip = np.take(lip_table, np.asarray(schp_lip_mask), mode="clip")
+        atr = np.take(atr_table, np.asarray(schp_atr_mask), mode="clip")
+        parse = lip | atr
+
+        # Strong Protect Area (Hands, Face, Accessory, Feet)
+        hands_protect_area = dilate(dense & 1, dilate_kernel)
+        hands_protect_area = hands_protect_area & (parse & 1)
+        face_protect_area = (lip >> 1) & 1
+
+        strong_protect_area = hands_protect_area | face_protect_area
+        if part == "short_sleeve":
+            strong_protect_area |= dilate((dense >> 1) & 1, dilate_kernel)
+        if part == "upper":
+            strong_protect_area |= dilate((dense >> 2) & 1, dilate_kernel)
+
+        # Weak Protect Area (Hair, Irrelevant Clothes, Body Parts)
+        weak_protect_area = ((parse >> 2) & 1) | strong_protect_area
+
+        # Mask Area
+        strong_mask_area = (parse >> 3) & 1
+        background_area = ((lip & atr) >> 4) & 1
+        mask_dense_area = (dense >> 3) & 1
+        mask_dense_area = cv2.resize(
+            mask_dense_area,
+            None,
+            fx=0.25,
+            fy=0.25,
+            interpolation=cv2.INTER_NEAREST,
+        )
+        mask_dense_area = dilate(mask_dense_area, dilate_kernel, iterations=2)
+        mask_dense_area = cv2.resize(
+            mask_dense_area,
+            None,
+            fx=4,
+            fy=4,
+            interpolation=cv2.INTER_NEAREST,
+        )
+
+        mask_area = (
+            np.ones_like(dense) & (~weak_protect_area) & (~background_area)
+        ) | mask_dense_area
+
+        mask_area = (
+            hull_mask(mask_area * 255) // 255
+        )  # Convex Hull to expand the mask area
+        mask_area = mask_area & (~weak_protect_area)
+        # blur_scale=1 reproduces the full resolution GaussianBlur exactly
+        mask_area = blur_threshold(mask_area * 255, kernal_size, 25, scale=blur_scale)
+        mask_area = (mask_area | strong_mask_area) & (~strong_protect_area)
+        mask_area = dilate(mask_area, dilate_kernel)
+
+        return Image.fromarray(mask_area * 255)
+
+    @staticmethod
+    def cloth_agnostic_mask_reference(
         densepose_mask: Image.Image,
         schp_lip_mask: Image.Image,
         schp_atr_mask: Image.Image,
         part: str = "overall",
         **kwargs,
     ):
+        """The original part_mask_of based implementation, kept to check cloth_agnostic_mask against."""
         assert part in ["upper", "lower", "overall", "inner", "outer", "short_sleeve", "shorts"], f"Invalid part: {part}"
         w, h = densepose_mask.size
 
@@ -283,8 +451,8 @@ class AutoMasker:
         hands_protect_area = part_mask_of(["hands", "feet"], densepose_mask, DENSE_INDEX_MAP)
         hands_protect_area = cv2.dilate(hands_protect_area, dilate_kernel, iterations=1)
         hands_protect_area = hands_protect_area & (
-            part_mask_of(["Left-arm", "Right-arm", "Left-leg", "Right-leg"], schp_atr_mask, ATR_MAPPING) |
-            part_mask_of(["Left-arm", "Right-arm", "Left-leg", "Right-leg"], schp_lip_mask, LIP_MAPPING)
+            part_mask_of(LIMB_PARTS, schp_atr_mask, ATR_MAPPING) |
+            part_mask_of(LIMB_PARTS, schp_lip_mask, LIP_MAPPING)
         )
         face_protect_area = part_mask_of("Face", schp_lip_mask, LIP_MAPPING)
 
@@ -309,21 +477,8 @@ class AutoMasker:
             PROTECT_CLOTH_PARTS[part]["LIP"], schp_lip_mask, LIP_MAPPING
         ) | part_mask_of(PROTECT_CLOTH_PARTS[part]["ATR"], schp_atr_mask, ATR_MAPPING)
         accessory_protect_area = part_mask_of(
-            (
-                accessory_parts := [
-                    "Hat",
-                    "Glove",
-                    "Sunglasses",
-                    "Bag",
-                    "Left-shoe",
-                    "Right-shoe",
-                    "Scarf",
-                    "Socks",
-                ]
-            ),
-            schp_lip_mask,
-            LIP_MAPPING,
-        ) | part_mask_of(accessory_parts, schp_atr_mask, ATR_MAPPING)
+            ACCESSORY_PARTS, schp_lip_mask, LIP_MAPPING
+        ) | part_mask_of(ACCESSORY_PARTS, schp_atr_mask, ATR_MAPPING)
         weak_protect_area = (
             body_protect_area
             | cloth_protect_area
@@ -376,7 +531,7 @@ class AutoMasker:
 
     def __call__(
         self,
-        image: Union[str, Image.Image],
+        image: Union[str, Image.Image, list],
         mask_type: str = "upper",
     ):
         assert mask_type in [
@@ -389,12 +544,22 @@ class AutoMasker:
             "shorts",
         ], f"mask_type should be one of ['upper', 'lower', 'overall', 'inner', 'outer', 'short_sleeve', 'shorts'], but got {mask_type}"
         preprocess_results = self.preprocess_image(image)
-        mask = self.cloth_agnostic_mask(
-            preprocess_results["densepose"],
-            preprocess_results["schp_lip"],
-            preprocess_results["schp_atr"],
-            part=mask_type,
-        )
+        if isinstance(image, list):
+            mask = [
+                self.cloth_agnostic_mask(densepose, schp_lip, schp_atr, part=mask_type)
+                for densepose, schp_lip, schp_atr in zip(
+                    preprocess_results["densepose"],
+                    preprocess_results["schp_lip"],
+                    preprocess_results["schp_atr"],
+                )
+            ]
+        else:
+            mask = self.cloth_agnostic_mask(
+                preprocess_results["densepose"],
+                preprocess_results["schp_lip"],
+                preprocess_results["schp_atr"],
+                part=mask_type,
+            )
         return {
             "mask": mask,
             "densepose": preprocess_results["densepose"],
@@ -419,6 +584,20 @@ if __name__ == "__main__":
         # "lower",
     )
     mask = outputs["mask"]
+    for part in MASK_TABLES:
+        reference = AutoMasker.cloth_agnostic_mask_reference(
+            outputs["densepose"], outputs["schp_lip"], outputs["schp_atr"], part=part
+        )
+        exact = AutoMasker.cloth_agnostic_mask(
+            outputs["densepose"], outputs["schp_lip"], outputs["schp_atr"], part=part, blur_scale=1
+        )
+        assert np.array_equal(np.array(reference), np.array(exact)), f"LUT mask differs for {part}"
+        fast = AutoMasker.cloth_agnostic_mask(
+            outputs["densepose"], outputs["schp_lip"], outputs["schp_atr"], part=part, blur_scale=4
+        )
+        differ = mismatch(np.array(reference), np.array(fast))
+        print(f"{part}: {differ * 100:.4f}% pixels differ at blur_scale=4")
+        assert differ <= BLUR_SCALE_MAX_MISMATCH, f"blur_scale=4 mask differs too much for {part}: {differ}"
     # densepose = outputs["densepose"]  # densepose I map, range 0~24
     # schp_lip = outputs["schp_lip"]
     # schp_atr = outputs["schp_atr"]
@@ -0,0 +1,388 @@
+import argparse
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import torch
+
+from leffa.checkpoint import load_file_mmap
+from leffa_utils.preprocess_cache import image_digest, model_version
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+# bump when the layout or the keying of an entry changes; old stores are then ignored, not misread
+STORE_FORMAT = 1
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+# which reference UNet timesteps to precompute: none, the ref_acceleration one, or all
+FEATURE_MODES = ("none", "accel", "schedule")
+
+
+def store_version(vt_model_type: str, *checkpoint_paths: str) -> str:
+    """Directory name of the store for a try-on model: entries are only valid for the weights they came from."""
+    return f"{vt_model_type}-{model_version(*checkpoint_paths)}"
+
+
+def reference_image(source):
+    """
+    The 768x1024 RGB garment image the try-on model gets for `source` (a path, upload
+    bytes, ...), prepared exactly as leffa_predict does. Store entries are keyed by
+    image_digest of this, so precompute and serving must both go through here.
+    """
+    from leffa_utils.utils import resize_and_center
+    from leffa_utils.image_io import load_image
+
+    return resize_and_center(load_image(source), 768, 1024)
+
+
+class StoredFeatures(object):
+    """
+    {timestep: [features]} view over the entries of one batch, stacked along the
+    batch dimension on demand (see LeffaPipeline.reference_features). A timestep is
+    only present if every entry has it.
+    """
+
+    def __init__(self, entries: Sequence[Dict[str, torch.Tensor]]):
+        self.entries = entries
+        per_entry = [set(_feature_timesteps(entry)) for entry in entries]
+        self.timesteps = set.intersection(*per_entry) if per_entry else set()
+
+    def __len__(self):
+        return len(self.timesteps)
+
+    def get(self, t: int, default=None) -> Optional[List[torch.Tensor]]:
+        if t not in self.timesteps:
+            return default
+        count = sum(1 for name in self.entries[0] if name.startswith(f"features.{t}."))
+        return [torch.stack([entry[f"features.{t}.{i}"] for entry in self.entries]) for i in range(count)]
+
+
+def _feature_timesteps(entry: Dict[str, torch.Tensor]) -> Iterable[int]:
+    return {int(name.split(".")[1]) for name in entry if name.startswith("features.")}
+
+
+class GarmentStore(object):
+    """
+    Precomputed garment-side tensors, one safetensors file per garment under
+    `root/<version>/<digest[:2]>/<digest>.safetensors`, where the digest is
+    image_digest of the 768x1024 RGB reference image fed to the try-on model
+    (see reference_image).
+
+    Each entry holds "latent" (the scaled VAE latent, 4xHxW) and optionally
+    "features.<t>.<i>" (conditional reference UNet features at timestep t, without
+    the batch dimension). Entries are written once, atomically, and read through
+    load_file_mmap, so a serving process only pages in what it touches and never
+    writes to the store. `index.jsonl` maps catalog ids to digests.
+    """
+
+    def __init__(self, root: str, version: str, read_only: bool = True, capacity: int = 64):
+        self.root = root
+        self.version = version
+        self.read_only = read_only
+        self.capacity = capacity
+        self.dir = os.path.join(root, version)
+        self.manifest: Dict[str, Any] = {}
+        self.index: Dict[str, Dict[str, Any]] = {}
+        self._open: "OrderedDict[str, Dict[str, torch.Tensor]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        manifest_path = os.path.join(self.dir, "manifest.json")
+        if os.path.isfile(manifest_path):
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+            if self.manifest.get("format") != STORE_FORMAT:
+                raise ValueError(f"{manifest_path}: format {self.manifest.get('format')}, expected {STORE_FORMAT}")
+        elif read_only:
+            raise FileNotFoundError(f"No garment store at {self.dir}")
+
+        index_path = os.path.join(self.dir, "index.jsonl")
+        if os.path.isfile(index_path):
+            with open(index_path) as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        self.index[record["id"]] = record
+
+    @classmethod
+    def open(cls, root: str, version: str) -> Optional["GarmentStore"]:
+        """Read-only store, or None if nothing (current) was precomputed for `version`."""
+        try:
+            return cls(root, version, read_only=True)
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            logger.warning(f"Ignoring garment store: {e}")
+            return None
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.dir, digest[:2], digest + ".safetensors")
+
+    def __contains__(self, digest: str) -> bool:
+        return os.path.isfile(self.path(digest))
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def get(self, digest: str) -> Optional[Dict[str, torch.Tensor]]:
+        with self._lock:
+            if digest in self._open:
+                self._open.move_to_end(digest)
+                return self._open[digest]
+        if digest not in self:
+            return None
+        entry = load_file_mmap(self.path(digest))
+        with self._lock:
+            self._open[digest] = entry
+            while len(self._open) > self.capacity:
+                self._open.popitem(last=False)
+        return entry
+
+    def lookup(self, garment_id: str) -> Optional[str]:
+        record = self.index.get(garment_id)
+        return record["digest"] if record is not None and record["digest"] in self else None
+
+    def batch(self, images) -> Optional[Tuple[torch.Tensor, StoredFeatures]]:
+        """(stacked latents, features) for reference images, or None unless all of them are stored."""
+        entries = [self.get(image_digest(image)) for image in images]
+        if any(entry is None for entry in entries):
+            return None
+        return torch.stack([entry["latent"] for entry in entries]), StoredFeatures(entries)
+
+    # writing
+
+    def init(self, **manifest) -> None:
+        """Create the store, or check that an existing one was built with the same settings."""
+        assert not self.read_only
+        manifest = {"format": STORE_FORMAT, "version": self.version, **manifest}
+        if self.manifest:
+            mismatched = {k: (self.manifest.get(k), v) for k, v in manifest.items() if self.manifest.get(k) != v}
+            if mismatched:
+                raise ValueError(f"{self.dir} was built with different settings: {mismatched}")
+            return
+        os.makedirs(self.dir, exist_ok=True)
+        manifest["created"] = time.time()
+        with open(os.path.join(self.dir, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=2)
+        self.manifest = manifest
+
+    def put(self, digest: str, tensors: Dict[str, torch.Tensor], record: Dict[str, Any]) -> None:
+        import safetensors.torch
+
+        assert not self.read_only
+        path = self.path(digest)
+        if digest not in self:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # write-then-rename: an interrupted run leaves no partial entries behind
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            os.close(fd)
+            safetensors.torch.save_file({k: v.contiguous() for k, v in tensors.items()}, tmp_path)
+            os.replace(tmp_path, path)
+        record = {**record, "digest": digest}
+        with open(os.path.join(self.dir, "index.jsonl"), "a") as f:
+            f.write(json.dumps(record) + "\n")
+        self.index[record["id"]] = record
+
+    def is_current(self, record: Dict[str, Any]) -> bool:
+        """Whether the source described by `record` was already processed, unchanged."""
+        known = self.index.get(record["id"])
+        return (
+            known is not None
+            and all(known.get(k) == v for k, v in record.items())
+            and known["digest"] in self
+        )
+
+
+# precompute job
+
+
+def list_garments(source: str) -> List[Dict[str, Any]]:
+    """Garments from a directory (recursively) or a manifest (.txt of paths or .jsonl with "path" and optional "id")."""
+    items = []
+    if os.path.isdir(source):
+        for dirpath, _, filenames in os.walk(source):
+            for filename in sorted(filenames):
+                if filename.lower().endswith(IMAGE_EXTENSIONS):
+                    path = os.path.join(dirpath, filename)
+                    items.append({"id": os.path.relpath(path, source), "path": path})
+        items.sort(key=lambda item: item["id"])
+    else:
+        base = os.path.dirname(os.path.abspath(source))
+        with open(source) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                item = json.loads(line) if line.startswith("{") else {"path": line}
+                item["path"] = os.path.join(base, item["path"])
+                item.setdefault("id", os.path.relpath(item["path"], base))
+                items.append(item)
+    for item in items:
+        st = os.stat(item["path"])
+        item["size"], item["mtime"] = st.st_size, int(st.st_mtime)
+    return items
+
+
+def decode_ahead(fn, items: Sequence[Any], workers: int, prefetch: int) -> Iterator[Tuple[Any, Any]]:
+    """(item, fn(item)) in order, with up to `prefetch` items decoding ahead on a thread pool."""
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="decode") as pool:
+        pending = deque()
+        items = iter(items)
+        for item in items:
+            pending.append((item, pool.submit(fn, item)))
+            if len(pending) >= prefetch:
+                break
+        while pending:
+            item, future = pending.popleft()
+            for next_item in items:
+                pending.append((next_item, pool.submit(fn, next_item)))
+                break
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.warning(f"Skipping {item['path']}: {e}")
+                continue
+            yield item, result
+
+
+def load_garment(item: Dict[str, Any]):
+    # no preprocess_garment_image here: serving does not run it on uploads, so an entry
+    # keyed by a preprocessed image would never be found (store preprocessed files instead)
+    image = reference_image(item["path"])
+    return image, image_digest(image)
+
+
+def check(store: GarmentStore, items: Sequence[Dict[str, Any]]) -> List[str]:
+    """
+    Ids of garments that a request would not find in the store: each file is read as
+    upload bytes, prepared by reference_image like leffa_predict does and looked up
+    with GarmentStore.batch like tryon_batch does.
+    """
+    missing = []
+    for item in items:
+        with open(item["path"], "rb") as f:
+            image = reference_image(f.read())
+        record = store.index.get(item["id"])
+        if record is None or record["digest"] != image_digest(image) or store.batch([image]) is None:
+            missing.append(item["id"])
+    return missing
+
+
+@torch.no_grad()
+def encode_batch(model, images, timesteps: Sequence[int], generator=None) -> List[Dict[str, torch.Tensor]]:
+    """Store entries for a batch of 768x1024 reference images: VAE latents and reference UNet features."""
+    from leffa.transform import LeffaTransform
+
+    processor = LeffaTransform().vae_processor
+    pixels = torch.cat([processor.preprocess(image, 1024, 768) for image in images])
+    pixels = pixels.to(device=model.vae.device, dtype=model.vae.dtype)
+    latents = model.vae.encode(pixels).latent_dist.sample(generator) * model.vae.config.scaling_factor
+
+    entries = [{"latent": latent.cpu()} for latent in latents]
+    for t in timesteps:
+        down, features = model.unet_encoder(
+            latents, torch.tensor(t, device=latents.device), encoder_hidden_states=None, return_dict=False
+        )
+        for i, feature in enumerate(features):
+            feature = feature.cpu()
+            for entry, row in zip(entries, feature):
+                entry[f"features.{t}.{i}"] = row.clone()
+    return entries
+
+
+def precompute(
+    ckpt_dir: str,
+    source: str,
+    output_dir: str,
+    vt_model_type: str = "viton_hd",
+    steps: int = 20,
+    features: str = "accel",
+    batch_size: int = 8,
+    workers: int = 4,
+    seed: int = 42,
+) -> GarmentStore:
+    """Fill the store for `vt_model_type` with every garment of `source` not already in it."""
+    from leffa.checkpoint import resolve_checkpoint
+    from leffa.model import LeffaModel
+
+    assert features in FEATURE_MODES, f"features must be one of {FEATURE_MODES}"
+    checkpoint = resolve_checkpoint(
+        f"{ckpt_dir}/virtual_tryon.pth" if vt_model_type == "viton_hd" else f"{ckpt_dir}/virtual_tryon_dc.pth"
+    )
+    store = GarmentStore(output_dir, store_version(vt_model_type, checkpoint), read_only=False)
+
+    items = list_garments(source)
+    todo = [item for item in items if not store.is_current(item)]
+    logger.info(f"{len(items)} garments, {len(items) - len(todo)} already in {store.dir}")
+    if not todo:
+        return store
+
+    model = LeffaModel(
+        pretrained_model_name_or_path=f"{ckpt_dir}/stable-diffusion-inpainting",
+        pretrained_model=checkpoint,
+        dtype="float16",
+    )
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = model.to(device).eval()
+    model.noise_scheduler.set_timesteps(steps, device=device)
+    schedule = [int(t) for t in model.noise_scheduler.timesteps]
+    timesteps = {"none": [], "accel": [schedule[steps // 2]], "schedule": schedule}[features]
+    store.init(steps=steps, features=features, timesteps=timesteps)
+    generator = torch.Generator(device).manual_seed(seed)
+
+    done = 0
+    start = time.perf_counter()
+    batch = []
+
+    def flush():
+        nonlocal done
+        # one encode per distinct garment not stored yet; duplicates only get an index record
+        new = OrderedDict((digest, image) for _, image, digest in batch if digest not in store)
+        entries = dict(zip(new, encode_batch(model, list(new.values()), timesteps, generator))) if new else {}
+        for item, _, digest in batch:
+            store.put(digest, entries.pop(digest, {}), item)
+        done += len(batch)
+        batch.clear()
+        logger.info(f"{done}/{len(todo)} garments, {done / (time.perf_counter() - start):.2f}/s")
+
+    for item, (image, digest) in decode_ahead(
+        load_garment, todo, workers=workers, prefetch=max(2 * batch_size, workers)
+    ):
+        batch.append((item, image, digest))
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    return store
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute garment latents and reference features for a catalog.")
+    parser.add_argument("source", help="directory of garment images, or a .txt / .jsonl manifest")
+    parser.add_argument("--ckpt_dir", default="./ckpts")
+    parser.add_argument("--output_dir", default="./garment_store")
+    parser.add_argument("--vt_model_type", default="viton_hd", choices=["viton_hd", "dress_code"])
+    parser.add_argument("--steps", type=int, default=20, help="inference steps the features are computed for")
+    parser.add_argument("--features", default="accel", choices=FEATURE_MODES,
+                        help="reference features to store: none, the ref_acceleration timestep, or every step")
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=4, help="decode threads")
+    parser.add_argument("--check", action="store_true",
+                        help="afterwards, check that every garment is found the way a try-on request looks it up")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    store = precompute(
+        args.ckpt_dir, args.source, args.output_dir, vt_model_type=args.vt_model_type, steps=args.steps,
+        features=args.features, batch_size=args.batch_size, workers=args.workers,
+    )
+    print(f"{len(store)} garments in {store.dir}")
+    if args.check:
+        missing = check(store, list_garments(args.source))
+        if missing:
+            raise SystemExit(f"{len(missing)} garments not found through the serving path, e.g. {missing[:5]}")
+        print("all garments found through the serving path")
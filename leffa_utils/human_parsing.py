@@ -0,0 +1,116 @@
+import contextlib
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from PIL import Image
+
+from leffa_utils.threads import get_thread_budget
+from preprocess.humanparsing.parsing_api import ParsingRunner, add_neck, get_palette, refine_atr_parsing
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+ATR_CKPT = "exp-schp-201908301523-atr.pth"
+LIP_CKPT = "exp-schp-201908261155-lip.pth"
+
+
+def labels_to_image(labels: np.ndarray, num_classes: int) -> Image.Image:
+    image = Image.fromarray(np.asarray(labels, dtype=np.uint8))
+    image.putpalette(get_palette(num_classes))
+    return image
+
+
+class HumanParsing(object):
+    """
+    ATR + LIP human parsing, run once per image and shared by AutoMasker and the
+    Leffa mask preprocessing.
+
+    backend="torch" runs the SCHP checkpoints in `schp_path` on `device`;
+    backend="onnx" runs the exported graphs in `onnx_path` with onnxruntime on CPU.
+    Both are fed BGR input, which is what the networks were trained on. ATR and LIP
+    run concurrently (on their own CUDA streams with the torch backend) and lists of
+    images are parsed as batches.
+    """
+
+    def __init__(
+        self,
+        backend: str = "torch",
+        schp_path: str = "./ckpts/schp",
+        onnx_path: str = "./ckpts/humanparsing",
+        device="cuda",
+        concurrent: bool = True,
+    ):
+        assert backend in ["torch", "onnx"], f"Invalid backend: {backend}"
+        self.backend = backend
+        self._executor = None
+        self._streams = {}
+        if backend == "torch":
+            from SCHP import SCHP  # type: ignore
+
+            if concurrent:
+                self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="parsing")
+                if torch.device(device).type == "cuda":
+                    self._streams = {"atr": torch.cuda.Stream(), "lip": torch.cuda.Stream()}
+
+            self.atr = SCHP(ckpt_path=os.path.join(schp_path, ATR_CKPT), device=device)
+            self.lip = SCHP(ckpt_path=os.path.join(schp_path, LIP_CKPT), device=device)
+        else:
+            session_options = get_thread_budget().ort_session_options("parsing", parallel=2 if concurrent else 1)
+            self.runner = ParsingRunner(
+                os.path.join(onnx_path, "parsing_atr.onnx"),
+                os.path.join(onnx_path, "parsing_lip.onnx"),
+                session_options=session_options,
+                concurrent=concurrent,
+            )
+
+    def torch_models(self):
+        """The nn.Modules behind the torch backend, for residency management."""
+        if self.backend != "torch":
+            return {}
+        return {"schp_atr": self.atr.model, "schp_lip": self.lip.model}
+
+    def _run(self, name, images):
+        images_bgr = [np.ascontiguousarray(np.asarray(image)[:, :, ::-1]) for image in images]
+        stream = self._streams.get(name)
+        if stream is not None:
+            stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream) if stream is not None else contextlib.nullcontext():
+            results = getattr(self, name)(images_bgr)
+        results = results if isinstance(results, list) else [results]
+        return [np.array(result) for result in results]
+
+    def parse(self, image_or_list):
+        """Raw (ATR, LIP) argmax label maps of an RGB PIL image or path, or of a list of them."""
+        images = image_or_list if isinstance(image_or_list, list) else [image_or_list]
+        images = [(Image.open(image) if isinstance(image, str) else image).convert("RGB") for image in images]
+        if self.backend == "onnx":
+            atr, lip = self.runner(images)
+        elif self._executor is not None:
+            atr, lip = self._executor.submit(self._run, "atr", images), self._executor.submit(self._run, "lip", images)
+            atr, lip = atr.result(), lip.result()
+        else:
+            atr, lip = self._run("atr", images), self._run("lip", images)
+        if not isinstance(image_or_list, list):
+            return atr[0], lip[0]
+        return atr, lip
+
+    def __call__(self, image_or_list):
+        """
+        :return: dict with the raw maps as paletted images ("schp_atr", "schp_lip"),
+            the hole-filled, neck-augmented ATR map ("parsing", what `Parsing` used to
+            return) and its face mask ("face_mask"); a list of them for list input.
+        """
+        if not isinstance(image_or_list, list):
+            return self([image_or_list])[0]
+        results = []
+        for atr, lip in zip(*self.parse(image_or_list)):
+            parsing = add_neck(refine_atr_parsing(atr), lip)
+            results.append({
+                "schp_atr": labels_to_image(atr, 18),
+                "schp_lip": labels_to_image(lip, 20),
+                "parsing": labels_to_image(parsing, 19),
+                "face_mask": torch.from_numpy((parsing == 11).astype(np.float32)),
+            })
+        return results
@@ -0,0 +1,58 @@
+import io
+import logging
+import math
+from typing import Optional, Tuple, Union
+
+import numpy as np
+from PIL import Image
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+# 40 MP: well above phone cameras, well below decompression bombs
+MAX_PIXELS = 40_000_000
+
+ImageSource = Union[str, bytes, bytearray, memoryview, io.IOBase, Image.Image, np.ndarray]
+
+
+class ImageTooLarge(ValueError):
+    """The encoded input or its pixel count exceeds the configured limit."""
+
+
+def load_image(
+    source: ImageSource,
+    target_size: Optional[Tuple[int, int]] = (768, 1024),
+    max_bytes: Optional[int] = None,
+    max_pixels: Optional[int] = MAX_PIXELS,
+) -> Image.Image:
+    """
+    RGB PIL image from a path, encoded bytes, a file object, a PIL image or an
+    HWC (or HW) uint8 RGB array, without going through a temp file.
+
+    Encoded JPEGs much larger than `target_size` (width, height) are decoded in
+    draft mode, i.e. downscaled by 1/2, 1/4 or 1/8 inside the JPEG decoder, to the
+    smallest size that still covers what resize_and_center(target_size) keeps.
+    The pixel count is checked from the header before anything is decoded.
+    """
+    if isinstance(source, Image.Image):
+        return source.convert("RGB")
+    if isinstance(source, np.ndarray):
+        if source.ndim == 2 or source.shape[-1] == 1:
+            return Image.fromarray(source.reshape(source.shape[:2]).astype(np.uint8)).convert("RGB")
+        return Image.fromarray(source[:, :, :3].astype(np.uint8), "RGB")
+
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        if max_bytes is not None and len(source) > max_bytes:
+            raise ImageTooLarge(f"{len(source)} bytes > {max_bytes}")
+        source = io.BytesIO(source)
+    image = Image.open(source)
+    width, height = image.size
+    if max_pixels is not None and width * height > max_pixels:
+        raise ImageTooLarge(f"{width}x{height} > {max_pixels} pixels")
+
+    if target_size is not None and image.format == "JPEG":
+        scale = min(target_size[0] / width, target_size[1] / height)
+        if scale < 0.5:
+            requested = (math.ceil(width * scale), math.ceil(height * scale))
+            image.draft("RGB", requested)
+            logger.debug(f"JPEG draft decode {width}x{height} -> {image.size}")
+    return image.convert("RGB")
@@ -0,0 +1,222 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, List, Optional
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    """The worker queue is at capacity; the caller should retry later (HTTP 429)."""
+
+
+class DeadlineExceeded(Exception):
+    """The request's deadline passed before the worker got to it."""
+
+
+class InferenceRequest(object):
+    def __init__(self, payload: Any, batch_key: Hashable, deadline: float):
+        self.payload = payload
+        self.batch_key = batch_key
+        self.deadline = deadline
+        self.enqueued = time.monotonic()
+        self.future: Future = Future()
+
+    def expired(self, now: Optional[float] = None) -> bool:
+        return (now if now is not None else time.monotonic()) > self.deadline
+
+
+class InferenceWorker(object):
+    """
+    Single background thread that owns the (synchronous) model, fed through a
+    bounded queue so the web server's event loop never blocks on a generation.
+
+    `submit()` returns a concurrent.futures.Future (wrap it with
+    asyncio.wrap_future in async code) or raises QueueFull once `max_queue`
+    requests are waiting. The worker takes the oldest request and, for up to
+    `batch_window` seconds, gathers further requests with the same `batch_key`
+    (e.g. model type, garment type and steps) into one call of
+    `predict_batch(payloads) -> results`, at most `max_batch` at a time. A result
+    that is an Exception instance fails only its own request. Requests
+    whose deadline has passed, or whose future was cancelled by a caller that gave
+    up, are dropped before they reach the model.
+    """
+
+    def __init__(
+        self,
+        predict_batch: Callable[[List[Any]], List[Any]],
+        max_queue: int = 16,
+        max_batch: int = 4,
+        batch_window: float = 0.05,
+        default_timeout: float = 300.0,
+        name: str = "inference",
+    ):
+        self.predict_batch = predict_batch
+        self.max_queue = max_queue
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self.default_timeout = default_timeout
+        self.name = name
+
+        self._queue: "deque[InferenceRequest]" = deque()
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+        self._busy = False
+        self.counters: Dict[str, int] = {
+            "submitted": 0, "rejected": 0, "expired": 0, "cancelled": 0,
+            "completed": 0, "failed": 0, "batches": 0,
+        }
+
+    # lifecycle
+
+    def start(self) -> "InferenceWorker":
+        if self._thread is None or not self._thread.is_alive():
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    # client side
+
+    def submit(
+        self, payload: Any, batch_key: Hashable = None, timeout: Optional[float] = None, reserve: int = 0
+    ) -> Future:
+        """
+        reserve: queue slots this request must leave free, so background submitters
+            (e.g. the job runner) cannot crowd out interactive requests
+        """
+        timeout = self.default_timeout if timeout is None else timeout
+        request = InferenceRequest(payload, batch_key, time.monotonic() + timeout)
+        with self._cond:
+            if len(self._queue) >= self.max_queue - reserve:
+                self.counters["rejected"] += 1
+                raise QueueFull(f"{len(self._queue)} requests waiting")
+            self._queue.append(request)
+            self.counters["submitted"] += 1
+            self._cond.notify_all()
+        return request.future
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "alive": self._thread is not None and self._thread.is_alive(),
+                "busy": self._busy,
+                "queued": len(self._queue),
+                "max_queue": self.max_queue,
+                **self.counters,
+            }
+
+    # worker side
+
+    def _drop_dead(self) -> None:
+        """Fail expired and skip cancelled requests. Caller holds the lock."""
+        now = time.monotonic()
+        for request in list(self._queue):
+            if request.future.cancelled():
+                self._queue.remove(request)
+                self.counters["cancelled"] += 1
+            elif request.expired(now):
+                self._queue.remove(request)
+                self.counters["expired"] += 1
+                if request.future.set_running_or_notify_cancel():
+                    request.future.set_exception(DeadlineExceeded(f"waited {now - request.enqueued:.1f}s"))
+
+    def _take_batch(self) -> Optional[List[InferenceRequest]]:
+        with self._cond:
+            while True:
+                self._drop_dead()
+                if self._queue or self._stopping:
+                    break
+                self._cond.wait(timeout=1.0)
+            if not self._queue:
+                return None
+            first = self._queue.popleft()
+            batch = [first]
+            window_end = time.monotonic() + self.batch_window
+            while len(batch) < self.max_batch:
+                self._drop_dead()
+                for request in list(self._queue):
+                    if request.batch_key == first.batch_key and len(batch) < self.max_batch:
+                        self._queue.remove(request)
+                        batch.append(request)
+                remaining = window_end - time.monotonic()
+                if len(batch) >= self.max_batch or remaining <= 0 or self._stopping:
+                    break
+                self._cond.wait(timeout=remaining)
+            self._busy = True
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._take_batch()
+            if batch is None:
+                return
+            # a caller may have given up while the batch was being gathered
+            batch = [r for r in batch if r.future.set_running_or_notify_cancel()]
+            try:
+                if batch:
+                    results = self.predict_batch([r.payload for r in batch])
+                    assert len(results) == len(batch), f"{len(results)} results for {len(batch)} requests"
+                    failed = 0
+                    for request, result in zip(batch, results):
+                        if isinstance(result, Exception):
+                            request.future.set_exception(result)
+                            failed += 1
+                        else:
+                            request.future.set_result(result)
+                    with self._cond:
+                        self.counters["completed"] += len(batch) - failed
+                        self.counters["failed"] += failed
+                        self.counters["batches"] += 1
+            except Exception as e:
+                logger.exception(f"Batch of {len(batch)} failed")
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                with self._cond:
+                    self.counters["failed"] += len(batch)
+            finally:
+                with self._cond:
+                    self._busy = False
+
+
+if __name__ == "__main__":
+    # CPU-only exercise of batching, backpressure and deadlines with a stub model
+    import argparse
+    from concurrent.futures import wait
+
+    parser = argparse.ArgumentParser(description="Run the inference worker against a stub pipeline.")
+    parser.add_argument("--requests", type=int, default=12)
+    parser.add_argument("--latency", type=float, default=0.2, help="stub seconds per batch")
+    parser.add_argument("--max_queue", type=int, default=8)
+    parser.add_argument("--max_batch", type=int, default=4)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    def stub_predict_batch(payloads):
+        time.sleep(args.latency)
+        return [f"result for {p}" for p in payloads]
+
+    worker = InferenceWorker(stub_predict_batch, max_queue=args.max_queue, max_batch=args.max_batch).start()
+    futures = []
+    for i in range(args.requests):
+        key = ("viton_hd", "upper_body", 20) if i % 3 else ("dress_code", "lower_body", 20)
+        try:
+            futures.append(worker.submit(i, batch_key=key, timeout=args.latency * 3))
+        except QueueFull as e:
+            print(f"request {i}: 429 ({e})")
+    wait(futures)
+    for future in futures:
+        print(future.exception() or future.result())
+    print(worker.stats())
+    worker.stop()
@@ -0,0 +1,105 @@
+import logging
+from typing import List, Optional, Tuple
+
+import cv2
+import numpy as np
+from PIL import Image
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+Box = Tuple[int, int, int, int]  # x0, y0, x1, y1, exclusive
+
+
+def _square(x0, y0, x1, y1, pad, min_side, image_size) -> Optional[Box]:
+    """Smallest square of at least `min_side` holding the padded box, moved inside the image.
+    None if it does not fit."""
+    w, h = image_size
+    side = max(x1 - x0, y1 - y0) + 2 * pad
+    side = max(side, min_side)
+    if side > min(w, h):
+        return None
+    cx, cy = (x0 + x1) // 2, (y0 + y1) // 2
+    bx = min(max(cx - side // 2, 0), w - side)
+    by = min(max(cy - side // 2, 0), h - side)
+    return bx, by, bx + side, by + side
+
+
+def _side(extent) -> int:
+    return max(extent[2] - extent[0], extent[3] - extent[1])
+
+
+def _overlaps(a: Box, b: Box) -> bool:
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def crop_boxes(
+    mask: np.ndarray, pad: int = 48, min_side: int = 256, max_boxes: int = 4
+) -> Optional[List[Box]]:
+    """
+    Square crop boxes covering every connected component of `mask`, each padded by
+    `pad` pixels of context. Overlapping boxes are merged, then the closest ones
+    until at most `max_boxes` remain.
+
+    :return: list of boxes, or None if the regions need a box larger than the image
+        (inpaint the full frame instead)
+    """
+    h, w = mask.shape[:2]
+    num, _, stats, _ = cv2.connectedComponentsWithStats(mask.astype(np.uint8), connectivity=8)
+    # (region extent, square box) per group of components
+    groups = []
+    for x, y, bw, bh, _ in stats[1:num]:
+        extent = (int(x), int(y), int(x + bw), int(y + bh))
+        box = _square(*extent, pad, min_side, (w, h))
+        if box is None:
+            return None
+        groups.append((extent, box))
+
+    def merged(a, b):
+        extent = (min(a[0][0], b[0][0]), min(a[0][1], b[0][1]), max(a[0][2], b[0][2]), max(a[0][3], b[0][3]))
+        return extent, _square(*extent, pad, min_side, (w, h))
+
+    while len(groups) > 1:
+        pairs = [(i, j) for i in range(len(groups)) for j in range(i + 1, len(groups))]
+        overlapping = [(i, j) for i, j in pairs if _overlaps(groups[i][1], groups[j][1])]
+        if overlapping:
+            i, j = overlapping[0]
+        elif len(groups) > max_boxes:
+            # the pair whose merged square is smallest
+            i, j = min(pairs, key=lambda p: _side(merged(groups[p[0]], groups[p[1]])[0]))
+        else:
+            break
+        group = merged(groups[i], groups[j])
+        if group[1] is None:
+            return None
+        groups = [g for k, g in enumerate(groups) if k not in (i, j)] + [group]
+    return [box for _, box in groups]
+
+
+def feather(mask: np.ndarray, radius: int) -> np.ndarray:
+    """
+    Float alpha that is 1 deep inside `mask` and falls off smoothly over about
+    `radius` pixels towards its edge, so composited patches have no hard seam.
+    It is 0 outside the mask: nothing outside the inpainted region is changed.
+    """
+    mask = (mask > 0).astype(np.float32)
+    if radius <= 0:
+        return mask
+    return mask * cv2.GaussianBlur(mask, (0, 0), radius / 2)
+
+
+def composite(base: np.ndarray, patch: np.ndarray, alpha: np.ndarray) -> np.ndarray:
+    """base * (1 - alpha) + patch * alpha for HWC uint8 images and an HW alpha."""
+    alpha = alpha[..., None]
+    out = base.astype(np.float32) * (1 - alpha) + patch.astype(np.float32) * alpha
+    return np.clip(np.rint(out), 0, 255).astype(np.uint8)
+
+
+def cut(image: Image.Image, box: Box, size: int) -> Image.Image:
+    return image.crop(box).resize((size, size), Image.LANCZOS)
+
+
+def paste(base: np.ndarray, patch: Image.Image, box: Box, alpha: np.ndarray) -> None:
+    """Resize `patch` back to `box` and blend it into `base` in place with the box's slice of `alpha`."""
+    x0, y0, x1, y1 = box
+    patch = np.asarray(patch.convert("RGB").resize((x1 - x0, y1 - y0), Image.LANCZOS))
+    base[y0:y1, x0:x1] = composite(base[y0:y1, x0:x1], patch, alpha[y0:y1, x0:x1])
@@ -0,0 +1,302 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from leffa_utils.inference_worker import QueueFull
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+TERMINAL = (DONE, FAILED, CANCELLED)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    batch_key TEXT,
+    params TEXT NOT NULL,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    stage TEXT,
+    progress REAL NOT NULL DEFAULT 0,
+    error TEXT,
+    result_path TEXT,
+    expires REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created);
+CREATE TABLE IF NOT EXISTS job_inputs (
+    job_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (job_id, name)
+);
+"""
+
+
+class JobStore(object):
+    """
+    Try-on jobs in a local SQLite database (WAL mode), with the encoded input
+    images stored alongside and results written to `result_dir`.
+
+    Everything a queued job needs survives a restart; jobs that were running
+    when the process died are put back in the queue by `requeue_running()`.
+    Finished jobs and their results are kept for `ttl` seconds.
+    """
+
+    def __init__(self, path: str = "./jobs/jobs.sqlite3", result_dir: str = "./jobs/results", ttl: float = 3600.0):
+        self.path = path
+        self.result_dir = result_dir
+        self.ttl = ttl
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        os.makedirs(result_dir, exist_ok=True)
+        self._local = threading.local()
+        self._claim_lock = threading.Lock()
+        with self._db() as db:
+            db.executescript(SCHEMA)
+
+    def _db(self) -> sqlite3.Connection:
+        # one connection per thread; sqlite3 connections are not shared across threads
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    @staticmethod
+    def _row(row: Optional[sqlite3.Row]) -> Optional[Dict[str, Any]]:
+        if row is None:
+            return None
+        job = dict(row)
+        job["params"] = json.loads(job["params"])
+        if job["batch_key"] is not None:
+            # stored as a JSON list, handed back as the tuple it was created with
+            job["batch_key"] = tuple(json.loads(job["batch_key"]))
+        return job
+
+    # client side
+
+    def create(
+        self, params: Dict[str, Any], inputs: Dict[str, bytes], batch_key: Optional[Sequence[Any]] = None
+    ) -> str:
+        """`batch_key`: tuple of JSON scalars, passed to the runner's `submit` as a tuple again."""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._db() as db:
+            db.execute(
+                "INSERT INTO jobs (id, status, batch_key, params, created, updated) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, QUEUED, json.dumps(list(batch_key)) if batch_key is not None else None,
+                 json.dumps(params), now, now),
+            )
+            db.executemany(
+                "INSERT INTO job_inputs (job_id, name, data) VALUES (?, ?, ?)",
+                [(job_id, name, sqlite3.Binary(data)) for name, data in inputs.items()],
+            )
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return self._row(self._db().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def count(self, status: str = QUEUED) -> int:
+        return self._db().execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (status,)).fetchone()[0]
+
+    def cancel(self, job_id: str) -> bool:
+        """Cancel a job that has not started yet."""
+        with self._db() as db:
+            cur = db.execute(
+                "UPDATE jobs SET status = ?, updated = ?, expires = ? WHERE id = ? AND status = ?",
+                (CANCELLED, time.time(), time.time() + self.ttl, job_id, QUEUED),
+            )
+            db.execute("DELETE FROM job_inputs WHERE job_id = ?", (job_id,))
+        return cur.rowcount == 1
+
+    # worker side
+
+    def claim(self) -> Optional[Dict[str, Any]]:
+        """Mark the oldest queued job running and return it, or None if the queue is empty."""
+        with self._claim_lock, self._db() as db:
+            row = db.execute(
+                "SELECT id FROM jobs WHERE status = ? ORDER BY created LIMIT 1", (QUEUED,)
+            ).fetchone()
+            if row is None:
+                return None
+            cur = db.execute(
+                "UPDATE jobs SET status = ?, updated = ? WHERE id = ? AND status = ?",
+                (RUNNING, time.time(), row["id"], QUEUED),
+            )
+            if cur.rowcount != 1:
+                return None
+        return self.get(row["id"])
+
+    def inputs(self, job_id: str) -> Dict[str, bytes]:
+        rows = self._db().execute("SELECT name, data FROM job_inputs WHERE job_id = ?", (job_id,)).fetchall()
+        return {row["name"]: bytes(row["data"]) for row in rows}
+
+    def set_progress(self, job_id: str, stage: str, progress: float) -> None:
+        with self._db() as db:
+            db.execute(
+                "UPDATE jobs SET stage = ?, progress = ?, updated = ? WHERE id = ? AND status = ?",
+                (stage, progress, time.time(), job_id, RUNNING),
+            )
+
+    def complete(self, job_id: str, result: bytes, ext: str = "jpg") -> None:
+        path = os.path.join(self.result_dir, f"{job_id}.{ext}")
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(result)
+        os.replace(tmp, path)
+        now = time.time()
+        with self._db() as db:
+            db.execute(
+                "UPDATE jobs SET status = ?, progress = 1, result_path = ?, updated = ?, expires = ? WHERE id = ?",
+                (DONE, path, now, now + self.ttl, job_id),
+            )
+            db.execute("DELETE FROM job_inputs WHERE job_id = ?", (job_id,))
+
+    def fail(self, job_id: str, error: str) -> None:
+        now = time.time()
+        with self._db() as db:
+            db.execute(
+                "UPDATE jobs SET status = ?, error = ?, updated = ?, expires = ? WHERE id = ?",
+                (FAILED, error, now, now + self.ttl, job_id),
+            )
+            db.execute("DELETE FROM job_inputs WHERE job_id = ?", (job_id,))
+
+    def requeue(self, job_id: str) -> bool:
+        """Put a running job back in the queue, e.g. when the runner stops before submitting it."""
+        with self._db() as db:
+            cur = db.execute(
+                "UPDATE jobs SET status = ?, stage = NULL, progress = 0, updated = ? WHERE id = ? AND status = ?",
+                (QUEUED, time.time(), job_id, RUNNING),
+            )
+        return cur.rowcount == 1
+
+    def requeue_running(self) -> int:
+        """Put jobs left running by a previous process back in the queue."""
+        with self._db() as db:
+            cur = db.execute(
+                "UPDATE jobs SET status = ?, stage = NULL, progress = 0, updated = ? WHERE status = ?",
+                (QUEUED, time.time(), RUNNING),
+            )
+        if cur.rowcount:
+            logger.info(f"Requeued {cur.rowcount} interrupted job(s)")
+        return cur.rowcount
+
+    def purge_expired(self) -> int:
+        now = time.time()
+        with self._db() as db:
+            rows = db.execute("SELECT id, result_path FROM jobs WHERE expires IS NOT NULL AND expires < ?", (now,)).fetchall()
+            for row in rows:
+                if row["result_path"] and os.path.exists(row["result_path"]):
+                    os.remove(row["result_path"])
+            db.executemany("DELETE FROM jobs WHERE id = ?", [(row["id"],) for row in rows])
+            db.executemany("DELETE FROM job_inputs WHERE job_id = ?", [(row["id"],) for row in rows])
+        return len(rows)
+
+
+class JobRunner(object):
+    """
+    Pool of dispatcher threads that move jobs from a JobStore to the model.
+
+    Each dispatcher claims one queued job, turns it into a payload with
+    `prepare(job, inputs)` and hands it to `submit(payload, batch_key)` (e.g.
+    InferenceWorker.submit, which batches what the dispatchers hand over and may
+    raise QueueFull). The result goes through `encode(result) -> bytes` into the
+    store. Payloads get a `progress` callback that records the current stage.
+    """
+
+    def __init__(
+        self,
+        store: JobStore,
+        submit: Callable[..., Future],
+        prepare: Callable[[Dict[str, Any], Dict[str, bytes]], Dict[str, Any]],
+        encode: Callable[[Any], bytes],
+        workers: int = 4,
+        poll_interval: float = 0.5,
+        purge_interval: float = 60.0,
+    ):
+        self.store = store
+        self.submit = submit
+        self.prepare = prepare
+        self.encode = encode
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.purge_interval = purge_interval
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    def start(self) -> "JobRunner":
+        self.store.requeue_running()
+        self._stopping.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._dispatch, name=f"jobs-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        thread = threading.Thread(target=self._purge, name="jobs-purge", daemon=True)
+        thread.start()
+        self._threads.append(thread)
+        return self
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def notify(self) -> None:
+        """Wake the dispatchers after a job was created."""
+        self._wakeup.set()
+
+    def _progress(self, job_id: str):
+        def on_stage(stage, event, finished, total):
+            self.store.set_progress(job_id, stage if event == "start" else None, finished / max(total, 1))
+
+        return on_stage
+
+    def _run_job(self, job: Dict[str, Any]) -> None:
+        payload = self.prepare(job, self.store.inputs(job["id"]))
+        payload["progress"] = self._progress(job["id"])
+        while True:
+            try:
+                future = self.submit(payload, batch_key=job["batch_key"])
+                break
+            except QueueFull:
+                # the job is safe in the store, wait for room in the in-memory queue
+                if self._stopping.is_set():
+                    # not started yet: leave it (and its inputs) for the next process
+                    self.store.requeue(job["id"])
+                    return
+                time.sleep(self.poll_interval)
+        self.store.complete(job["id"], self.encode(future.result()))
+
+    def _dispatch(self) -> None:
+        while not self._stopping.is_set():
+            job = self.store.claim()
+            if job is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+            try:
+                self._run_job(job)
+            except Exception as e:
+                logger.exception(f"Job {job['id']} failed")
+                self.store.fail(job["id"], str(e))
+
+    def _purge(self) -> None:
+        while not self._stopping.wait(self.purge_interval):
+            try:
+                purged = self.store.purge_expired()
+                if purged:
+                    logger.info(f"Purged {purged} expired job(s)")
+            except Exception:
+                logger.exception("Purging expired jobs failed")
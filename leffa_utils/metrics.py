@@ -0,0 +1,203 @@
+import bisect
+import logging
+import math
+import threading
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+# seconds; covers cache hits (~ms) up to full-frame diffusion runs
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric(object):
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], object] = {}
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._samples(key, value))
+        return lines
+
+    def _samples(self, key, value) -> List[str]:
+        return [f"{self.name}{_labels(self.label_names, key)} {_number(value)}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # per-bucket (non-cumulative) counts, sum, count
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def _samples(self, key, value) -> List[str]:
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.buckets + (math.inf,), counts):
+            cumulative += n
+            lines.append(f"{self.name}_bucket{_labels(self.label_names, key, ('le', _number(bound)))} {cumulative}")
+        lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {_number(total)}")
+        lines.append(f"{self.name}_count{_labels(self.label_names, key)} {count}")
+        return lines
+
+    def render(self) -> List[str]:
+        # copy the mutable states under the lock before formatting
+        with self._lock:
+            items = sorted((k, ([*v[0]], v[1], v[2])) for k, v in self._values.items())
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in items:
+            lines.extend(self._samples(key, value))
+        return lines
+
+
+class Registry(object):
+    """
+    Minimal Prometheus text-format (0.0.4) registry. Recording is a dict update
+    under a lock; gauges that mirror other components' state are refreshed by
+    `on_collect` callbacks at scrape time instead of on the hot path.
+    """
+
+    def __init__(self):
+        self.metrics: Dict[str, _Metric] = {}
+        self.collectors: List[Callable[[], None]] = []
+
+    def _add(self, metric: _Metric):
+        assert metric.name not in self.metrics, f"Duplicate metric {metric.name}"
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: Sequence[str] = ()) -> Gauge:
+        return self._add(Gauge(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def on_collect(self, fn: Callable[[], None]) -> Callable[[], None]:
+        self.collectors.append(fn)
+        return fn
+
+    def render(self) -> str:
+        for fn in self.collectors:
+            try:
+                fn()
+            except Exception:
+                logger.exception("Metrics collector failed")
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "leffa_stage_seconds",
+    "Wall time of try-on stages (graph stages, and VAE encode / denoise / VAE decode inside tryon).",
+    ["stage", "vt_model_type", "vt_garment_type"],
+)
+
+
+def observe_stages(timings: Dict[str, float], **labels) -> None:
+    """Record {stage: seconds}, e.g. from a StageTrace or LeffaPipeline.last_timings."""
+    for stage, seconds in timings.items():
+        STAGE_SECONDS.observe(seconds, stage=stage, **labels)
+
+
+def observe_trace(trace, **labels) -> None:
+    if trace is not None:
+        observe_stages({r["stage"]: r["seconds"] for r in trace.records}, **labels)
+
+
+def collect_memory(gauge: Gauge, residency=None) -> None:
+    """Process RSS, per-device torch allocator usage and model residency tiers, in bytes."""
+    try:
+        import psutil
+
+        gauge.set(psutil.Process().memory_info().rss, kind="process_rss", device="host")
+    except ImportError:
+        pass
+    try:
+        import torch
+    except ImportError:
+        return
+    if torch.cuda.is_available():
+        for index in range(torch.cuda.device_count()):
+            device = f"cuda:{index}"
+            gauge.set(torch.cuda.memory_allocated(index), kind="allocated", device=device)
+            gauge.set(torch.cuda.memory_reserved(index), kind="reserved", device=device)
+            gauge.set(torch.cuda.max_memory_allocated(index), kind="max_allocated", device=device)
+    if residency is not None:
+        for tier in ("device", "host", "disk"):
+            gauge.set(residency.used(tier), kind="models", device=tier)
+
+
+if __name__ == "__main__":
+    # print a sample exposition
+    requests = REGISTRY.counter("demo_requests_total", "Demo requests.", ["status"])
+    requests.inc(status="200")
+    requests.inc(status="429")
+    observe_stages({"person_parsing": 0.12, "tryon": 4.2}, vt_model_type="viton_hd", vt_garment_type="upper_body")
+    print(REGISTRY.render())
@@ -0,0 +1,116 @@
+import logging
+
+import cv2
+import numpy as np
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+# square kernels at least this large go through a distance transform
+DT_MIN_SIZE = 15
+# largest fraction of pixels blur_threshold(scale > 1) may flip relative to scale=1;
+# the differences are confined to a band along the mask boundary
+BLUR_SCALE_MAX_MISMATCH = 0.01
+
+
+def composed_kernel(size: int, iterations: int = 1):
+    """
+    `iterations` dilations with a size x size box equal one dilation with this
+    (size, anchor): offsets add up per axis, and the intermediate points of any
+    path can be kept inside the image, so the result is identical at the borders too.
+    """
+    return iterations * (size - 1) + 1, iterations * (size // 2)
+
+
+def _binary_value(mask: np.ndarray):
+    """The single non-zero value of `mask`, 0 if it is empty, None if it is not a binary mask."""
+    value = mask.max()
+    if value == 0:
+        return value
+    if np.count_nonzero(mask) != np.count_nonzero(mask == value):
+        return None
+    return value
+
+
+def dilate(mask: np.ndarray, size: int, iterations: int = 1) -> np.ndarray:
+    """
+    Same as cv2.dilate(mask, np.ones((size, size)), iterations=iterations), in one pass.
+
+    Large odd kernels on binary masks use a chessboard distance transform, whose cost
+    does not grow with the kernel; everything else is a single box dilation.
+    """
+    if iterations <= 0:
+        return mask.copy()
+    ksize, anchor = composed_kernel(size, iterations)
+    if ksize >= DT_MIN_SIZE and ksize % 2 == 1:
+        value = _binary_value(mask)
+        if value is not None:
+            # DIST_C with a 3x3 mask is the exact chessboard distance to the nearest set pixel
+            dist = cv2.distanceTransform((mask == 0).astype(np.uint8), cv2.DIST_C, 3)
+            result = np.zeros_like(mask)
+            result[dist <= ksize // 2] = value
+            return result
+    return cv2.dilate(mask, np.ones((ksize, ksize), np.uint8), anchor=(anchor, anchor))
+
+
+def gaussian_sigma(ksize: int) -> float:
+    """The sigma OpenCV derives from the kernel size when sigma=0 is passed."""
+    return 0.3 * ((ksize - 1) * 0.5 - 1) + 0.8
+
+
+def blur_threshold(image: np.ndarray, ksize: int, threshold: float, scale: int = 1) -> np.ndarray:
+    """
+    (cv2.GaussianBlur(image, (ksize, ksize), 0) >= threshold) as a 0/1 uint8 mask.
+
+    With scale > 1 the blur runs on an image `scale` times smaller, with the kernel
+    and sigma scaled to match. The blurred values, not the binary result, are
+    upsampled bilinearly and thresholded at full resolution, so the boundary is
+    placed per pixel instead of in scale x scale blocks. scale=1 is exact.
+    """
+    h, w = image.shape[:2]
+    if scale <= 1 or min(h, w) < scale * ksize:
+        blurred = cv2.GaussianBlur(image, (ksize, ksize), 0)
+        return (blurred >= threshold).astype(np.uint8)
+
+    small = cv2.resize(image.astype(np.float32), (w // scale, h // scale), interpolation=cv2.INTER_AREA)
+    small_ksize = max(3, int(ksize / scale) | 1)
+    small = cv2.GaussianBlur(small, (small_ksize, small_ksize), gaussian_sigma(ksize) / scale)
+    blurred = cv2.resize(small, (w, h), interpolation=cv2.INTER_LINEAR)
+    if np.issubdtype(image.dtype, np.integer):
+        # the full resolution blur rounds to the input's integer type before the comparison
+        threshold = threshold - 0.5
+    return (blurred >= threshold).astype(np.uint8)
+
+
+def mismatch(a: np.ndarray, b: np.ndarray) -> float:
+    """Fraction of pixels where two masks disagree."""
+    return float(np.count_nonzero((a > 0) != (b > 0))) / a.size
+
+
+if __name__ == "__main__":
+    # parity against the plain OpenCV calls on random blob masks
+    rng = np.random.default_rng(0)
+    masks = []
+    for _ in range(8):
+        mask = np.zeros((1024, 768), np.uint8)
+        for _ in range(6):
+            center = (int(rng.integers(0, 768)), int(rng.integers(0, 1024)))
+            axes = (int(rng.integers(20, 200)), int(rng.integers(20, 300)))
+            cv2.ellipse(mask, center, axes, float(rng.integers(0, 180)), 0, 360, 1, -1)
+        masks.append(mask)
+
+    for size, iterations in [(5, 1), (5, 4), (10, 5), (9, 3)]:
+        for mask in masks:
+            reference = cv2.dilate(mask, np.ones((size, size), np.uint16), iterations=iterations)
+            assert np.array_equal(dilate(mask, size, iterations), reference), (size, iterations)
+    print("dilate: exact")
+
+    for scale in [1, 2, 4]:
+        worst = max(
+            mismatch(blur_threshold(m * 255, 41, 25, scale), (cv2.GaussianBlur(m * 255, (41, 41), 0) >= 25))
+            for m in masks
+        )
+        print(f"blur_threshold scale={scale}: max mismatch {worst * 100:.4f}% of pixels")
+        if scale == 1:
+            assert worst == 0, f"blur_threshold scale=1 is not exact: {worst}"
+        else:
+            assert worst <= BLUR_SCALE_MAX_MISMATCH, f"blur_threshold scale={scale}: {worst} > {BLUR_SCALE_MAX_MISMATCH}"
@@ -0,0 +1,256 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Optional
+
+import numpy as np
+from PIL import Image
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+def image_digest(image) -> str:
+    """Content hash of a PIL image or ndarray, independent of where it came from."""
+    h = hashlib.sha256()
+    if isinstance(image, Image.Image):
+        h.update(f"{image.mode}:{image.size}".encode())
+        h.update(image.tobytes())
+    elif isinstance(image, np.ndarray):
+        h.update(f"{image.dtype}:{image.shape}".encode())
+        h.update(np.ascontiguousarray(image).tobytes())
+    elif isinstance(image, (bytes, bytearray)):
+        h.update(image)
+    else:
+        raise TypeError(f"Cannot digest {type(image)}")
+    return h.hexdigest()
+
+
+def model_version(*paths: str) -> str:
+    """Cheap identity of a set of checkpoint files (name, size and mtime)."""
+    parts = []
+    for path in paths:
+        if os.path.exists(path):
+            st = os.stat(path)
+            parts.append(f"{os.path.basename(path)}:{st.st_size}:{int(st.st_mtime)}")
+        else:
+            parts.append(os.path.basename(path))
+    return hashlib.sha256("|".join(parts).encode()).hexdigest()[:16]
+
+
+def _encode(value, arrays: Dict[str, np.ndarray]):
+    """JSON description of `value`, with its arrays moved into `arrays` (see _decode)."""
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return {"type": "json", "value": value}
+    if isinstance(value, Image.Image):
+        name = f"a{len(arrays)}"
+        arrays[name] = np.asarray(value)
+        meta = {"type": "image", "mode": value.mode, "array": name}
+        if value.mode == "P":
+            meta["palette"] = value.getpalette()
+        return meta
+    if isinstance(value, np.ndarray):
+        if value.dtype == object:
+            raise TypeError("object arrays are not stored")
+        name = f"a{len(arrays)}"
+        arrays[name] = value
+        return {"type": "array", "array": name}
+    if type(value).__module__ == "torch" and type(value).__name__ == "Tensor":
+        name = f"a{len(arrays)}"
+        arrays[name] = value.detach().cpu().numpy()
+        return {"type": "tensor", "array": name}
+    if isinstance(value, dict):
+        if not all(isinstance(k, str) for k in value):
+            raise TypeError("dict keys must be strings")
+        return {"type": "dict", "items": {k: _encode(v, arrays) for k, v in value.items()}}
+    if isinstance(value, (list, tuple)):
+        return {"type": type(value).__name__, "items": [_encode(v, arrays) for v in value]}
+    raise TypeError(f"Cannot store {type(value)}")
+
+
+def _decode(meta, arrays):
+    kind = meta["type"]
+    if kind == "json":
+        return meta["value"]
+    if kind == "image":
+        image = Image.fromarray(arrays[meta["array"]], mode=meta["mode"])
+        if "palette" in meta:
+            image.putpalette(meta["palette"])
+        return image
+    if kind == "array":
+        return arrays[meta["array"]]
+    if kind == "tensor":
+        import torch
+
+        return torch.from_numpy(arrays[meta["array"]])
+    if kind == "dict":
+        return {k: _decode(v, arrays) for k, v in meta["items"].items()}
+    items = [_decode(v, arrays) for v in meta["items"]]
+    return tuple(items) if kind == "tuple" else items
+
+
+class PreprocessCache(object):
+    """
+    Content-addressed cache for person-side preprocessing results.
+
+    Entries are keyed by stage name, input image digest, the stage's model version
+    and any parameters that influence the result. Lookups hit an in-memory LRU first
+    and then, if `cache_dir` is set, an on-disk store that survives restarts and can
+    be shared between replicas. Disk entries are .npz files of plain arrays plus a
+    JSON description (images, arrays, tensors, dicts, lists and scalars), loaded with
+    allow_pickle=False, so a shared directory cannot inject code. The disk store is
+    an LRU within `disk_bytes`, ordered by file mtime across restarts.
+
+    Concurrent misses on the same key are computed once: later callers wait for the
+    first one's result.
+    """
+
+    def __init__(
+        self,
+        capacity: int = 64,
+        cache_dir: Optional[str] = None,
+        versions: Optional[Dict[str, str]] = None,
+        disk_bytes: int = 2**30,
+    ):
+        self.capacity = capacity
+        self.cache_dir = cache_dir
+        self.versions = versions or {}
+        self.disk_bytes = disk_bytes if cache_dir is not None else 0
+        self.hits = 0
+        self.misses = 0
+        self._memory: "OrderedDict[str, Any]" = OrderedDict()
+        self._disk: "OrderedDict[str, int]" = OrderedDict()
+        self._disk_used = 0
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._scan()
+
+    def key(self, stage: str, digest: str, **params) -> str:
+        payload = json.dumps(
+            {"stage": stage, "digest": digest, "version": self.versions.get(stage, ""), "params": params},
+            sort_keys=True,
+            default=str,
+        )
+        return f"{stage}-{hashlib.sha256(payload.encode()).hexdigest()}"
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[-2:], key + ".npz")
+
+    def _scan(self) -> None:
+        """Rebuild the disk LRU from the entries left by earlier runs, oldest access first."""
+        entries = []
+        for dirpath, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if filename.endswith(".npz"):
+                    st = os.stat(os.path.join(dirpath, filename))
+                    entries.append((st.st_mtime, filename[:-4], st.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_used += size
+        with self._lock:
+            self._evict_disk()
+
+    def get(self, key: str, default=None):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+        if self.cache_dir is None or not os.path.isfile(self._path(key)):
+            return default
+        try:
+            with np.load(self._path(key), allow_pickle=False) as data:
+                arrays = {name: data[name] for name in data.files}
+            value = _decode(json.loads(arrays.pop("__meta__").tobytes().decode()), arrays)
+            os.utime(self._path(key))
+        except Exception as e:
+            logger.warning(f"Dropping unreadable cache entry {key}: {e}")
+            return default
+        with self._lock:
+            if key in self._disk:
+                self._disk.move_to_end(key)
+        self._remember(key, value)
+        return value
+
+    def put(self, key: str, value: Any) -> None:
+        self._remember(key, value)
+        if not self.disk_bytes:
+            return
+        arrays: Dict[str, np.ndarray] = {}
+        try:
+            meta = _encode(value, arrays)
+        except TypeError as e:
+            logger.debug(f"Keeping {key} in memory only: {e}")
+            return
+        arrays["__meta__"] = np.frombuffer(json.dumps(meta).encode(), dtype=np.uint8)
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write-then-rename so concurrent readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, **arrays)
+        size = os.path.getsize(tmp_path)
+        if size > self.disk_bytes:
+            os.remove(tmp_path)
+            return
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._disk_used -= self._disk.pop(key, 0)
+            self._disk[key] = size
+            self._disk_used += size
+            self._evict_disk()
+
+    def _evict_disk(self) -> None:
+        """Caller holds the lock."""
+        while self._disk_used > self.disk_bytes and self._disk:
+            key, size = self._disk.popitem(last=False)
+            self._disk_used -= size
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def _remember(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._memory[key] = value
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.capacity:
+                self._memory.popitem(last=False)
+
+    def get_or_compute(self, stage: str, image, fn: Callable[[], Any], **params):
+        key = self.key(stage, image_digest(image), **params)
+        value = self.get(key, _MISSING)
+        with self._lock:
+            # get_or_compute runs concurrently from the stage graph's threads
+            if value is not _MISSING:
+                self.hits += 1
+                return value
+            future = self._inflight.get(key)
+            if future is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+                self._inflight[key] = owned = Future()
+        if future is not None:
+            # an identical miss is already computing
+            return future.result()
+        try:
+            value = fn()
+            self.put(key, value)
+        except BaseException as e:
+            with self._lock:
+                self._inflight.pop(key, None)
+            owned.set_exception(e)
+            raise
+        with self._lock:
+            self._inflight.pop(key, None)
+        owned.set_result(value)
+        return value
+
+
+_MISSING = object()
@@ -0,0 +1,89 @@
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+import torch
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+class PromptEmbeddingCache(object):
+    """
+    LRU of CLIP text embeddings keyed by prompt text, so constant prompts are
+    tokenized and encoded once instead of on every pipeline call.
+
+    Embeddings match what diffusers' `encode_prompt` produces for a plain prompt
+    (no LoRA scale, clip_skip or textual inversion), with a negative prompt
+    encoded as its own text. After `offload()` the text encoder lives on the CPU
+    and is detached from the pipeline it came from; a cache miss moves it to
+    `device` for the one encode.
+    """
+
+    def __init__(self, tokenizer, text_encoder, capacity: int = 32, device=None):
+        self.tokenizer = tokenizer
+        self.text_encoder = text_encoder
+        self.capacity = capacity
+        self.device = torch.device(device) if device is not None else next(text_encoder.parameters()).device
+        self.offloaded = False
+        self._pipe = None
+        self._entries: "OrderedDict[str, torch.Tensor]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_pipeline(cls, pipe, capacity: int = 32, device=None):
+        cache = cls(pipe.tokenizer, pipe.text_encoder, capacity=capacity, device=device)
+        cache._pipe = pipe
+        return cache
+
+    @torch.no_grad()
+    def _encode(self, text: str) -> torch.Tensor:
+        input_ids = self.tokenizer(
+            text,
+            padding="max_length",
+            max_length=self.tokenizer.model_max_length,
+            truncation=True,
+            return_tensors="pt",
+        ).input_ids
+        if self.offloaded:
+            self.text_encoder.to(self.device)
+        try:
+            embeds = self.text_encoder(input_ids.to(self.device))[0]
+        finally:
+            if self.offloaded:
+                self.text_encoder.to("cpu")
+        return embeds
+
+    def __call__(self, text: str) -> torch.Tensor:
+        """(1, tokens, dim) embedding of `text`."""
+        with self._lock:
+            if text in self._entries:
+                self._entries.move_to_end(text)
+                return self._entries[text]
+            embeds = self._encode(text)
+            self._entries[text] = embeds
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+        return embeds
+
+    def embeds(self, prompt: str, negative_prompt: Optional[str] = None, batch_size: int = 1) -> Dict[str, torch.Tensor]:
+        """`prompt_embeds` / `negative_prompt_embeds` kwargs for a diffusers pipeline call."""
+        negative = self(negative_prompt or "")
+        return {
+            "prompt_embeds": self(prompt).repeat(batch_size, 1, 1),
+            "negative_prompt_embeds": negative.repeat(batch_size, 1, 1),
+        }
+
+    def warmup(self, *texts: str) -> None:
+        for text in texts:
+            self(text)
+
+    def offload(self) -> None:
+        """Move the text encoder off the accelerator; only cache misses bring it back."""
+        self.text_encoder.to("cpu")
+        self.offloaded = True
+        if self._pipe is not None:
+            # the pipeline only needs it for string prompts, and residency management
+            # would otherwise move it back with the rest of the pipeline
+            self._pipe.text_encoder = None
+        logger.info(f"Text encoder offloaded, {len(self._entries)} prompt(s) cached")
@@ -0,0 +1,233 @@
+import contextlib
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence
+
+import torch
+import torch.nn as nn
+
+from leffa.checkpoint import load_file_mmap
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+TIERS = ("device", "host", "disk")
+
+
+def module_components(obj: Any) -> Dict[str, nn.Module]:
+    """The nn.Modules held by `obj`: the module itself, or a diffusers pipeline's components."""
+    if isinstance(obj, nn.Module):
+        return {"": obj}
+    components = getattr(obj, "components", None)
+    if isinstance(components, dict):
+        return {k: v for k, v in components.items() if isinstance(v, nn.Module)}
+    raise TypeError(f"Cannot manage residency of {type(obj)}")
+
+
+def module_nbytes(obj: Any) -> int:
+    total = 0
+    for module in module_components(obj).values():
+        for t in list(module.parameters()) + list(module.buffers()):
+            total += t.numel() * t.element_size()
+    return total
+
+
+class _Entry(object):
+    def __init__(self, name: str, obj: Any, size: int, tier: str):
+        self.name = name
+        self.obj = obj
+        self.size = size
+        self.tier = tier
+        self.in_use = 0
+        self.last_used = 0.0
+        self.lock = threading.Lock()
+        self.future: Optional[Future] = None
+
+
+class ModelResidencyManager(object):
+    """
+    Keeps the models of a multi-stage pipeline within a device memory budget.
+
+    Every registered model lives in one of three tiers: "device" (the compute
+    device), "host" (pinned CPU memory when CUDA is present) or "disk" (weights
+    written to `offload_dir` on every eviction and memory-mapped back, so they only
+    occupy reclaimable page cache). Models can be patched in place while resident
+    (see leffa.variant), so a file from an earlier eviction or an earlier process
+    is never reused; `offload_dir` is cleared when the manager starts.
+
+    `use(*names)` brings the given models onto the device, evicting the least
+    recently used idle models until the budget fits, and starts prefetching the
+    models of the next stage in `schedule` on a side stream.
+
+    Nothing here is CUDA specific: with `device="cpu"` the tiers and the budget
+    accounting behave the same, which is how the policy is exercised without a GPU.
+    """
+
+    def __init__(
+        self,
+        device_budget: int,
+        device: str = "cuda",
+        host_budget: Optional[int] = None,
+        offload_dir: str = "./offload",
+        schedule: Optional[Sequence[Sequence[str]]] = None,
+    ):
+        self.device = torch.device(device)
+        self.device_budget = device_budget
+        self.host_budget = host_budget
+        self.offload_dir = offload_dir
+        self.schedule: List[List[str]] = [list(group) for group in (schedule or [])]
+        self.pin_memory = self.device.type == "cuda"
+
+        self._entries: Dict[str, _Entry] = {}
+        self._lock = threading.RLock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="residency")
+        self._stream = torch.cuda.Stream() if self.device.type == "cuda" else None
+        self._clear_offload_dir()
+
+    # bookkeeping
+
+    def register(self, name: str, obj: Any, size: Optional[int] = None, tier: Optional[str] = None):
+        """Track `obj`. Its current placement is detected unless `tier` is given."""
+        if tier is None:
+            tier = "device" if self._on_device(obj) else "host"
+        assert tier in TIERS, f"Invalid tier: {tier}"
+        entry = _Entry(name, obj, size if size is not None else module_nbytes(obj), tier)
+        with self._lock:
+            self._entries[name] = entry
+        if tier != "device":
+            self._move(entry, tier)
+        self._make_room(0)
+        return obj
+
+    def tier_of(self, name: str) -> str:
+        return self._entries[name].tier
+
+    def used(self, tier: str = "device") -> int:
+        with self._lock:
+            return sum(e.size for e in self._entries.values() if e.tier == tier)
+
+    def _on_device(self, obj: Any) -> bool:
+        for module in module_components(obj).values():
+            for p in module.parameters():
+                return p.device.type == self.device.type
+        return False
+
+    # placement
+
+    def _move(self, entry: _Entry, tier: str) -> None:
+        if entry.tier == tier:
+            return
+        stream = self._stream if threading.current_thread().name.startswith("residency") else None
+        with torch.cuda.stream(stream) if stream is not None else contextlib.nullcontext():
+            for component, module in module_components(entry.obj).items():
+                if tier == "device":
+                    module.to(self.device, non_blocking=self.pin_memory)
+                elif tier == "host":
+                    module.to("cpu")
+                    if self.pin_memory:
+                        for t in list(module.parameters()) + list(module.buffers()):
+                            t.data = t.data.pin_memory()
+                else:
+                    self._to_disk(entry.name, component, module)
+        if stream is not None:
+            stream.synchronize()
+        logger.info(f"{entry.name}: {entry.tier} -> {tier} ({entry.size / 2**20:.0f} MiB)")
+        entry.tier = tier
+
+    def _clear_offload_dir(self) -> None:
+        if not os.path.isdir(self.offload_dir):
+            return
+        for filename in os.listdir(self.offload_dir):
+            if filename.endswith((".safetensors", ".tmp")):
+                os.remove(os.path.join(self.offload_dir, filename))
+
+    def _to_disk(self, name: str, component: str, module: nn.Module) -> None:
+        import safetensors.torch
+
+        # always write the current weights: the module may have been patched since the last eviction
+        path = os.path.join(self.offload_dir, f"{name}{'.' + component if component else ''}.safetensors")
+        os.makedirs(self.offload_dir, exist_ok=True)
+        state = {k: v.detach().cpu().contiguous() for k, v in module.state_dict().items()}
+        safetensors.torch.save_file(state, path + ".tmp")
+        os.replace(path + ".tmp", path)
+        module.load_state_dict(load_file_mmap(path), assign=True)
+
+    def _make_room(self, needed: int, keep: Sequence[str] = ()) -> None:
+        with self._lock:
+            victims = sorted(
+                (e for e in self._entries.values()
+                 if e.tier == "device" and e.in_use == 0 and e.name not in keep),
+                key=lambda e: e.last_used,
+            )
+            over = self.used("device") + needed - self.device_budget
+            chosen = []
+            for victim in victims:
+                if over <= 0:
+                    break
+                chosen.append(victim)
+                over -= victim.size
+            if over > 0:
+                logger.warning(f"Device budget exceeded by {over / 2**20:.0f} MiB, all resident models are in use")
+        for victim in chosen:
+            with victim.lock:
+                if victim.in_use:
+                    continue
+                host_full = self.host_budget is not None and self.used("host") + victim.size > self.host_budget
+                self._move(victim, "disk" if host_full else "host")
+
+    def _ensure_on_device(self, name: str, keep: Sequence[str]) -> None:
+        entry = self._entries[name]
+        with entry.lock:
+            if entry.tier != "device":
+                self._make_room(entry.size, keep=keep)
+                self._move(entry, "device")
+            entry.last_used = time.monotonic()
+
+    # public API
+
+    def prefetch(self, *names: str) -> None:
+        """Start moving `names` onto the device in the background."""
+        for name in names:
+            entry = self._entries[name]
+            if entry.tier == "device" or (entry.future is not None and not entry.future.done()):
+                continue
+            entry.future = self._executor.submit(self._ensure_on_device, name, names)
+
+    def _next_stage(self, names: Sequence[str]) -> List[str]:
+        for i, group in enumerate(self.schedule):
+            if set(names) <= set(group):
+                return self.schedule[(i + 1) % len(self.schedule)]
+        return []
+
+    @contextlib.contextmanager
+    def use(self, *names: str, prefetch_next: Optional[Sequence[str]] = None):
+        """
+        Make `names` resident for the duration of the block. The models of the next
+        stage (`prefetch_next`, or the successor of `names` in `schedule`) start
+        moving onto the device as soon as these are in place.
+        """
+        entries = [self._entries[name] for name in names]
+        with self._lock:
+            for entry in entries:
+                entry.in_use += 1
+        try:
+            for entry in entries:
+                if entry.future is not None:
+                    entry.future.result()
+                    entry.future = None
+                self._ensure_on_device(entry.name, names)
+            if self._stream is not None:
+                torch.cuda.current_stream().wait_stream(self._stream)
+            if prefetch_next is None:
+                prefetch_next = self._next_stage(names)
+            upcoming = [n for n in prefetch_next if n not in names]
+            if upcoming:
+                self.prefetch(*upcoming)
+            yield tuple(entry.obj for entry in entries)
+        finally:
+            with self._lock:
+                for entry in entries:
+                    entry.in_use -= 1
+                    entry.last_used = time.monotonic()
@@ -0,0 +1,195 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Dict, Optional, Tuple
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+HIT, WAIT, MISS = "hit", "wait", "miss"
+
+
+class ResultCache(object):
+    """
+    Encoded try-on results (JPEG/WebP bytes) keyed by a digest of the normalized
+    request: input image digests, every generation parameter and the model version.
+
+    Two LRU tiers, each with a byte budget: memory, then (if `cache_dir` is set) disk,
+    where the access order survives restarts through file mtimes. Identical requests
+    that arrive while the first is still generating are coalesced onto it: `claim()`
+    makes the first caller the owner, who must `resolve()` or `abandon()` the key;
+    everyone else gets the owner's Future.
+    """
+
+    def __init__(self, memory_bytes: int = 256 * 2**20, disk_bytes: int = 0, cache_dir: Optional[str] = None):
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes if cache_dir is not None else 0
+        self.cache_dir = cache_dir
+        self._memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self._memory_used = 0
+        self._disk: "OrderedDict[str, int]" = OrderedDict()
+        self._disk_used = 0
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self.counters: Dict[str, int] = {
+            "memory_hits": 0, "disk_hits": 0, "coalesced": 0, "misses": 0,
+            "bytes_saved": 0, "evictions": 0,
+        }
+        if self.disk_bytes:
+            self._scan()
+
+    @staticmethod
+    def key(**parts) -> str:
+        payload = json.dumps(parts, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + ".bin")
+
+    def _scan(self) -> None:
+        """Rebuild the disk LRU from the files left by earlier runs, oldest access first."""
+        entries = []
+        for dirpath, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if filename.endswith(".bin"):
+                    st = os.stat(os.path.join(dirpath, filename))
+                    entries.append((st.st_mtime, filename[:-4], st.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_used += size
+        self._evict_disk()
+
+    # lookups
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                self.counters["bytes_saved"] += len(data)
+                return data
+            on_disk = key in self._disk
+        if not on_disk:
+            return None
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+            os.utime(self._path(key))
+        except OSError as e:
+            logger.warning(f"Dropping unreadable result {key}: {e}")
+            with self._lock:
+                self._forget_disk(key)
+            return None
+        with self._lock:
+            if key in self._disk:
+                self._disk.move_to_end(key)
+            self.counters["disk_hits"] += 1
+            self.counters["bytes_saved"] += len(data)
+            self._remember(key, data)
+        return data
+
+    def claim(self, key: str) -> Tuple[str, Any]:
+        """
+        (HIT, bytes) if cached; (WAIT, Future) if an identical request is generating;
+        otherwise (MISS, None) and the caller owns the key until resolve/abandon.
+        """
+        data = self.get(key)
+        if data is not None:
+            return HIT, data
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                self.counters["coalesced"] += 1
+                future.add_done_callback(self._count_coalesced)
+                return WAIT, future
+            self._inflight[key] = Future()
+            self.counters["misses"] += 1
+        return MISS, None
+
+    def _count_coalesced(self, future: Future) -> None:
+        if not future.cancelled() and future.exception() is None:
+            with self._lock:
+                self.counters["bytes_saved"] += len(future.result())
+
+    def resolve(self, key: str, data: bytes) -> None:
+        self.put(key, data)
+        with self._lock:
+            future = self._inflight.pop(key, None)
+        if future is not None:
+            future.set_result(data)
+
+    def abandon(self, key: str, error: BaseException) -> None:
+        """The owner failed: waiters get its error, the next request starts over."""
+        with self._lock:
+            future = self._inflight.pop(key, None)
+        if future is not None:
+            future.set_exception(error)
+
+    # storage
+
+    def put(self, key: str, data: bytes) -> None:
+        with self._lock:
+            self._remember(key, data)
+        if not self.disk_bytes or len(data) > self.disk_bytes:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._forget_disk(key)
+            self._disk[key] = len(data)
+            self._disk_used += len(data)
+            self._evict_disk()
+
+    def _remember(self, key: str, data: bytes) -> None:
+        """Caller holds the lock."""
+        if len(data) > self.memory_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_used -= len(old)
+        self._memory[key] = data
+        self._memory_used += len(data)
+        while self._memory_used > self.memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_used -= len(evicted)
+            self.counters["evictions"] += 1
+
+    def _forget_disk(self, key: str) -> None:
+        """Caller holds the lock."""
+        size = self._disk.pop(key, None)
+        if size is not None:
+            self._disk_used -= size
+
+    def _evict_disk(self) -> None:
+        """Caller holds the lock."""
+        while self._disk_used > self.disk_bytes and self._disk:
+            key, size = self._disk.popitem(last=False)
+            self._disk_used -= size
+            self.counters["evictions"] += 1
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            hits = self.counters["memory_hits"] + self.counters["disk_hits"] + self.counters["coalesced"]
+            lookups = hits + self.counters["misses"]
+            return {
+                **self.counters,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_used,
+                "disk_entries": len(self._disk),
+                "disk_bytes": self._disk_used,
+                "inflight": len(self._inflight),
+            }
@@ -0,0 +1,177 @@
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+class Stage(object):
+    """
+    One node of a StageGraph: `fn(**{name: value for name in inputs})` produces the
+    values named in `outputs` (a single value for one output, a tuple otherwise).
+    `types` optionally maps output names to the type(s) each value must have.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        fn: Callable[..., Any],
+        inputs: Sequence[str] = (),
+        outputs: Optional[Sequence[str]] = None,
+        types: Optional[Dict[str, Any]] = None,
+    ):
+        self.name = name
+        self.fn = fn
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs) if outputs is not None else (name,)
+        self.types = dict(types or {})
+
+    def __repr__(self):
+        return f"Stage({self.name}: {', '.join(self.inputs)} -> {', '.join(self.outputs)})"
+
+    def __call__(self, values: Dict[str, Any]) -> Dict[str, Any]:
+        result = self.fn(**{name: values[name] for name in self.inputs})
+        result = (result,) if len(self.outputs) == 1 else tuple(result)
+        assert len(result) == len(self.outputs), f"{self.name} returned {len(result)} values for {self.outputs}"
+        produced = dict(zip(self.outputs, result))
+        for name, expected in self.types.items():
+            if not isinstance(produced[name], expected):
+                raise TypeError(f"{self.name}: output {name} is {type(produced[name])}, expected {expected}")
+        return produced
+
+
+class StageTrace(object):
+    """Start/end times of the stages of one StageGraph.run, relative to its start."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.records: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, start: float, end: float) -> None:
+        with self._lock:
+            self.records.append({
+                "stage": stage,
+                "start": start - self.start,
+                "end": end - self.start,
+                "seconds": end - start,
+                "thread": threading.current_thread().name,
+            })
+
+    @property
+    def total(self) -> float:
+        return max((r["end"] for r in self.records), default=0.0)
+
+    def __str__(self):
+        lines = [f"{'stage':<20} {'start':>8} {'end':>8} {'seconds':>8}  thread"]
+        for r in sorted(self.records, key=lambda r: r["start"]):
+            lines.append(f"{r['stage']:<20} {r['start']:>8.3f} {r['end']:>8.3f} {r['seconds']:>8.3f}  {r['thread']}")
+        lines.append(f"{'total':<20} {'':>8} {self.total:>8.3f}")
+        return "\n".join(lines)
+
+
+class StageGraph(object):
+    """
+    A DAG of Stages connected by value names.
+
+    `run(outputs, inputs)` evaluates only the stages the requested outputs depend on,
+    submitting every stage whose inputs are available to a thread pool, so
+    independent stages (CPU parsing next to GPU DensePose, say) overlap.
+    """
+
+    def __init__(self, stages: Sequence[Stage] = (), max_workers: int = 4):
+        self.stages: Dict[str, Stage] = {}
+        self.producers: Dict[str, Stage] = {}
+        for stage in stages:
+            self.add(stage)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="stage")
+
+    def add(self, stage: Stage) -> Stage:
+        assert stage.name not in self.stages, f"Duplicate stage: {stage.name}"
+        for name in stage.outputs:
+            assert name not in self.producers, f"{name} is produced by {self.producers[name].name} and {stage.name}"
+            self.producers[name] = stage
+        self.stages[stage.name] = stage
+        return stage
+
+    def stage(self, name: str, inputs: Sequence[str] = (), outputs: Optional[Sequence[str]] = None, types=None):
+        """Decorator form of add()."""
+
+        def register(fn):
+            self.add(Stage(name, fn, inputs, outputs, types))
+            return fn
+
+        return register
+
+    def plan(self, outputs: Sequence[str], available: Sequence[str]) -> List[Stage]:
+        """The stages needed for `outputs` given the `available` values, in dependency order."""
+        order: List[Stage] = []
+        visiting = set()
+        done = set(available)
+
+        def visit(name):
+            if name in done:
+                return
+            stage = self.producers.get(name)
+            if stage is None:
+                raise KeyError(f"No stage produces {name!r} and it was not given as an input")
+            if stage.name in visiting:
+                raise ValueError(f"Cycle through stage {stage.name}")
+            visiting.add(stage.name)
+            for dependency in stage.inputs:
+                visit(dependency)
+            visiting.discard(stage.name)
+            order.append(stage)
+            done.update(stage.outputs)
+
+        for name in outputs:
+            visit(name)
+        return order
+
+    def run(
+        self,
+        outputs: Sequence[str],
+        inputs: Dict[str, Any],
+        on_stage: Optional[Callable[[str, str, int, int], None]] = None,
+    ) -> Tuple[Dict[str, Any], StageTrace]:
+        """
+        :param on_stage: optional progress callback, called from the stage threads as
+            on_stage(stage name, "start" or "end", stages finished, stages planned)
+        :return: the requested values (plus every intermediate value that was
+            computed) and the timing trace of the stages that ran
+        """
+        values = dict(inputs)
+        pending = self.plan(outputs, list(values))
+        total = len(pending)
+        trace = StageTrace()
+        running = {}
+
+        def call(stage):
+            if on_stage is not None:
+                on_stage(stage.name, "start", len(trace.records), total)
+            start = time.perf_counter()
+            try:
+                return stage(values)
+            finally:
+                trace.add(stage.name, start, time.perf_counter())
+                if on_stage is not None:
+                    on_stage(stage.name, "end", len(trace.records), total)
+
+        try:
+            while pending or running:
+                for stage in [s for s in pending if all(name in values for name in s.inputs)]:
+                    pending.remove(stage)
+                    running[self._executor.submit(call, stage)] = stage
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    running.pop(future)
+                    values.update(future.result())
+        except BaseException:
+            for future in running:
+                future.cancel()
+            raise
+        finally:
+            logger.debug(f"stage trace:\n{trace}")
+        return values, trace
@@ -0,0 +1,177 @@
+import argparse
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+def available_cores() -> List[int]:
+    """CPU ids this process may run on (respects taskset/cgroup cpusets)."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+class ThreadBudget(object):
+    """
+    One process-wide split of the CPU between concurrent workers and the stages
+    they run, so ONNX Runtime, PyTorch and OpenCV stop each sizing their pools to
+    the whole machine.
+
+    The available cores are divided evenly between `workers` (concurrent requests).
+    Inside a worker a stage gets the worker's cores shared by the sessions it runs
+    in parallel, unless `stages` overrides it with explicit (intra, inter) counts.
+    With `pin=True` each worker is bound to its own contiguous core set.
+
+    Defaults come from LEFFA_CPU_WORKERS, LEFFA_CPU_THREADS and LEFFA_PIN_CORES.
+    """
+
+    def __init__(
+        self,
+        workers: Optional[int] = None,
+        total_threads: Optional[int] = None,
+        stages: Optional[Dict[str, Tuple[int, int]]] = None,
+        pin: Optional[bool] = None,
+    ):
+        cores = available_cores()
+        if workers is None:
+            workers = int(os.environ.get("LEFFA_CPU_WORKERS", 1))
+        if total_threads is None:
+            total_threads = int(os.environ.get("LEFFA_CPU_THREADS", len(cores)))
+        if pin is None:
+            pin = os.environ.get("LEFFA_PIN_CORES", "0") == "1"
+        self.cores = cores[:total_threads]
+        self.workers = max(1, workers)
+        self.per_worker = max(1, len(self.cores) // self.workers)
+        self.stages = dict(stages or {})
+        self.pin = pin
+
+    def __repr__(self):
+        return (
+            f"ThreadBudget(workers={self.workers}, per_worker={self.per_worker}, "
+            f"stages={self.stages}, pin={self.pin})"
+        )
+
+    def threads(self, stage: str, parallel: int = 1) -> Tuple[int, int]:
+        """(intra, inter) op threads for one of `parallel` concurrent sessions of `stage`."""
+        if stage in self.stages:
+            return self.stages[stage]
+        return max(1, self.per_worker // parallel), 1
+
+    def worker_cores(self, worker: int) -> List[int]:
+        worker = worker % self.workers
+        return self.cores[worker * self.per_worker : (worker + 1) * self.per_worker]
+
+    def ort_session_options(self, stage: str, parallel: int = 1):
+        import onnxruntime as ort
+
+        intra, inter = self.threads(stage, parallel)
+        session_options = ort.SessionOptions()
+        session_options.intra_op_num_threads = intra
+        session_options.inter_op_num_threads = inter
+        session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        session_options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        # ORT's own spinning workers only burn the cores other stages need
+        session_options.add_session_config_entry("session.intra_op.allow_spinning", "0")
+        return session_options
+
+    def apply(self) -> None:
+        """Size the PyTorch and OpenCV pools of this process to one worker's share."""
+        import cv2
+        import torch
+
+        torch.set_num_threads(self.per_worker)
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            # only allowed before the first parallel op; keep whatever is there
+            pass
+        cv2.setNumThreads(self.per_worker)
+        logger.info(f"Applied {self}")
+
+    def pin_worker(self, worker: int) -> None:
+        """Bind the calling thread (and the threads it starts later) to its worker's cores."""
+        if not self.pin or not hasattr(os, "sched_setaffinity"):
+            return
+        # pid 0 is the calling thread on Linux
+        os.sched_setaffinity(0, self.worker_cores(worker))
+
+
+_budget: Optional[ThreadBudget] = None
+_budget_lock = threading.Lock()
+
+
+def get_thread_budget() -> ThreadBudget:
+    global _budget
+    with _budget_lock:
+        if _budget is None:
+            _budget = ThreadBudget()
+        return _budget
+
+
+def set_thread_budget(budget: ThreadBudget) -> ThreadBudget:
+    global _budget
+    with _budget_lock:
+        _budget = budget
+    budget.apply()
+    return budget
+
+
+def _sweep(image_path: str, onnx_path: str, configs: List[Tuple[int, int]], repeat: int) -> None:
+    from concurrent.futures import ThreadPoolExecutor
+
+    from PIL import Image
+
+    from preprocess.humanparsing.parsing_api import ParsingRunner
+
+    image = Image.open(image_path).convert("RGB").resize((768, 1024))
+    print(f"{'workers':>8} {'threads':>8} {'pin':>4} {'p50 ms':>9} {'p95 ms':>9} {'img/s':>8}")
+    for workers, total in configs:
+        for pin in (False, True):
+            budget = ThreadBudget(workers=workers, total_threads=total, pin=pin)
+            budget.apply()
+            runners = [
+                ParsingRunner(
+                    os.path.join(onnx_path, "parsing_atr.onnx"),
+                    os.path.join(onnx_path, "parsing_lip.onnx"),
+                    session_options=budget.ort_session_options("parsing", parallel=2),
+                )
+                for _ in range(workers)
+            ]
+
+            def run(worker):
+                budget.pin_worker(worker)
+                latencies = []
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    runners[worker]([image])
+                    latencies.append(time.perf_counter() - start)
+                return latencies
+
+            runners[0]([image])  # warm-up
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                latencies = sorted(sum(pool.map(run, range(workers)), []))
+            elapsed = time.perf_counter() - start
+            p50 = latencies[len(latencies) // 2] * 1000
+            p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000
+            print(f"{workers:>8} {budget.per_worker:>8} {str(pin):>4} {p50:>9.1f} {p95:>9.1f} "
+                  f"{len(latencies) / elapsed:>8.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Sweep CPU thread budgets (concurrent workers x threads, pinned or not) on ONNX human parsing."
+    )
+    parser.add_argument("image", help="person image to parse")
+    parser.add_argument("--onnx_path", default="./ckpts/humanparsing")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--threads", type=int, nargs="+", default=[len(available_cores())])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    _sweep(args.image, args.onnx_path, [(w, t) for w in args.workers for t in args.threads], args.repeat)
@@ -5,6 +5,8 @@ import numpy as np
 from numpy.linalg import lstsq
 from PIL import Image, ImageDraw
 
+from leffa_utils.morphology import dilate
+
 
 def resize_and_center(image, target_width, target_height):
     img = np.array(image)
@@ -244,29 +246,26 @@ def get_agnostic_mask_hd(model_parse, keypoint, category, size=(384, 512), model
         if knee_right[0] > 1. or knee_right[1] > 1.:
             legs_draw_right.line([hip_right, knee_right], 'white', LEG_LINE_WIDTH, 'curve')
 
-        leg_mask = cv2.dilate(np.logical_or(im_legs_left, im_legs_right).astype('float32'), 
-                              np.ones((5, 5), np.uint16), iterations=4)
+        leg_mask = dilate(np.logical_or(im_legs_left, im_legs_right).astype('float32'), 5, iterations=4)
         parse_mask += leg_mask
 
     parser_mask_fixed = cv2.erode(parser_mask_fixed, np.ones((5, 5), np.uint16), iterations=1)
     parser_mask_fixed = np.logical_or(parser_mask_fixed, parse_head)
     
-    parse_mask = cv2.dilate(parse_mask, np.ones((10, 10), np.uint16), iterations=5)
+    parse_mask = dilate(parse_mask, 10, iterations=5)
     
     # MODIFIED: Include short_sleeve in condition
     if category in ['dresses', 'upper_body', 'short_sleeve']:
         neck_mask = (parse_array == 18).astype(np.float32)
-        neck_mask = cv2.dilate(neck_mask, np.ones((5, 5), np.uint16), iterations=1)
+        neck_mask = dilate(neck_mask, 5, iterations=1)
         neck_mask = np.logical_and(neck_mask, np.logical_not(parse_head))
         parse_mask = np.logical_or(parse_mask, neck_mask)
         
         if category == 'short_sleeve':
-            arm_mask = cv2.dilate(np.logical_or(im_arms_left, im_arms_right).astype('float32'), 
-                                  np.ones((5, 5), np.uint16), iterations=4)
+            arm_mask = dilate(np.logical_or(im_arms_left, im_arms_right).astype('float32'), 5, iterations=4)
             parse_mask += np.logical_or(parse_mask, arm_mask)
         else:
-            arm_mask = cv2.dilate(np.logical_or(im_arms_left, im_arms_right).astype('float32'), 
-                                  np.ones((5, 5), np.uint16), iterations=4)
+            arm_mask = dilate(np.logical_or(im_arms_left, im_arms_right).astype('float32'), 5, iterations=4)
             parse_mask += np.logical_or(parse_mask, arm_mask)
 
     parse_mask = np.logical_and(parser_mask_changeable, np.logical_not(parse_mask))
@@ -389,9 +388,9 @@ def get_agnostic_mask_dc(model_parse, keypoint, category, size=(384, 512)):
 
         # Dilation for arms
         if height > 512:
-            im_arms = cv2.dilate(np.float32(im_arms), np.ones((10, 10), np.uint16), iterations=5)
+            im_arms = dilate(np.float32(im_arms), 10, iterations=5)
         elif height > 256:
-            im_arms = cv2.dilate(np.float32(im_arms), np.ones((5, 5), np.uint16), iterations=5)
+            im_arms = dilate(np.float32(im_arms), 5, iterations=5)
         
         parse_mask += im_arms
         parser_mask_fixed += hands
@@ -414,9 +413,9 @@ def get_agnostic_mask_dc(model_parse, keypoint, category, size=(384, 512)):
 
         # Dilation for legs
         if height > 512:
-            im_legs = cv2.dilate(np.float32(im_legs), np.ones((10, 10), np.uint16), iterations=5)
+            im_legs = dilate(np.float32(im_legs), 10, iterations=5)
         elif height > 256:
-            im_legs = cv2.dilate(np.float32(im_legs), np.ones((5, 5), np.uint16), iterations=5)
+            im_legs = dilate(np.float32(im_legs), 5, iterations=5)
         parse_mask += im_legs
 
 
@@ -5,16 +5,19 @@ import sys
 PROJECT_ROOT = Path(__file__).absolute().parents[0].absolute()
 sys.path.insert(0, str(PROJECT_ROOT))
 import os
+from concurrent.futures import ThreadPoolExecutor
 import torch
 import numpy as np
 import cv2
-import torchvision.transforms as transforms
-from torch.utils.data import DataLoader
-from datasets.simple_extractor_dataset import SimpleFolderDataset
-from utils.transforms import transform_logits
-from tqdm import tqdm
+from utils.transforms import get_affine_transform, transform_logits
 from PIL import Image
 
+# network input size (h, w) of the two SCHP models
+PARSING_INPUT_SIZES = {"atr": (512, 512), "lip": (473, 473)}
+# SCHP normalization, in the BGR channel order the networks take
+PARSING_MEAN = np.array([0.406, 0.456, 0.485], dtype=np.float32)
+PARSING_STD = np.array([0.225, 0.224, 0.229], dtype=np.float32)
+
 
 def get_palette(num_cls):
     """ Returns the color map for visualizing the segmentation mask.
@@ -118,71 +121,164 @@ def refine_hole(parsing_result_filled, parsing_result, arm_mask):
             cv2.drawContours(refine_hole_mask, contours, i, color=255, thickness=-1)
     return refine_hole_mask + arm_mask
 
-def onnx_inference(session, lip_session, input_dir):
-    transform = transforms.Compose([
-        transforms.ToTensor(),
-        transforms.Normalize(mean=[0.406, 0.456, 0.485], std=[0.225, 0.224, 0.229])
-    ])
-    dataset = SimpleFolderDataset(root=input_dir, input_size=[512, 512], transform=transform)
-    dataloader = DataLoader(dataset)
-    with torch.no_grad():
-        for _, batch in enumerate(tqdm(dataloader)):
-            image, meta = batch
-            c = meta['center'].numpy()[0]
-            s = meta['scale'].numpy()[0]
-            w = meta['width'].numpy()[0]
-            h = meta['height'].numpy()[0]
-            output = session.run(None, {"input.1": image.numpy().astype(np.float32)})
-            upsample = torch.nn.Upsample(size=[512, 512], mode='bilinear', align_corners=True)
-            upsample_output = upsample(torch.from_numpy(output[1][0]).unsqueeze(0))
-            upsample_output = upsample_output.squeeze()
-            upsample_output = upsample_output.permute(1, 2, 0)  # CHW -> HWC
-            logits_result = transform_logits(upsample_output.data.cpu().numpy(), c, s, w, h, input_size=[512, 512])
-            parsing_result = np.argmax(logits_result, axis=2)
-            parsing_result = np.pad(parsing_result, pad_width=1, mode='constant', constant_values=0)
-            # try holefilling the clothes part
-            arm_mask = (parsing_result == 14).astype(np.float32) \
-                       + (parsing_result == 15).astype(np.float32)
-            upper_cloth_mask = (parsing_result == 4).astype(np.float32) + arm_mask
-            img = np.where(upper_cloth_mask, 255, 0)
-            dst = hole_fill(img.astype(np.uint8))
-            parsing_result_filled = dst / 255 * 4
-            parsing_result_woarm = np.where(parsing_result_filled == 4, parsing_result_filled, parsing_result)
-            # add back arm and refined hole between arm and cloth
-            refine_hole_mask = refine_hole(parsing_result_filled.astype(np.uint8), parsing_result.astype(np.uint8),
-                                           arm_mask.astype(np.uint8))
-            parsing_result = np.where(refine_hole_mask, parsing_result, parsing_result_woarm)
-            # remove padding
-            parsing_result = parsing_result[1:-1, 1:-1]
-
-        dataset_lip = SimpleFolderDataset(root=input_dir, input_size=[473, 473], transform=transform)
-        dataloader_lip = DataLoader(dataset_lip)
-        with torch.no_grad():
-            for _, batch in enumerate(tqdm(dataloader_lip)):
-                image, meta = batch
-                c = meta['center'].numpy()[0]
-                s = meta['scale'].numpy()[0]
-                w = meta['width'].numpy()[0]
-                h = meta['height'].numpy()[0]
-
-                output_lip = lip_session.run(None, {"input.1": image.numpy().astype(np.float32)})
-                upsample = torch.nn.Upsample(size=[473, 473], mode='bilinear', align_corners=True)
-                upsample_output_lip = upsample(torch.from_numpy(output_lip[1][0]).unsqueeze(0))
-                upsample_output_lip = upsample_output_lip.squeeze()
-                upsample_output_lip = upsample_output_lip.permute(1, 2, 0)  # CHW -> HWC
-                logits_result_lip = transform_logits(upsample_output_lip.data.cpu().numpy(), c, s, w, h,
-                                                     input_size=[473, 473])
-                parsing_result_lip = np.argmax(logits_result_lip, axis=2)
-    # add neck parsing result
+def to_bgr(image):
+    if isinstance(image, str):
+        return cv2.imread(image, cv2.IMREAD_COLOR)
+    if isinstance(image, Image.Image):
+        return np.asarray(image.convert("RGB"))[:, :, ::-1]
+    return image
+
+
+def warp_input(img, input_size):
+    """Person-centred affine crop of a BGR image to `input_size`, normalized CHW float32."""
+    h, w, _ = img.shape
+    aspect_ratio = input_size[1] * 1.0 / input_size[0]
+    x, y, box_w, box_h = 0, 0, w - 1, h - 1
+    center = np.array([x + box_w * 0.5, y + box_h * 0.5], dtype=np.float32)
+    if box_w > aspect_ratio * box_h:
+        box_h = box_w * 1.0 / aspect_ratio
+    elif box_w < aspect_ratio * box_h:
+        box_w = box_h * aspect_ratio
+    scale = np.array([box_w, box_h], dtype=np.float32)
+    trans = get_affine_transform(center, scale, 0, np.asarray(input_size))
+    warped = cv2.warpAffine(
+        img,
+        trans,
+        (int(input_size[1]), int(input_size[0])),
+        flags=cv2.INTER_LINEAR,
+        borderMode=cv2.BORDER_CONSTANT,
+        borderValue=(0, 0, 0))
+    warped = (warped.astype(np.float32) / 255. - PARSING_MEAN) / PARSING_STD
+    meta = {'center': center, 'height': h, 'width': w, 'scale': scale}
+    return warped.transpose(2, 0, 1), meta
+
+
+def _interp_matrix(out_len, in_len):
+    # bilinear weights of nn.Upsample(mode='bilinear', align_corners=True) along one axis
+    matrix = np.zeros((out_len, in_len), dtype=np.float32)
+    if in_len == 1 or out_len == 1:
+        matrix[:, 0] = 1
+        return matrix
+    pos = np.arange(out_len, dtype=np.float64) * (in_len - 1) / (out_len - 1)
+    lo = np.clip(np.floor(pos).astype(np.int64), 0, in_len - 2)
+    frac = (pos - lo).astype(np.float32)
+    matrix[np.arange(out_len), lo] = 1 - frac
+    matrix[np.arange(out_len), lo + 1] += frac
+    return matrix
+
+
+def upsample_logits(logits, size):
+    """Bilinear (align_corners=True) upsample of CHW logits to `size`, returned as HWC."""
+    c, h, w = logits.shape
+    rows = _interp_matrix(size[0], h)
+    cols = _interp_matrix(size[1], w)
+    out = np.matmul(logits, cols.T)                # C x h x W
+    out = np.tensordot(rows, out, axes=(1, 1))     # H x C x W
+    return np.ascontiguousarray(out.transpose(0, 2, 1))
+
+
+def run_session(session, batch):
+    """Fused SCHP logits (N x C x h x w) of a preprocessed batch, through IO binding."""
+    input_meta = session.get_inputs()[0]
+    # output 1 is the fusion result ([[parsing, fusion], [edge]] flattened)
+    output_name = session.get_outputs()[1].name
+    # graphs exported with a fixed batch size are fed in chunks of that size
+    step = input_meta.shape[0] if isinstance(input_meta.shape[0], int) else len(batch)
+    outputs = []
+    for i in range(0, len(batch), step):
+        binding = session.io_binding()
+        binding.bind_cpu_input(input_meta.name, np.ascontiguousarray(batch[i:i + step], dtype=np.float32))
+        binding.bind_output(output_name)
+        session.run_with_iobinding(binding)
+        outputs.append(binding.copy_outputs_to_cpu()[0])
+    return np.concatenate(outputs)
+
+
+def postprocess_logits(logits, meta, input_size):
+    upsampled = upsample_logits(logits, input_size)
+    return transform_logits(upsampled, meta['center'], meta['scale'], meta['width'], meta['height'],
+                            input_size=input_size, labels=True)
+
+
+def onnx_parse(session, image, input_size):
+    """Plain argmax label map of one image (PIL image, BGR array or path) from an SCHP ONNX session."""
+    batch, meta = warp_input(to_bgr(image), input_size)
+    logits = run_session(session, batch[None])[0]
+    return postprocess_logits(logits, meta, input_size)
+
+
+class ParsingRunner(object):
+    """
+    ATR + LIP ONNX sessions behind one call: every image is decoded and warped once
+    per distinct input size, both sessions run concurrently (onnxruntime releases
+    the GIL) on whole batches, and upsampling, warp and argmax stay in numpy.
+    """
+
+    def __init__(self, atr_path, lip_path, session_options=None, providers=('CPUExecutionProvider',),
+                 concurrent=True):
+        import onnxruntime as ort
+
+        self.sessions = {
+            name: ort.InferenceSession(path, sess_options=session_options, providers=list(providers))
+            for name, path in (("atr", atr_path), ("lip", lip_path))
+        }
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="onnx-parsing") if concurrent else None
+
+    def _parse(self, name, inputs):
+        batch, metas = inputs
+        input_size = PARSING_INPUT_SIZES[name]
+        logits = run_session(self.sessions[name], batch)
+        return [postprocess_logits(l, meta, input_size) for l, meta in zip(logits, metas)]
+
+    def __call__(self, images):
+        """(ATR label maps, LIP label maps) of a list of PIL images / BGR arrays / paths."""
+        images = [to_bgr(image) for image in images]
+        inputs = {}
+        for size in set(PARSING_INPUT_SIZES.values()):
+            warped, metas = zip(*[warp_input(image, size) for image in images])
+            inputs[size] = (np.stack(warped), metas)
+        if self.executor is not None:
+            futures = {name: self.executor.submit(self._parse, name, inputs[size])
+                       for name, size in PARSING_INPUT_SIZES.items()}
+            return futures["atr"].result(), futures["lip"].result()
+        return (self._parse("atr", inputs[PARSING_INPUT_SIZES["atr"]]),
+                self._parse("lip", inputs[PARSING_INPUT_SIZES["lip"]]))
+
+
+def refine_atr_parsing(parsing_result):
+    """Fill holes in the upper clothes of an ATR label map, keeping the arms."""
+    parsing_result = np.pad(parsing_result, pad_width=1, mode='constant', constant_values=0)
+    # try holefilling the clothes part
+    arm_mask = (parsing_result == 14).astype(np.float32) \
+               + (parsing_result == 15).astype(np.float32)
+    upper_cloth_mask = (parsing_result == 4).astype(np.float32) + arm_mask
+    img = np.where(upper_cloth_mask, 255, 0)
+    dst = hole_fill(img.astype(np.uint8))
+    parsing_result_filled = dst / 255 * 4
+    parsing_result_woarm = np.where(parsing_result_filled == 4, parsing_result_filled, parsing_result)
+    # add back arm and refined hole between arm and cloth
+    refine_hole_mask = refine_hole(parsing_result_filled.astype(np.uint8), parsing_result.astype(np.uint8),
+                                   arm_mask.astype(np.uint8))
+    parsing_result = np.where(refine_hole_mask, parsing_result, parsing_result_woarm)
+    # remove padding
+    return parsing_result[1:-1, 1:-1]
+
+
+def add_neck(parsing_result, parsing_result_lip):
+    """Label ATR face pixels that LIP does not call face as neck (18)."""
     neck_mask = np.logical_and(np.logical_not((parsing_result_lip == 13).astype(np.float32)),
                                (parsing_result == 11).astype(np.float32))
-    parsing_result = np.where(neck_mask, 18, parsing_result)
+    return np.where(neck_mask, 18, parsing_result)
+
+
+def onnx_inference(session, lip_session, input_dir):
+    parsing_result = refine_atr_parsing(onnx_parse(session, input_dir, [512, 512]))
+    parsing_result_lip = onnx_parse(lip_session, input_dir, [473, 473])
+    # add neck parsing result
+    parsing_result = add_neck(parsing_result, parsing_result_lip)
     palette = get_palette(19)
     output_img = Image.fromarray(np.asarray(parsing_result, dtype=np.uint8))
     output_img.putpalette(palette)
     face_mask = torch.from_numpy((parsing_result == 11).astype(np.float32))
 
     return output_img, face_mask
-
-
-
@@ -1,25 +1,26 @@
 from pathlib import Path
 import os
 import sys
-import onnxruntime as ort
+import numpy as np
+import torch
+from PIL import Image
 PROJECT_ROOT = Path(__file__).absolute().parents[0].absolute()
 sys.path.insert(0, str(PROJECT_ROOT))
-from parsing_api import onnx_inference
+sys.path.insert(1, str(PROJECT_ROOT.parents[1]))
+from leffa_utils.threads import get_thread_budget
+from parsing_api import ParsingRunner, add_neck, get_palette, refine_atr_parsing
 
 
 class Parsing:
     def __init__(self, atr_path, lip_path):
-        session_options = ort.SessionOptions()
-        session_options.inter_op_num_threads = os.cpu_count() // 2
-        session_options.intra_op_num_threads = os.cpu_count() // 2
-        session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
-        session_options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
-        self.session = ort.InferenceSession(atr_path,
-                                            sess_options=session_options, providers=['CPUExecutionProvider'])
-        self.lip_session = ort.InferenceSession(lip_path,
-                                                sess_options=session_options, providers=['CPUExecutionProvider'])
+        # threads come from the process-wide budget instead of cpu_count() // 2 per session
+        session_options = get_thread_budget().ort_session_options("parsing", parallel=2)
+        self.runner = ParsingRunner(atr_path, lip_path, session_options=session_options)
 
     def __call__(self, input_image):
-        parsed_image, face_mask = onnx_inference(
-            self.session, self.lip_session, input_image)
+        atr, lip = self.runner([input_image])
+        parsing_result = add_neck(refine_atr_parsing(atr[0]), lip[0])
+        parsed_image = Image.fromarray(np.asarray(parsing_result, dtype=np.uint8))
+        parsed_image.putpalette(get_palette(19))
+        face_mask = torch.from_numpy((parsing_result == 11).astype(np.float32))
         return parsed_image, face_mask
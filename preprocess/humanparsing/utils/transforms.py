@@ -12,6 +12,10 @@ import numpy as np
 import cv2
 import torch
 
+# one implementation of the logits warp for both parsers (see SCHP/utils/transforms.py)
+from SCHP.utils.transforms import transform_logits, transform_logits_torch  # noqa: F401
+
+
 class BRG2Tensor_transform(object):
     def __call__(self, pic):
         img = torch.from_numpy(pic.transpose((2, 0, 1)))
@@ -78,25 +82,6 @@ def transform_parsing(pred, center, scale, width, height, input_size):
 
     return target_pred
 
-def transform_logits(logits, center, scale, width, height, input_size):
-
-    trans = get_affine_transform(center, scale, 0, input_size, inv=1)
-    channel = logits.shape[2]
-    target_logits = []
-    for i in range(channel):
-        target_logit = cv2.warpAffine(
-            logits[:,:,i],
-            trans,
-            (int(width), int(height)), #(int(width), int(height)),
-            flags=cv2.INTER_LINEAR,
-            borderMode=cv2.BORDER_CONSTANT,
-            borderValue=(0))
-        target_logits.append(target_logit)
-    target_logits = np.stack(target_logits,axis=2)
-
-    return target_logits
-
-
 def get_affine_transform(center,
                          scale,
                          rot,
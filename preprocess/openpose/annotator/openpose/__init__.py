@@ -22,7 +22,7 @@ hand_model_path = "https://huggingface.co/lllyasviel/Annotators/resolve/main/han
 face_model_path = "https://huggingface.co/lllyasviel/Annotators/resolve/main/facenet.pth"
 
 
-def draw_pose(pose, H, W, draw_body=True, draw_hand=True, draw_face=True):
+def draw_pose(pose, H, W, draw_body=True, draw_hand=True, draw_face=True, scale=1):
     bodies = pose['bodies']
     faces = pose['faces']
     hands = pose['hands']
@@ -31,7 +31,7 @@ def draw_pose(pose, H, W, draw_body=True, draw_hand=True, draw_face=True):
     canvas = np.zeros(shape=(H, W, 3), dtype=np.uint8)
 
     if draw_body:
-        canvas = util.draw_bodypose(canvas, candidate, subset)
+        canvas = util.draw_bodypose(canvas, candidate, subset, scale=scale)
 
     if draw_hand:
         canvas = util.draw_handpose(canvas, hands)
@@ -43,7 +43,7 @@ def draw_pose(pose, H, W, draw_body=True, draw_hand=True, draw_face=True):
 
 
 class OpenposeDetector:
-    def __init__(self, body_modelpath):
+    def __init__(self, body_modelpath, low_res=False):
         # body_modelpath = os.path.join(annotator_ckpts_path, "body_pose_model.pth")
         # hand_modelpath = os.path.join(annotator_ckpts_path, "hand_pose_model.pth")
         # face_modelpath = os.path.join(annotator_ckpts_path, "facenet.pth")
@@ -60,7 +60,7 @@ class OpenposeDetector:
         #     from basicsr.utils.download_util import load_file_from_url
         #     load_file_from_url(face_model_path, model_dir=annotator_ckpts_path)
 
-        self.body_estimation = Body(body_modelpath)
+        self.body_estimation = Body(body_modelpath, low_res=low_res)
         # self.hand_estimation = Hand(hand_modelpath)
         # self.face_estimation = Face(face_modelpath)
 
@@ -16,9 +16,224 @@ from torchvision import transforms
 from . import util
 from .model import bodypose_model
 
+# find connection in the specified sequence, center 29 is in the position 15
+limbSeq = [[2, 3], [2, 6], [3, 4], [4, 5], [6, 7], [7, 8], [2, 9], [9, 10], \
+           [10, 11], [2, 12], [12, 13], [13, 14], [2, 1], [1, 15], [15, 17], \
+           [1, 16], [16, 18], [3, 17], [6, 18]]
+# the middle joints heatmap correpondence
+mapIdx = [[31, 32], [39, 40], [33, 34], [35, 36], [41, 42], [43, 44], [19, 20], [21, 22], \
+          [23, 24], [25, 26], [27, 28], [29, 30], [47, 48], [49, 50], [53, 54], [51, 52], \
+          [55, 56], [37, 38], [45, 46]]
+
+
+def find_peaks(heatmap_avg, thre1):
+    """
+    Local maxima of the 18 part heatmaps, all parts at once.
+
+    :return: candidate, (N, 4) array of x, y, score, id ordered by part, then y, then x,
+        and the part of each peak
+    """
+    maps = np.ascontiguousarray(np.transpose(heatmap_avg[:, :, :18], (2, 0, 1)))
+    # sigma 0 on the part axis: each heatmap is filtered on its own
+    blurred = gaussian_filter(maps, sigma=(0, 3, 3))
+    padded = np.pad(blurred, ((0, 0), (1, 1), (1, 1)))
+    peaks_binary = np.logical_and.reduce(
+        (blurred >= padded[:, :-2, 1:-1], blurred >= padded[:, 2:, 1:-1],
+         blurred >= padded[:, 1:-1, :-2], blurred >= padded[:, 1:-1, 2:],
+         blurred > thre1))
+    parts, ys, xs = np.nonzero(peaks_binary)
+    candidate = np.stack([xs, ys, maps[parts, ys, xs], np.arange(len(xs))], axis=1).astype(np.float64)
+    return candidate, parts
+
+
+def bilinear_gather(maps, xs, ys, channels):
+    """maps[ys, xs, channels] at fractional coordinates, clamped to the map."""
+    h, w = maps.shape[:2]
+    xs = np.clip(xs, 0, w - 1)
+    ys = np.clip(ys, 0, h - 1)
+    x0 = np.minimum(np.floor(xs).astype(np.intp), w - 2) if w > 1 else np.zeros(xs.shape, np.intp)
+    y0 = np.minimum(np.floor(ys).astype(np.intp), h - 2) if h > 1 else np.zeros(ys.shape, np.intp)
+    x1 = np.minimum(x0 + 1, w - 1)
+    y1 = np.minimum(y0 + 1, h - 1)
+    fx = (xs - x0)[..., None]
+    fy = (ys - y0)[..., None]
+    top = maps[y0[..., None], x0[..., None], channels] * (1 - fx) + maps[y0[..., None], x1[..., None], channels] * fx
+    bottom = maps[y1[..., None], x0[..., None], channels] * (1 - fx) + maps[y1[..., None], x1[..., None], channels] * fx
+    return top * (1 - fy) + bottom * fy
+
+
+def map_to_image(xs, ys, cell):
+    """
+    Network output coordinates to image pixels. The maps were brought to the image
+    by a stride x resize (centre aligned, as cv2.resize), a crop of the bottom/right
+    padding and a resize to the image size, which together scale by `cell` about
+    the pixel centres.
+    """
+    return (xs + 0.5) * cell[0] - 0.5, (ys + 0.5) * cell[1] - 0.5
+
+
+def image_to_map(xs, ys, cell):
+    return (xs + 0.5) / cell[0] - 0.5, (ys + 0.5) / cell[1] - 0.5
+
+
+def find_peaks_low_res(heatmap, thre1, cell, image_size, sigma=3):
+    """
+    find_peaks on the network output heatmap, already cropped to the cells that
+    cover the image (no stride padding): the same smoothing (sigma given in image
+    pixels), 4-neighbour maxima, then a per-axis quadratic fit through the peak and
+    its neighbours for the sub-cell offset. Coordinates are mapped to image pixels
+    with map_to_image; peaks that land outside the image are dropped, and the
+    sub-pixel overshoot of those on its first/last pixel is clipped. Scores are the
+    raw heatmap value at the peak cell.
+
+    :return: same as find_peaks, with fractional x, y
+    """
+    maps = np.ascontiguousarray(np.transpose(heatmap[:, :, :18], (2, 0, 1)), dtype=np.float64)
+    blurred = gaussian_filter(maps, sigma=(0, sigma / cell[1], sigma / cell[0]))
+    padded = np.pad(blurred, ((0, 0), (1, 1), (1, 1)))
+    up, down = padded[:, :-2, 1:-1], padded[:, 2:, 1:-1]
+    left, right = padded[:, 1:-1, :-2], padded[:, 1:-1, 2:]
+    peaks_binary = np.logical_and.reduce(
+        (blurred >= up, blurred >= down, blurred >= left, blurred >= right, blurred > thre1))
+    parts, ys, xs = np.nonzero(peaks_binary)
+
+    def offset(before, center, after):
+        curvature = before - 2 * center + after
+        with np.errstate(divide="ignore", invalid="ignore"):
+            delta = np.where(curvature < 0, 0.5 * (before - after) / curvature, 0)
+        return np.clip(delta, -0.5, 0.5)
+
+    center = blurred[parts, ys, xs]
+    dx = offset(left[parts, ys, xs], center, right[parts, ys, xs])
+    dy = offset(up[parts, ys, xs], center, down[parts, ys, xs])
+    x, y = map_to_image(xs + dx, ys + dy, cell)
+    inside = (x >= -0.5) & (x < image_size[1] - 0.5) & (y >= -0.5) & (y < image_size[0] - 0.5)
+    parts, xs, ys = parts[inside], xs[inside], ys[inside]
+    x = np.clip(x[inside], 0, image_size[1] - 1)
+    y = np.clip(y[inside], 0, image_size[0] - 1)
+    candidate = np.stack([x, y, maps[parts, ys, xs], np.arange(len(xs))], axis=1).astype(np.float64)
+    return candidate, parts
+
+
+def connect_limb(candidate, parts, paf_avg, k, image_height, thre2, mid_num=10, cell=None):
+    """
+    Score every (A, B) peak pair of limb k along its PAF and greedily keep the best
+    disjoint pairs.
+
+    With `cell` = (cell_x, cell_y), paf_avg is at network resolution and the image
+    coordinates are mapped onto it (see image_to_map) and sampled bilinearly.
+
+    :return: (M, 5) array of id A, id B, score, index in A, index in B; None if A or B has no peak
+    """
+    candA = candidate[parts == limbSeq[k][0] - 1]
+    candB = candidate[parts == limbSeq[k][1] - 1]
+    nA, nB = len(candA), len(candB)
+    if nA == 0 or nB == 0:
+        return None
+
+    vec = candB[None, :, :2] - candA[:, None, :2]
+    norm = np.maximum(np.sqrt(vec[..., 0] * vec[..., 0] + vec[..., 1] * vec[..., 1]), 0.001)
+    vec = vec / norm[..., None]
+
+    # (nA, nB, mid_num, 2) sample points
+    startend = np.linspace(candA[:, None, :2], candB[None, :, :2], num=mid_num, axis=2)
+    channels = np.array([x - 19 for x in mapIdx[k]])
+    if cell is None:
+        # rounded like the per-pair loop did
+        startend = np.round(startend).astype(np.intp)
+        score_mid = paf_avg[startend[..., 1, None], startend[..., 0, None], channels]
+    else:
+        xs, ys = image_to_map(startend[..., 0], startend[..., 1], cell)
+        score_mid = bilinear_gather(paf_avg, xs, ys, channels)
+
+    score_midpts = score_mid[..., 0] * vec[..., 0, None] + score_mid[..., 1] * vec[..., 1, None]
+    score_with_dist_prior = score_midpts.mean(axis=-1) + np.minimum(0.5 * image_height / norm - 1, 0)
+    criterion1 = np.count_nonzero(score_midpts > thre2, axis=-1) > 0.8 * mid_num
+    criterion2 = score_with_dist_prior > 0
+    ii, jj = np.nonzero(criterion1 & criterion2)
+    scores = score_with_dist_prior[ii, jj]
+
+    # stable, so equal scores keep the (i, j) order of the loop
+    order = np.argsort(-scores, kind="stable")
+    connection = np.zeros((min(nA, nB), 5))
+    usedA = np.zeros(nA, dtype=bool)
+    usedB = np.zeros(nB, dtype=bool)
+    count = 0
+    for c in order:
+        i, j = ii[c], jj[c]
+        if usedA[i] or usedB[j]:
+            continue
+        usedA[i] = usedB[j] = True
+        connection[count] = candA[i, 3], candB[j, 3], scores[c], i, j
+        count += 1
+        if count >= len(connection):
+            break
+    return connection[:count]
+
+
+def assemble_subsets(candidate, connection_all):
+    """
+    Group limb connections into people.
+
+    :return: subset, (n, 20) array: 0-17 the index in candidate, 18 the total score, 19 the total parts
+    """
+    capacity = sum(len(connection) for connection in connection_all if connection is not None)
+    subset = -1 * np.ones((capacity, 20))
+    n = 0
+
+    for k, connection in enumerate(connection_all):
+        if connection is None:
+            continue
+        partAs = connection[:, 0]
+        partBs = connection[:, 1]
+        indexA, indexB = np.array(limbSeq[k]) - 1
+
+        for i in range(len(connection)):
+            rows = subset[:n]
+            found = np.nonzero((rows[:, indexA] == partAs[i]) | (rows[:, indexB] == partBs[i]))[0]
+
+            if len(found) == 1:
+                j = found[0]
+                if subset[j, indexB] != partBs[i]:
+                    subset[j, indexB] = partBs[i]
+                    subset[j, -1] += 1
+                    subset[j, -2] += candidate[int(partBs[i]), 2] + connection[i, 2]
+            elif len(found) == 2:  # if found 2 and disjoint, merge them
+                j1, j2 = found
+                membership = ((subset[j1] >= 0).astype(int) + (subset[j2] >= 0).astype(int))[:-2]
+                if len(np.nonzero(membership == 2)[0]) == 0:  # merge
+                    subset[j1, :-2] += (subset[j2, :-2] + 1)
+                    subset[j1, -2:] += subset[j2, -2:]
+                    subset[j1, -2] += connection[i, 2]
+                    # drop row j2 in place, keeping the order of the rows after it
+                    subset[j2:n - 1] = subset[j2 + 1:n]
+                    n -= 1
+                else:  # as like found == 1
+                    subset[j1, indexB] = partBs[i]
+                    subset[j1, -1] += 1
+                    subset[j1, -2] += candidate[int(partBs[i]), 2] + connection[i, 2]
+
+            # if find no partA in the subset, create a new subset
+            elif len(found) == 0 and k < 17:
+                row = subset[n]
+                row[:] = -1
+                row[indexA] = partAs[i]
+                row[indexB] = partBs[i]
+                row[-1] = 2
+                row[-2] = candidate[connection[i, :2].astype(int), 2].sum() + connection[i, 2]
+                n += 1
+
+    # delete some rows of subset which has few parts occur
+    subset = subset[:n]
+    keep = (subset[:, -1] >= 4) & (subset[:, -2] / subset[:, -1] >= 0.4)
+    return subset[keep]
+
 
 class Body(object):
-    def __init__(self, model_path):
+    def __init__(self, model_path, low_res=False):
+        # low_res: find peaks and sample PAFs on the network output instead of on
+        # maps upsampled to the input image
+        self.low_res = low_res
         self.model = bodypose_model()
         if torch.cuda.is_available():
             self.model = self.model.cuda()
@@ -27,190 +242,76 @@ class Body(object):
         self.model.eval()
 
 
+    def infer(self, oriImg, scale, stride=8, padValue=128):
+        """
+        :return: heatmap (h, w, 19) and paf (h, w, 38) at network resolution, and the
+            size of the resized, unpadded input they cover
+        """
+        imageToTest = util.smart_resize_k(oriImg, fx=scale, fy=scale)
+        imageToTest_padded, pad = util.padRightDownCorner(imageToTest, stride, padValue)
+        im = np.transpose(np.float32(imageToTest_padded[:, :, :, np.newaxis]), (3, 2, 0, 1)) / 256 - 0.5
+        im = np.ascontiguousarray(im)
+
+        data = torch.from_numpy(im).float()
+        if torch.cuda.is_available():
+            data = data.cuda()
+        # data = data.permute([2, 0, 1]).unsqueeze(0).float()
+        with torch.no_grad():
+            Mconv7_stage6_L1, Mconv7_stage6_L2 = self.model(data)
+
+        Mconv7_stage6_L1 = Mconv7_stage6_L1.cpu().numpy()
+        Mconv7_stage6_L2 = Mconv7_stage6_L2.cpu().numpy()
+
+        heatmap = np.transpose(np.squeeze(Mconv7_stage6_L2), (1, 2, 0))  # output 1 is heatmaps
+        paf = np.transpose(np.squeeze(Mconv7_stage6_L1), (1, 2, 0))  # output 0 is PAFs
+        return heatmap, paf, imageToTest.shape[:2]
+
     def __call__(self, oriImg):
         # scale_search = [0.5, 1.0, 1.5, 2.0]
         scale_search = [0.5]
         boxsize = 368
         stride = 8
-        padValue = 128
         thre1 = 0.1
         thre2 = 0.05
         multiplier = [x * boxsize / oriImg.shape[0] for x in scale_search]
+
+        if self.low_res:
+            # single scale; nothing is resized, peaks are mapped back analytically
+            heatmap, paf, (h, w) = self.infer(oriImg, multiplier[0], stride)
+            # drop the cells that only cover the stride padding, as the full path crops it
+            rows, cols = -(-h // stride), -(-w // stride)
+            heatmap, paf = heatmap[:rows, :cols], paf[:rows, :cols]
+            cell = (stride * oriImg.shape[1] / w, stride * oriImg.shape[0] / h)
+            candidate, parts = find_peaks_low_res(heatmap, thre1, cell, oriImg.shape[:2])
+            connection_all = [
+                connect_limb(candidate, parts, paf, k, oriImg.shape[0], thre2, cell=cell) for k in range(len(limbSeq))
+            ]
+            return candidate, assemble_subsets(candidate, connection_all)
+
         heatmap_avg = np.zeros((oriImg.shape[0], oriImg.shape[1], 19))
         paf_avg = np.zeros((oriImg.shape[0], oriImg.shape[1], 38))
 
         for m in range(len(multiplier)):
             scale = multiplier[m]
-            imageToTest = util.smart_resize_k(oriImg, fx=scale, fy=scale)
-            imageToTest_padded, pad = util.padRightDownCorner(imageToTest, stride, padValue)
-            im = np.transpose(np.float32(imageToTest_padded[:, :, :, np.newaxis]), (3, 2, 0, 1)) / 256 - 0.5
-            im = np.ascontiguousarray(im)
-
-            data = torch.from_numpy(im).float()
-            if torch.cuda.is_available():
-                data = data.cuda()
-            # data = data.permute([2, 0, 1]).unsqueeze(0).float()
-            with torch.no_grad():
-                Mconv7_stage6_L1, Mconv7_stage6_L2 = self.model(data)
-
-            Mconv7_stage6_L1 = Mconv7_stage6_L1.cpu().numpy()
-            Mconv7_stage6_L2 = Mconv7_stage6_L2.cpu().numpy()
+            heatmap, paf, (h, w) = self.infer(oriImg, scale, stride)
 
             # extract outputs, resize, and remove padding
-            # heatmap = np.transpose(np.squeeze(net.blobs[output_blobs.keys()[1]].data), (1, 2, 0))  # output 1 is heatmaps
-            heatmap = np.transpose(np.squeeze(Mconv7_stage6_L2), (1, 2, 0))  # output 1 is heatmaps
             heatmap = util.smart_resize_k(heatmap, fx=stride, fy=stride)
-            heatmap = heatmap[:imageToTest_padded.shape[0] - pad[2], :imageToTest_padded.shape[1] - pad[3], :]
+            heatmap = heatmap[:h, :w, :]
             heatmap = util.smart_resize(heatmap, (oriImg.shape[0], oriImg.shape[1]))
 
-            # paf = np.transpose(np.squeeze(net.blobs[output_blobs.keys()[0]].data), (1, 2, 0))  # output 0 is PAFs
-            paf = np.transpose(np.squeeze(Mconv7_stage6_L1), (1, 2, 0))  # output 0 is PAFs
             paf = util.smart_resize_k(paf, fx=stride, fy=stride)
-            paf = paf[:imageToTest_padded.shape[0] - pad[2], :imageToTest_padded.shape[1] - pad[3], :]
+            paf = paf[:h, :w, :]
             paf = util.smart_resize(paf, (oriImg.shape[0], oriImg.shape[1]))
 
             heatmap_avg += heatmap_avg + heatmap / len(multiplier)
             paf_avg += + paf / len(multiplier)
 
-        all_peaks = []
-        peak_counter = 0
-
-        for part in range(18):
-            map_ori = heatmap_avg[:, :, part]
-            one_heatmap = gaussian_filter(map_ori, sigma=3)
-
-            map_left = np.zeros(one_heatmap.shape)
-            map_left[1:, :] = one_heatmap[:-1, :]
-            map_right = np.zeros(one_heatmap.shape)
-            map_right[:-1, :] = one_heatmap[1:, :]
-            map_up = np.zeros(one_heatmap.shape)
-            map_up[:, 1:] = one_heatmap[:, :-1]
-            map_down = np.zeros(one_heatmap.shape)
-            map_down[:, :-1] = one_heatmap[:, 1:]
-
-            peaks_binary = np.logical_and.reduce(
-                (one_heatmap >= map_left, one_heatmap >= map_right, one_heatmap >= map_up, one_heatmap >= map_down,
-                 one_heatmap > thre1))
-            peaks = list(zip(np.nonzero(peaks_binary)[1], np.nonzero(peaks_binary)[0]))  # note reverse
-            peaks_with_score = [x + (map_ori[x[1], x[0]],) for x in peaks]
-            peak_id = range(peak_counter, peak_counter + len(peaks))
-            peaks_with_score_and_id = [peaks_with_score[i] + (peak_id[i],) for i in range(len(peak_id))]
-
-            all_peaks.append(peaks_with_score_and_id)
-            peak_counter += len(peaks)
-
-        # find connection in the specified sequence, center 29 is in the position 15
-        limbSeq = [[2, 3], [2, 6], [3, 4], [4, 5], [6, 7], [7, 8], [2, 9], [9, 10], \
-                   [10, 11], [2, 12], [12, 13], [13, 14], [2, 1], [1, 15], [15, 17], \
-                   [1, 16], [16, 18], [3, 17], [6, 18]]
-        # the middle joints heatmap correpondence
-        mapIdx = [[31, 32], [39, 40], [33, 34], [35, 36], [41, 42], [43, 44], [19, 20], [21, 22], \
-                  [23, 24], [25, 26], [27, 28], [29, 30], [47, 48], [49, 50], [53, 54], [51, 52], \
-                  [55, 56], [37, 38], [45, 46]]
-
-        connection_all = []
-        special_k = []
-        mid_num = 10
-
-        for k in range(len(mapIdx)):
-            score_mid = paf_avg[:, :, [x - 19 for x in mapIdx[k]]]
-            candA = all_peaks[limbSeq[k][0] - 1]
-            candB = all_peaks[limbSeq[k][1] - 1]
-            nA = len(candA)
-            nB = len(candB)
-            indexA, indexB = limbSeq[k]
-            if (nA != 0 and nB != 0):
-                connection_candidate = []
-                for i in range(nA):
-                    for j in range(nB):
-                        vec = np.subtract(candB[j][:2], candA[i][:2])
-                        norm = math.sqrt(vec[0] * vec[0] + vec[1] * vec[1])
-                        norm = max(0.001, norm)
-                        vec = np.divide(vec, norm)
-
-                        startend = list(zip(np.linspace(candA[i][0], candB[j][0], num=mid_num), \
-                                            np.linspace(candA[i][1], candB[j][1], num=mid_num)))
-
-                        vec_x = np.array([score_mid[int(round(startend[I][1])), int(round(startend[I][0])), 0] \
-                                          for I in range(len(startend))])
-                        vec_y = np.array([score_mid[int(round(startend[I][1])), int(round(startend[I][0])), 1] \
-                                          for I in range(len(startend))])
-
-                        score_midpts = np.multiply(vec_x, vec[0]) + np.multiply(vec_y, vec[1])
-                        score_with_dist_prior = sum(score_midpts) / len(score_midpts) + min(
-                            0.5 * oriImg.shape[0] / norm - 1, 0)
-                        criterion1 = len(np.nonzero(score_midpts > thre2)[0]) > 0.8 * len(score_midpts)
-                        criterion2 = score_with_dist_prior > 0
-                        if criterion1 and criterion2:
-                            connection_candidate.append(
-                                [i, j, score_with_dist_prior, score_with_dist_prior + candA[i][2] + candB[j][2]])
-
-                connection_candidate = sorted(connection_candidate, key=lambda x: x[2], reverse=True)
-                connection = np.zeros((0, 5))
-                for c in range(len(connection_candidate)):
-                    i, j, s = connection_candidate[c][0:3]
-                    if (i not in connection[:, 3] and j not in connection[:, 4]):
-                        connection = np.vstack([connection, [candA[i][3], candB[j][3], s, i, j]])
-                        if (len(connection) >= min(nA, nB)):
-                            break
-
-                connection_all.append(connection)
-            else:
-                special_k.append(k)
-                connection_all.append([])
-
-        # last number in each row is the total parts number of that person
-        # the second last number in each row is the score of the overall configuration
-        subset = -1 * np.ones((0, 20))
-        candidate = np.array([item for sublist in all_peaks for item in sublist])
-
-        for k in range(len(mapIdx)):
-            if k not in special_k:
-                partAs = connection_all[k][:, 0]
-                partBs = connection_all[k][:, 1]
-                indexA, indexB = np.array(limbSeq[k]) - 1
-
-                for i in range(len(connection_all[k])):  # = 1:size(temp,1)
-                    found = 0
-                    subset_idx = [-1, -1]
-                    for j in range(len(subset)):  # 1:size(subset,1):
-                        if subset[j][indexA] == partAs[i] or subset[j][indexB] == partBs[i]:
-                            subset_idx[found] = j
-                            found += 1
-
-                    if found == 1:
-                        j = subset_idx[0]
-                        if subset[j][indexB] != partBs[i]:
-                            subset[j][indexB] = partBs[i]
-                            subset[j][-1] += 1
-                            subset[j][-2] += candidate[partBs[i].astype(int), 2] + connection_all[k][i][2]
-                    elif found == 2:  # if found 2 and disjoint, merge them
-                        j1, j2 = subset_idx
-                        membership = ((subset[j1] >= 0).astype(int) + (subset[j2] >= 0).astype(int))[:-2]
-                        if len(np.nonzero(membership == 2)[0]) == 0:  # merge
-                            subset[j1][:-2] += (subset[j2][:-2] + 1)
-                            subset[j1][-2:] += subset[j2][-2:]
-                            subset[j1][-2] += connection_all[k][i][2]
-                            subset = np.delete(subset, j2, 0)
-                        else:  # as like found == 1
-                            subset[j1][indexB] = partBs[i]
-                            subset[j1][-1] += 1
-                            subset[j1][-2] += candidate[partBs[i].astype(int), 2] + connection_all[k][i][2]
-
-                    # if find no partA in the subset, create a new subset
-                    elif not found and k < 17:
-                        row = -1 * np.ones(20)
-                        row[indexA] = partAs[i]
-                        row[indexB] = partBs[i]
-                        row[-1] = 2
-                        row[-2] = sum(candidate[connection_all[k][i, :2].astype(int), 2]) + connection_all[k][i][2]
-                        subset = np.vstack([subset, row])
-        # delete some rows of subset which has few parts occur
-        deleteIdx = []
-        for i in range(len(subset)):
-            if subset[i][-1] < 4 or subset[i][-2] / subset[i][-1] < 0.4:
-                deleteIdx.append(i)
-        subset = np.delete(subset, deleteIdx, axis=0)
+        candidate, parts = find_peaks(heatmap_avg, thre1)
+        connection_all = [
+            connect_limb(candidate, parts, paf_avg, k, oriImg.shape[0], thre2) for k in range(len(limbSeq))
+        ]
+        subset = assemble_subsets(candidate, connection_all)
 
         # subset: n*20 array, 0-17 is the index in candidate, 18 is the total score, 19 is the total parts
         # candidate: x, y, score, id
@@ -65,12 +65,13 @@ def transfer(model, model_weights):
     return transfered_model_weights
 
 
-def draw_bodypose(canvas, candidate, subset):
+def draw_bodypose(canvas, candidate, subset, scale=1):
+    # scale: line width and joint radius multiplier, to draw straight at a larger size
     H, W, C = canvas.shape
     candidate = np.array(candidate)
     subset = np.array(subset)
 
-    stickwidth = 4
+    stickwidth = int(round(4 * scale))
 
     limbSeq = [[2, 3], [2, 6], [3, 4], [4, 5], [6, 7], [7, 8], [2, 9], [9, 10], \
                [10, 11], [2, 12], [12, 13], [13, 14], [2, 1], [1, 15], [15, 17], \
@@ -104,7 +105,7 @@ def draw_bodypose(canvas, candidate, subset):
             x, y = candidate[index][0:2]
             x = int(x * W)
             y = int(y * H)
-            cv2.circle(canvas, (int(x), int(y)), 4, colors[i], thickness=-1)
+            cv2.circle(canvas, (int(x), int(y)), int(round(4 * scale)), colors[i], thickness=-1)
 
     return canvas
 
@@ -13,7 +13,7 @@ import json
 
 # from pytorch_lightning import seed_everything
 from preprocess.openpose.annotator.util import resize_image, HWC3
-from preprocess.openpose.annotator.openpose import OpenposeDetector
+from preprocess.openpose.annotator.openpose import OpenposeDetector, draw_pose
 
 from PIL import Image
 import torch
@@ -22,10 +22,10 @@ import pdb
 # os.environ['CUDA_VISIBLE_DEVICES'] = '0,1,2,3'
 
 class OpenPose:
-    def __init__(self, body_model_path):
-        self.preprocessor = OpenposeDetector(body_model_path)
+    def __init__(self, body_model_path, low_res=False):
+        self.preprocessor = OpenposeDetector(body_model_path, low_res=low_res)
 
-    def __call__(self, input_image, resolution=384):
+    def __call__(self, input_image, resolution=384, output_size=(768, 1024)):
         if isinstance(input_image, Image.Image):
             input_image = np.asarray(input_image)
         elif type(input_image) == str:
@@ -37,7 +37,11 @@ class OpenPose:
             input_image = resize_image(input_image, resolution)
             H, W, C = input_image.shape
             assert (H == 512 and W == 384), 'Incorrect input image shape'
-            pose, detected_map = self.preprocessor(input_image, hand_and_face=False)
+            pose = self.preprocessor(input_image, hand_and_face=False, return_is_index=True)
+            # the control image is drawn at output size from the normalized keypoints
+            # (before they are scaled below) instead of upscaling a 384x512 drawing
+            detected_map = draw_pose(pose, output_size[1], output_size[0], draw_hand=False, draw_face=False,
+                                     scale=output_size[1] / H)
 
             candidate = pose['bodies']['candidate']
             subset = pose['bodies']['subset'][0][:18]
@@ -64,7 +68,7 @@ class OpenPose:
             #     json.dump(keypoints, f)
             #
             # # print(candidate)
-            output_image_np = cv2.resize(cv2.cvtColor(detected_map, cv2.COLOR_BGR2RGB), (768, 1024))
+            output_image_np = cv2.cvtColor(detected_map, cv2.COLOR_BGR2RGB)
             output_image = Image.fromarray(output_image_np)
             # cv2.imwrite('/home/aigc/ProjectVTON/OpenPose/keypoints/out_pose.jpg', output_image)
 
@@ -3,10 +3,22 @@ from PIL import Image
 from leffa.transform import LeffaTransform
 from leffa.model import LeffaModel
 from leffa.inference import LeffaInference
+from leffa.checkpoint import resolve_checkpoint
+from leffa.variant import VariantSwitcher
+from leffa_utils.residency import ModelResidencyManager
+from leffa_utils.preprocess_cache import PreprocessCache, image_digest, model_version
 from leffa_utils.garment_agnostic_mask_predictor import AutoMasker
 from leffa_utils.densepose_predictor import DensePosePredictor
 from leffa_utils.utils import resize_and_center, get_agnostic_mask_hd, get_agnostic_mask_dc, preprocess_garment_image
-from preprocess.humanparsing.run_parsing import Parsing
+from leffa_utils.human_parsing import HumanParsing
+from leffa_utils.threads import ThreadBudget, set_thread_budget
+from leffa_utils.morphology import dilate
+from leffa_utils.inpaint_crops import crop_boxes, cut, feather, paste
+from leffa_utils.prompt_cache import PromptEmbeddingCache
+from leffa_utils.stage_graph import StageGraph
+from leffa_utils.image_io import load_image
+from leffa_utils.garment_store import GarmentStore, reference_image, store_version
+from leffa_utils.metrics import observe_stages, observe_trace
 from preprocess.openpose.run_openpose import OpenPose
 import torch
 from diffusers import StableDiffusionControlNetInpaintPipeline, ControlNetModel
@@ -14,45 +26,145 @@ import cv2
 from pytorch_fid import fid_score
 import os
 import shutil
+import contextlib
+import json
+import logging
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+# To generate skin that matches the person, use a more neutral prompt
+# and guide the model to be less creative.
+SKIN_PROMPT = "Wearing Held Tight Short Sleeve Shirt, high quality skin, realistic, high quality"
+SKIN_NEGATIVE_PROMPT = "Blurry, low quality, artifacts, deformed, ugly, , texture, watermark, text, bad anatomy, extra limbs, face, hands, fingers"
+
+GARMENT_MAPPING = {
+    "dresses": "overall",
+    "upper_body": "upper",
+    "lower_body": "lower",
+    "short_sleeve": "short_sleeve",
+    "shorts": "shorts"
+}
+
+
+# leffa_predict's keyword defaults, for predict_batch
+LEFFA_PREDICT_DEFAULTS = dict(
+    control_type="virtual_tryon",
+    ref_acceleration=False,
+    output_path=None,
+    step=20,
+    cross_attention_kwargs={"scale": 3},
+    seed=42,
+    vt_model_type="viton_hd",
+    vt_garment_type="upper_body",
+    vt_repaint=False,
+    src_mask_path=None,
+    progress=None,
+)
+
+
+class TryonProgress(object):
+    """
+    on_stage progress callback for a person-side graph run that counts the batched
+    try-on after it as one more stage; call tryon_done() once that has run.
+    """
+
+    def __init__(self, progress):
+        self.progress = progress
+        self.total = 0
+
+    def __call__(self, stage, event, finished, total):
+        self.total = total
+        self.progress(stage, event, finished, total + 1)
+
+    def tryon_done(self):
+        self.progress("tryon", "end", self.total + 1, self.total + 1)
+
 
 class LeffaVirtualTryOn:
-    def __init__(self, ckpt_dir: str):
-        self.mask_predictor = AutoMasker(
-            densepose_path=f"{ckpt_dir}/densepose",
-            schp_path=f"{ckpt_dir}/schp",
-        )
+    def __init__(
+        self,
+        ckpt_dir: str,
+        memory_budget_gb: float = None,
+        cache_dir: str = None,
+        cache_size: int = 64,
+        cache_disk_gb: float = 1.0,
+        parsing_backend: str = "torch",
+        thread_budget: ThreadBudget = None,
+        openpose_low_res: bool = False,
+        skin_crop_size: int = 512,
+        skin_max_crops: int = 4,
+        skin_min_mask_area: int = 256,
+        skin_feather: int = 8,
+        garment_store_dir: str = None,
+    ):
+        # size ORT/torch/cv2 thread pools before any model is built
+        self.thread_budget = set_thread_budget(thread_budget or ThreadBudget())
+        # skin inpainting: crop size (0 = always full frame), max crops per image,
+        # mask area in pixels below which the stage is skipped, feather radius
+        self.skin_crop_size = skin_crop_size
+        self.skin_max_crops = skin_max_crops
+        self.skin_min_mask_area = skin_min_mask_area
+        self.skin_feather = skin_feather
+
+        # one DensePose model serves both the agnostic mask and the conditioning image
         self.densepose_predictor = DensePosePredictor(
             config_path=f"{ckpt_dir}/densepose/densepose_rcnn_R_50_FPN_s1x.yaml",
             weights_path=f"{ckpt_dir}/densepose/model_final_162be9.pkl",
         )
-        self.parsing = Parsing(
-            atr_path=f"{ckpt_dir}/humanparsing/parsing_atr.onnx",
-            lip_path=f"{ckpt_dir}/humanparsing/parsing_lip.onnx",
+        # likewise one ATR/LIP parser for the agnostic mask and the limb masks
+        self.parsing = HumanParsing(
+            backend=parsing_backend,
+            schp_path=f"{ckpt_dir}/schp",
+            onnx_path=f"{ckpt_dir}/humanparsing",
+        )
+        self.parsing_models = tuple(self.parsing.torch_models())
+        self.mask_predictor = AutoMasker(
+            densepose_path=f"{ckpt_dir}/densepose",
+            schp_path=f"{ckpt_dir}/schp",
+            densepose_processor=self.densepose_predictor,
+            parsing_processor=self.parsing,
         )
         self.openpose = OpenPose(
             body_model_path=f"{ckpt_dir}/openpose/body_pose_model.pth",
+            low_res=openpose_low_res,
         )
 
+        # with a memory budget the large models are built on the host and the residency
+        # manager places them on the device as the stages need them, so loading never
+        # exceeds the budget either
+        load_device = "cpu" if memory_budget_gb is not None else None
+        compute_device = "cuda" if torch.cuda.is_available() else "cpu"
+
         vt_model_hd = LeffaModel(
             pretrained_model_name_or_path=f"{ckpt_dir}/stable-diffusion-inpainting",
-            pretrained_model=f"{ckpt_dir}/virtual_tryon.pth",
+            pretrained_model=resolve_checkpoint(f"{ckpt_dir}/virtual_tryon.pth"),
             dtype="float16",
         )
-        self.vt_inference_hd = LeffaInference(model=vt_model_hd)
+        self.vt_inference_hd = LeffaInference(model=vt_model_hd, load_device=load_device)
 
         self.skin_model = LeffaModel(
             pretrained_model_name_or_path=f"{ckpt_dir}/stable-diffusion-inpainting",
-            pretrained_model=f"{ckpt_dir}/virtual_tryon.pth",
+            pretrained_model=resolve_checkpoint(f"{ckpt_dir}/virtual_tryon.pth"),
             dtype="float16",
         )
-        self.skin_inference = LeffaInference(model=self.skin_model)
-
-        vt_model_dc = LeffaModel(
-            pretrained_model_name_or_path=f"{ckpt_dir}/stable-diffusion-inpainting",
-            pretrained_model=f"{ckpt_dir}/virtual_tryon_dc.pth",
-            dtype="float16",
-        )
-        self.vt_inference_dc = LeffaInference(model=vt_model_hd)
+        self.skin_inference = LeffaInference(model=self.skin_model, load_device=load_device)
+
+        # DressCode is served from the VITON-HD weights plus a delta when one has been
+        # built with `python -m leffa.variant`, instead of a second resident model.
+        dc_delta_path = f"{ckpt_dir}/virtual_tryon_dc.delta.safetensors"
+        if os.path.isfile(dc_delta_path):
+            self.vt_variants = VariantSwitcher(
+                vt_model_hd, base_name="viton_hd", deltas={"dress_code": dc_delta_path}
+            )
+            self.vt_inference_dc = self.vt_inference_hd
+        else:
+            self.vt_variants = None
+            vt_model_dc = LeffaModel(
+                pretrained_model_name_or_path=f"{ckpt_dir}/stable-diffusion-inpainting",
+                pretrained_model=resolve_checkpoint(f"{ckpt_dir}/virtual_tryon_dc.pth"),
+                dtype="float16",
+            )
+            self.vt_inference_dc = LeffaInference(model=vt_model_dc, load_device=load_device)
 
         # majicmix realistic skin model - diffusers pipeline
         controlnet = ControlNetModel.from_pretrained(
@@ -63,65 +175,390 @@ class LeffaVirtualTryOn:
             controlnet=controlnet,
             torch_dtype=torch.float16,
             safety_checker=None
-        ).to("cuda")
+        ).to(load_device or "cuda")
+        # the skin prompts never change: encode them once, then keep the text encoder off the GPU
+        # (offloaded first, so the encode runs on the compute device wherever the pipeline was built)
+        self.skin_prompts = PromptEmbeddingCache.from_pipeline(self.skin_pipe, device=compute_device)
+        self.skin_prompts.offload()
+        self.skin_prompts.warmup(SKIN_PROMPT, SKIN_NEGATIVE_PROMPT)
+
+        # Person-side results are keyed by image content, so repeat try-ons of the
+        # same person only pay for the final diffusion.
+        self.preprocess_cache = PreprocessCache(
+            capacity=cache_size,
+            cache_dir=cache_dir,
+            disk_bytes=int(cache_disk_gb * 2**30),
+            versions={
+                "parsing": parsing_backend + ":" + (
+                    model_version(f"{ckpt_dir}/schp") if parsing_backend == "torch" else model_version(
+                        f"{ckpt_dir}/humanparsing/parsing_atr.onnx", f"{ckpt_dir}/humanparsing/parsing_lip.onnx"
+                    )
+                ),
+                "openpose": ("lowres:" if openpose_low_res else "") + model_version(
+                    f"{ckpt_dir}/openpose/body_pose_model.pth"
+                ),
+                "skin": model_version(f"{ckpt_dir}/majicmixRealistic_v7.safetensors"),
+                "densepose": model_version(f"{ckpt_dir}/densepose/model_final_162be9.pkl"),
+            },
+        )
+
+        # identity of every checkpoint that shapes a try-on result (result cache keys)
+        self.model_versions = {
+            **self.preprocess_cache.versions,
+            "tryon": model_version(
+                resolve_checkpoint(f"{ckpt_dir}/virtual_tryon.pth"),
+                resolve_checkpoint(f"{ckpt_dir}/virtual_tryon_dc.pth"),
+                dc_delta_path,
+            ),
+        }
+
+        # With a memory budget, models are moved between device, pinned host memory
+        # and disk as the stages of leffa_predict need them.
+        self.residency = None
+        if memory_budget_gb is not None:
+            self.residency = ModelResidencyManager(
+                device_budget=int(memory_budget_gb * 2**30),
+                device="cuda" if torch.cuda.is_available() else "cpu",
+                offload_dir=f"{ckpt_dir}/offload",
+            )
+            for name, model in self.managed_models().items():
+                self.residency.register(name, model)
+
+        # garment latents / reference features precomputed with `python -m leffa_utils.garment_store`,
+        # opened read-only; only entries built from the loaded weights are found
+        self.garment_stores = {}
+        if garment_store_dir is not None:
+            for vt_model_type, checkpoint in (("viton_hd", "virtual_tryon.pth"), ("dress_code", "virtual_tryon_dc.pth")):
+                store = GarmentStore.open(
+                    garment_store_dir, store_version(vt_model_type, resolve_checkpoint(f"{ckpt_dir}/{checkpoint}"))
+                )
+                if store is not None:
+                    self.garment_stores[vt_model_type] = store
+
+        self.graph = self.build_graph()
+        self.last_trace = None
+        self.last_pipeline_timings = {}
+
+    def build_graph(self):
+        """
+        The try-on flow of leffa_predict as a stage graph: only the stages the
+        requested outputs need are run, independent ones concurrently (parsing next
+        to OpenPose, DensePose next to parsing of the skin-repaired image).
+        """
+        graph = StageGraph(max_workers=4)
+
+        @graph.stage("person_parsing", inputs=["src_image"], outputs=["parsing_map"], types={"parsing_map": np.ndarray})
+        def person_parsing(src_image):
+            return np.array(self.human_parsing(src_image.resize((768, 1024)), prefetch_next=["openpose"])["parsing"])
+
+        @graph.stage("inpaint_mask", inputs=["src_image", "parsing_map", "vt_garment_type"], outputs=["inpaint_mask"],
+                     types={"inpaint_mask": Image.Image})
+        def inpaint_mask(src_image, parsing_map, vt_garment_type):
+            return self.inpaint_mask(src_image, parsing_map, vt_garment_type)[0]
+
+        @graph.stage("pose", inputs=["src_image"], outputs=["pose_image"], types={"pose_image": Image.Image})
+        def pose(src_image):
+            return self.pose_control(src_image)
+
+        @graph.stage("skin", inputs=["src_image", "inpaint_mask", "pose_image", "step", "seed"],
+                     outputs=["agnostic_image"], types={"agnostic_image": Image.Image})
+        def skin(src_image, inpaint_mask, pose_image, step, seed):
+            # an empty overlap mask is below skin_min_mask_area and comes back unchanged
+            return self.skin_image(src_image, inpaint_mask, step=step, seed=seed, control_image=pose_image)
+
+        @graph.stage("agnostic_densepose", inputs=["agnostic_image", "vt_model_type"], outputs=["agnostic_analysis"])
+        def agnostic_densepose(agnostic_image, vt_model_type):
+            return self.person_analysis(agnostic_image, prefetch_next=[self.vt_model_name(vt_model_type)])
+
+        @graph.stage("agnostic_parsing", inputs=["agnostic_image"], outputs=["agnostic_parsing"])
+        def agnostic_parsing(agnostic_image):
+            return self.human_parsing(agnostic_image)
+
+        # pose_transfer repaints the whole frame: leffa_predict passes its mask in as an input,
+        # so neither this stage nor the agnostic parsing it needs is planned for it
+        @graph.stage("tryon_mask", inputs=["agnostic_image", "agnostic_analysis", "agnostic_parsing", "vt_garment_type"],
+                     outputs=["mask"], types={"mask": Image.Image})
+        def tryon_mask(agnostic_image, agnostic_analysis, agnostic_parsing, vt_garment_type):
+            garment_type_hd = GARMENT_MAPPING.get(vt_garment_type, "upper")
+            return self.agnostic_mask(
+                agnostic_image, garment_type_hd, analysis=agnostic_analysis, parsing=agnostic_parsing
+            )
+
+        @graph.stage("densepose", inputs=["agnostic_image", "agnostic_analysis", "vt_model_type"], outputs=["densepose"],
+                     types={"densepose": Image.Image})
+        def densepose(agnostic_image, agnostic_analysis, vt_model_type):
+            seg = self.densepose_condition(np.array(agnostic_image), vt_model_type, analysis=agnostic_analysis)
+            return Image.fromarray(seg)
+
+        @graph.stage("tryon", inputs=["agnostic_image", "ref_image", "mask", "densepose", "vt_model_type", "step", "seed",
+                                      "ref_acceleration", "cross_attention_kwargs", "vt_repaint"],
+                     outputs=["generated_image"], types={"generated_image": Image.Image})
+        def tryon(agnostic_image, ref_image, mask, densepose, vt_model_type, step, seed, ref_acceleration,
+                  cross_attention_kwargs, vt_repaint):
+            return self.tryon_batch(
+                [agnostic_image], [ref_image], [mask], [densepose], vt_model_type, step=step, seed=seed,
+                ref_acceleration=ref_acceleration, cross_attention_kwargs=cross_attention_kwargs, vt_repaint=vt_repaint,
+            )[0]
+
+        return graph
+
+    def tryon_batch(
+        self,
+        agnostic_images,
+        ref_images,
+        masks,
+        denseposes,
+        vt_model_type,
+        step=20,
+        seed=42,
+        ref_acceleration=False,
+        cross_attention_kwargs={"scale": 3},
+        vt_repaint=False,
+    ):
+        """Try-on diffusion for lists of (person, garment, mask, densepose) in one denoising run."""
+        transform = LeffaTransform()
+        data = {
+            "src_image": list(agnostic_images),
+            "ref_image": list(ref_images),
+            "mask": list(masks),
+            "densepose": list(denseposes),
+        }
+        data = transform(data)
+
+        inference = self.vt_inference_hd if vt_model_type == "viton_hd" else self.vt_inference_dc
+
+        # skip the garment VAE encode (and reference UNet where stored) for precomputed garments
+        stored = {}
+        store = self.garment_stores.get(vt_model_type)
+        hit = store.batch(ref_images) if store is not None else None
+        if hit is not None:
+            stored = dict(ref_latents=hit[0], ref_features=hit[1])
+
+        garment_prompt = "High quality skin, lifelike details, realistic textures, full masking range"
+        negative_prompt = "distorted, blurry, low quality, artifact, background, clothes"
+
+        with self.use_models(self.vt_model_name(vt_model_type), prefetch_next=["densepose"]), \
+                self.variant_session(vt_model_type):
+            result = inference(
+                data,
+                ref_acceleration=ref_acceleration,
+                num_inference_steps=step,
+                cross_attention_kwargs=cross_attention_kwargs,
+                seed=seed,
+                repaint=vt_repaint,
+                prompt=garment_prompt,
+                negative_prompt=negative_prompt,
+                **stored,
+            )
+        self.last_pipeline_timings = dict(inference.pipe.last_timings)
+        return result["generated_image"]
+
+    def managed_models(self):
+        models = {
+            **self.parsing.torch_models(),
+            "openpose": self.openpose.preprocessor.body_estimation.model,
+            "skin_pipe": self.skin_pipe,
+            "skin_model": self.skin_model,
+            "densepose": self.densepose_predictor.predictor.model,
+            "viton_hd": self.vt_inference_hd.model,
+        }
+        if self.vt_inference_dc is not self.vt_inference_hd:
+            models["dress_code"] = self.vt_inference_dc.model
+        return models
+
+    def use_models(self, *names, prefetch_next=None):
+        if self.residency is None:
+            return contextlib.nullcontext()
+        return self.residency.use(*names, prefetch_next=prefetch_next)
+
+    def vt_model_name(self, vt_model_type):
+        return "viton_hd" if vt_model_type == "viton_hd" or self.vt_variants is not None else "dress_code"
+
+    def cached(self, stage, image, fn, **params):
+        return self.preprocess_cache.get_or_compute(stage, image, fn, **params)
+
+    def person_analysis(self, image, prefetch_next=None):
+        """DensePose I-map, seg and IUV of `image` from a single, cached forward pass."""
+        image_np = np.asarray(image)
+
+        def compute():
+            with self.use_models("densepose", prefetch_next=prefetch_next):
+                return self.densepose_predictor.analyze(image_np)
+
+        return self.cached("densepose", image_np, compute)
+
+    def agnostic_mask(self, image, mask_type, prefetch_next=None, analysis=None, parsing=None):
+        """AutoMasker mask for `image`, built from the cached (or given) DensePose and parsing results."""
+        if analysis is None:
+            analysis = self.person_analysis(image, prefetch_next=self.parsing_models)
+        if parsing is None:
+            parsing = self.human_parsing(image, prefetch_next=prefetch_next)
+        i_map = Image.fromarray(analysis["i_map"])
+        maps = self.mask_predictor.preprocess_image(image, densepose=i_map, parsing=parsing)
+        return self.mask_predictor.cloth_agnostic_mask(
+            maps["densepose"], maps["schp_lip"], maps["schp_atr"], part=mask_type
+        )
+
+    def human_parsing(self, image, prefetch_next=None):
+        def compute():
+            with self.use_models(*self.parsing_models, prefetch_next=prefetch_next):
+                return self.parsing(image)
+
+        return self.cached("parsing", image, compute)
+
+    def densepose_condition(self, image_np, vt_model_type, analysis=None):
+        if analysis is None:
+            analysis = self.person_analysis(image_np, prefetch_next=[self.vt_model_name(vt_model_type)])
+        if vt_model_type == "viton_hd":
+            seg = analysis["seg"][:, :, ::-1]
+        else:
+            if analysis["iuv"] is None:
+                raise ValueError("DensePose found no person in the image")
+            seg = np.concatenate([analysis["iuv"][:, :, :1]] * 3, axis=-1)
+        return np.ascontiguousarray(seg)
+
+    @staticmethod
+    def mask_inputs(src_image, control_type):
+        """
+        Graph inputs that fix the try-on mask up front: pose_transfer repaints the whole
+        (768x1024, like the skin-repaired image) frame, so its mask needs no stage at all.
+        """
+        if control_type != "pose_transfer":
+            return {}
+        return {"mask": Image.fromarray(np.full((src_image.height, src_image.width, 3), 255, dtype=np.uint8))}
+
+    def inpaint_mask(self, src_image, parsing_map, vt_garment_type):
+        """
+        Where the garment overlaps the arms/legs, plus a 10px margin: the area the
+        skin stage repaints. Also returns whether there is any overlap at all.
+        """
+        limb_mask_raw = np.isin(parsing_map, [4, 5]).astype(np.uint8)  # 팔(4), 다리(5)
+        limb_mask_img = Image.fromarray(limb_mask_raw * 255).resize(src_image.size, Image.NEAREST)
+        limb_mask_np = np.array(limb_mask_img.convert("L")) > 128
+
+        # vt_garment_type에 따라 마스킹 영역 결정
+        if vt_garment_type == "upper_body":
+            garment_mask_np = np.isin(parsing_map, [4]).astype(np.uint8)  # 상의
+            hands_mask_np = np.isin(parsing_map, [14, 15]).astype(np.uint8)  # 손
+            garment_mask_np |= hands_mask_np
+        elif vt_garment_type == "lower_body":
+            garment_mask_np = np.isin(parsing_map, [5]).astype(np.uint8)  # 하의
+        else:
+            garment_mask_np = np.isin(parsing_map, [4, 5]).astype(np.uint8)  # 기본적으로 상의와 하의 포함
+
+        # 인페인팅할 마스크 계산 (의상과 팔/다리가 겹치는 영역)
+        inpaint_mask_np = garment_mask_np & limb_mask_np
+
+        # 마스크에 10px 마진 추가 (팽창)
+        inpaint_mask_np_dilated = dilate(inpaint_mask_np.astype(np.uint8), 10)
+
+        return Image.fromarray(inpaint_mask_np_dilated * 255), bool(np.any(inpaint_mask_np))
+
+    def pose_control(self, src_image):
+        """OpenPose control image of `src_image` (cached)."""
+        def run_openpose():
+            with self.use_models("openpose", prefetch_next=["skin_pipe"]):
+                return self.openpose(src_image)
+
+        openpose_result = self.cached("openpose", src_image, run_openpose)
+
+        # dict 형태일 경우 image 키 추출
+        if isinstance(openpose_result, dict):
+            openpose_image = openpose_result.get("image")
+        else:
+            openpose_image = openpose_result
+
+        # 검증: 이미지가 정상적으로 반환되었는지 확인
+        if not isinstance(openpose_image, Image.Image):
+            raise TypeError(f"OpenPose에서 반환된 control image가 유효하지 않습니다: {type(openpose_image)}")
+        return openpose_image
+
+    def skin_image(self, src_image, inpaint_mask_img, step, seed, control_image=None):
+        return self.cached(
+            "skin",
+            src_image,
+            lambda: self.generate_skin(
+                src_image=src_image, inpaint_mask_img=inpaint_mask_img, step=step, seed=seed,
+                control_image=control_image,
+            ),
+            mask=image_digest(inpaint_mask_img),
+            step=step,
+            seed=seed,
+            crop=(self.skin_crop_size, self.skin_max_crops, self.skin_min_mask_area, self.skin_feather),
+        )
+
+    def variant_session(self, vt_model_type: str):
+        """Context in which the try-on model carries the weights of `vt_model_type`."""
+        if self.vt_variants is None:
+            return contextlib.nullcontext()
+        return self.vt_variants.session(vt_model_type)
 
     def generate_skin(
         self,
         src_image: Image.Image,
         inpaint_mask_img: Image.Image,
         step: int = 20,
-        seed: int = 42
+        seed: int = 42,
+        control_image: Image.Image = None,
     ) -> Image.Image:
         """
         주어진 마스크 영역에 사실적인 피부를 인페인팅합니다.
         Inpaints realistic skin in the given masked area using a dedicated skin model.
+        `control_image` is the OpenPose control image, computed here if not given.
         """
-        # To generate skin that matches the person, use a more neutral prompt
-        # and guide the model to be less creative.
-        skin_prompt = "Wearing Held Tight Short Sleeve Shirt, high quality skin, realistic, high quality"
-        negative_prompt = "Blurry, low quality, artifacts, deformed, ugly, , texture, watermark, text, bad anatomy, extra limbs, face, hands, fingers"
+        src_np = np.array(src_image)
+        mask_np = np.array(inpaint_mask_img.convert("L")) > 127
+        if np.count_nonzero(mask_np) < self.skin_min_mask_area:
+            # too little to repaint to be worth OpenPose and a diffusion run
+            return src_image
 
         # Generate OpenPose control image
-        openpose_result = self.openpose(src_image)
-        
-        # dict 형태일 경우 image 키 추출
-        if isinstance(openpose_result, dict):
-            openpose_image = openpose_result.get("image")
+        openpose_image = control_image if control_image is not None else self.pose_control(src_image)
+        if openpose_image.size != src_image.size:
+            openpose_image = openpose_image.resize(src_image.size)
+
+        # The overlap mask is usually a few small arm/leg regions: inpaint padded
+        # crops around them at the SD resolution as one batch instead of the full frame.
+        boxes = crop_boxes(mask_np, max_boxes=self.skin_max_crops) if self.skin_crop_size else None
+        if boxes is not None and not boxes:
+            # empty mask (skin_min_mask_area=0): nothing to inpaint
+            return src_image
+        if boxes is not None and len(boxes) * self.skin_crop_size ** 2 >= src_image.width * src_image.height:
+            boxes = None
+        if boxes is None:
+            boxes = [(0, 0, src_image.width, src_image.height)]
+            images, masks, controls = [src_image], [inpaint_mask_img], [openpose_image]
+            width, height = src_image.width, src_image.height
         else:
-            openpose_image = openpose_result
-        
-        # 검증: 이미지가 정상적으로 반환되었는지 확인
-        if not isinstance(openpose_image, Image.Image):
-            raise TypeError(f"OpenPose에서 반환된 control image가 유효하지 않습니다: {type(openpose_image)}")
-        
-        # 이후 파이프라인 호출
+            size = self.skin_crop_size
+            mask_img = Image.fromarray(mask_np.astype(np.uint8) * 255)
+            images = [cut(src_image, box, size) for box in boxes]
+            masks = [mask_img.crop(box).resize((size, size), Image.NEAREST) for box in boxes]
+            controls = [cut(openpose_image, box, size) for box in boxes]
+            width = height = size
 
         generator = torch.Generator(device="cuda").manual_seed(seed)
 
         # Use the dedicated skin inpainting pipeline
-        generated_image = self.skin_pipe(
-            prompt=skin_prompt,
-            negative_prompt=negative_prompt,
-            image=src_image,
-            mask_image=inpaint_mask_img,
-            control_image=openpose_image,
-            width=src_image.width,
-            height=src_image.height,
-            num_inference_steps=step,
-            generator=generator,
-            guidance_scale=7.0  # Lower guidance to better match image context
-        ).images[0]
+        with self.use_models("skin_pipe", prefetch_next=["densepose"]):
+            generated_images = self.skin_pipe(
+                **self.skin_prompts.embeds(SKIN_PROMPT, SKIN_NEGATIVE_PROMPT, batch_size=len(images)),
+                image=images,
+                mask_image=masks,
+                control_image=controls,
+                width=width,
+                height=height,
+                num_inference_steps=step,
+                generator=generator,
+                guidance_scale=7.0  # Lower guidance to better match image context
+            ).images
 
         # Explicitly composite the generated skin onto the original image
-        # to ensure only the masked area is affected.
-        src_np = np.array(src_image)
-        mask_np = np.array(inpaint_mask_img.convert("L")) / 255.0
-        mask_np = np.expand_dims(mask_np, axis=-1)
-        generated_np = np.array(generated_image)
-
-        # Combine the original image (outside the mask) with the generated skin (inside the mask)
-        final_np = src_np * (1 - mask_np) + generated_np * mask_np
-        final_image = Image.fromarray(final_np.astype(np.uint8))
+        # to ensure only the masked area is affected, feathered inside its edge.
+        alpha = feather(mask_np, self.skin_feather)
+        for box, generated_image in zip(boxes, generated_images):
+            paste(src_np, generated_image, box, alpha)
+        final_image = Image.fromarray(src_np)
 
         return final_image
 
@@ -145,56 +582,21 @@ class LeffaVirtualTryOn:
         Removes clothing from arms and legs in an image and inpaints with realistic skin.
         """
         # 1. 이미지 로드 및 준비
-        src_image = Image.open(src_image_path).convert("RGB")
+        src_image = load_image(src_image_path)
         src_image = resize_and_center(src_image, 768, 1024)
 
-        # 2. 원본 이미지에서 의상 마스크 추출
-        garment_mask_img = self.mask_predictor(src_image, "overall")["mask"]
-        garment_mask_np = np.array(garment_mask_img.convert("L")) > 128
-
-        
-        # 3. 휴먼 파싱을 통해 팔과 다리 마스크 추출
-        parsing_map, _ = self.parsing(src_image.resize((768, 1024)))
-        parsing_map = np.array(parsing_map)
-        limb_mask_raw = np.isin(parsing_map, [4, 5]).astype(np.uint8)  # 팔(4), 다리(5)
-        limb_mask_img = Image.fromarray(limb_mask_raw * 255).resize(src_image.size, Image.NEAREST)
-        limb_mask_np = np.array(limb_mask_img.convert("L")) > 128
-        
-        # vt_garment_type에 따라 마스킹 영역 결정
-        if vt_garment_type == "upper_body":
-            garment_mask_np = np.isin(parsing_map, [4]).astype(np.uint8)  # 상의
-            hands_mask_np = np.isin(parsing_map, [14, 15]).astype(np.uint8)  # 손
-            garment_mask_np |= hands_mask_np
-        elif vt_garment_type == "lower_body":
-            garment_mask_np = np.isin(parsing_map, [5]).astype(np.uint8)  # 하의
-        else:
-            garment_mask_np = np.isin(parsing_map, [4, 5]).astype(np.uint8)  # 기본적으로 상의와 하의 포함
-
-        # 4. 인페인팅할 마스크 계산 (의상과 팔/다리가 겹치는 영역)
-        inpaint_mask_np = garment_mask_np & limb_mask_np
-        
-        # 5. 마스크에 10px 마진 추가 (팽창)
-        kernel = np.ones((10, 10), np.uint8)  # 10px 마진용 커널
-        inpaint_mask_np_dilated = cv2.dilate(inpaint_mask_np.astype(np.uint8), kernel, iterations=1)
-        
-        # PIL 이미지로 변환
-        inpaint_mask_img = Image.fromarray(inpaint_mask_np_dilated * 255)
+        # 2. 휴먼 파싱으로 의상과 팔/다리가 겹치는 인페인팅 마스크 계산
+        parsing_map = np.array(self.human_parsing(src_image.resize((768, 1024)))["parsing"])
+        inpaint_mask_img, has_overlap = self.inpaint_mask(src_image, parsing_map, vt_garment_type)
 
         # 인페인팅할 영역이 없으면 원본 이미지와 빈 마스크 반환
-        if not np.any(inpaint_mask_np):
+        if not has_overlap:
             if output_path:
                 src_image.save(output_path)
-            return src_image, Image.fromarray(np.zeros_like(inpaint_mask_np, dtype=np.uint8) * 255)
+            return src_image, Image.fromarray(np.zeros(parsing_map.shape, dtype=np.uint8))
 
-        # 6. 피부 생성 호출
-        final_image = self.generate_skin(
-            src_image=src_image,
-            inpaint_mask_img=inpaint_mask_img,
-            step=step,
-            seed=seed
-        )
-
-        agnostic_image = final_image
+        # 3. 피부 생성 호출
+        final_image = self.skin_image(src_image, inpaint_mask_img, step=step, seed=seed)
 
         # 이후 반환값에 inpaint_mask_img 포함
         return final_image, inpaint_mask_img, parsing_map
@@ -212,115 +614,46 @@ class LeffaVirtualTryOn:
         vt_model_type="viton_hd",
         vt_garment_type="upper_body",
         vt_repaint=False,
-        src_mask_path=None
+        src_mask_path=None,
+        progress=None,
     ):
+        """
+        src_image_path / ref_image_path: a path, encoded image bytes, a PIL image or an
+        RGB ndarray (see leffa_utils.image_io.load_image); nothing is written to disk.
+        progress: optional StageGraph on_stage callback.
+        """
         assert control_type in ["virtual_tryon", "pose_transfer"], f"Invalid control type: {control_type}"
 
-        src_image = Image.open(src_image_path).convert("RGB")
-        ref_image = Image.open(ref_image_path).convert("RGB")
+        src_image = load_image(src_image_path)
         src_image = resize_and_center(src_image, 768, 1024)
-        ref_image = resize_and_center(ref_image, 768, 1024)
-
-        # 2. 원본 이미지에서 의상 마스크 추출
-        garment_mask_img = self.mask_predictor(src_image, "overall")["mask"]
-        garment_mask_np = np.array(garment_mask_img.convert("L")) > 128
-
-        # 3. 휴먼 파싱을 통해 팔과 다리 마스크 추출
-        parsing_map, _ = self.parsing(src_image.resize((768, 1024)))
-        parsing_map = np.array(parsing_map)
-        limb_mask_raw = np.isin(parsing_map, [4, 5]).astype(np.uint8)  # 팔(4), 다리(5)
-        limb_mask_img = Image.fromarray(limb_mask_raw * 255).resize(src_image.size, Image.NEAREST)
-        limb_mask_np = np.array(limb_mask_img.convert("L")) > 128
-
-        # vt_garment_type에 따라 마스킹 영역 결정
-        if vt_garment_type == "upper_body":
-            garment_mask_np = np.isin(parsing_map, [4]).astype(np.uint8)  # 상의
-            hands_mask_np = np.isin(parsing_map, [14, 15]).astype(np.uint8)  # 손
-            garment_mask_np |= hands_mask_np
-        elif vt_garment_type == "lower_body":
-            garment_mask_np = np.isin(parsing_map, [5]).astype(np.uint8)  # 하의
-        else:
-            garment_mask_np = np.isin(parsing_map, [4, 5]).astype(np.uint8)  # 기본적으로 상의와 하의 포함
-
-        # 4. 인페인팅할 마스크 계산 (의상과 팔/다리가 겹치는 영역)
-        inpaint_mask_np = garment_mask_np & limb_mask_np
-
-        # 5. 마스크에 10px 마진 추가 (팽창)
-        kernel = np.ones((10, 10), np.uint8)  # 10px 마진용 커널
-        inpaint_mask_np_dilated = cv2.dilate(inpaint_mask_np.astype(np.uint8), kernel, iterations=1)
-
-        # PIL 이미지로 변환
-        inpaint_mask_img = Image.fromarray(inpaint_mask_np_dilated * 255)
-
-        # 인페인팅할 영역이 없으면 원본 이미지와 빈 마스크 반환
-        if not np.any(inpaint_mask_np):
-            if output_path:
-                src_image.save(output_path)
-            return src_image, Image.fromarray(np.zeros_like(inpaint_mask_np, dtype=np.uint8) * 255)
-
-        # 6. 피부 생성 호출
-        final_image = self.generate_skin(
-            src_image=src_image,
-            inpaint_mask_img=inpaint_mask_img,
-            step=step,
-            seed=seed
+        # prepared the same way as precomputed garments, so their store entries are found
+        ref_image = reference_image(ref_image_path)
+
+        values, self.last_trace = self.graph.run(
+            ["generated_image", "mask", "densepose", "agnostic_image"],
+            {
+                **self.mask_inputs(src_image, control_type),
+                "src_image": src_image,
+                "ref_image": ref_image,
+                "vt_model_type": vt_model_type,
+                "vt_garment_type": vt_garment_type,
+                "step": step,
+                "seed": seed,
+                "ref_acceleration": ref_acceleration,
+                "cross_attention_kwargs": cross_attention_kwargs,
+                "vt_repaint": vt_repaint,
+            },
+            on_stage=progress,
         )
-        
-        agnostic_image = final_image
-        
-        # 7. 메인 마스크 생성
-        if control_type == "virtual_tryon":
-            garment_mapping = {
-                "dresses": "overall",
-                "upper_body": "upper",
-                "lower_body": "lower",
-                "short_sleeve": "short_sleeve",
-                "shorts": "shorts"
-            }
-            garment_type_hd = garment_mapping.get(vt_garment_type, "upper")
-            mask = self.mask_predictor(agnostic_image, garment_type_hd)["mask"]
-            
-            if src_mask_path:
-                mask.save(src_mask_path)
-        else:
-            mask = Image.fromarray(np.ones_like(agnostic_np, dtype=np.uint8) * 255)
-    
-        # 8. DensePose 생성
-        agnostic_np = np.array(agnostic_image)
-        if vt_model_type == "viton_hd":
-            seg = self.densepose_predictor.predict_seg(agnostic_np)[:, :, ::-1]
-        else:
-            iuv = self.densepose_predictor.predict_iuv(agnostic_np)
-            seg = np.concatenate([iuv[:, :, :1]] * 3, axis=-1)
-        densepose = Image.fromarray(seg)
-    
-        # 9. 최종 가상 피팅
-        transform = LeffaTransform()
-        data = {
-            "src_image": [agnostic_image],
-            "ref_image": [ref_image],
-            "mask": [mask],
-            "densepose": [densepose],
-        }
-        data = transform(data)
-    
-        inference = self.vt_inference_hd if vt_model_type == "viton_hd" else self.vt_inference_dc
-        
-        garment_prompt = "High quality skin, lifelike details, realistic textures, full masking range"
-        negative_prompt = "distorted, blurry, low quality, artifact, background, clothes"
-        
-        result = inference(
-            data,
-            ref_acceleration=ref_acceleration,
-            num_inference_steps=step,
-            cross_attention_kwargs=cross_attention_kwargs,
-            seed=seed,
-            repaint=vt_repaint,
-            prompt=garment_prompt,
-            negative_prompt=negative_prompt
-        )
-    
-        gen_image = result["generated_image"][0]
+        # stage latencies, recorded after the fact from the trace the graph keeps anyway
+        labels = dict(vt_model_type=vt_model_type, vt_garment_type=vt_garment_type)
+        observe_trace(self.last_trace, **labels)
+        observe_stages(self.last_pipeline_timings, **labels)
+        mask, densepose, agnostic_image = values["mask"], values["densepose"], values["agnostic_image"]
+        if src_mask_path and control_type == "virtual_tryon":
+            mask.save(src_mask_path)
+
+        gen_image = values["generated_image"]
     
         # 9. 결과 반환
         if output_path:
@@ -377,6 +710,195 @@ class LeffaVirtualTryOn:
 
         return gen_image, mask, densepose, agnostic_image
     
+    def person_side(self, src_image, control_type, vt_model_type, vt_garment_type, step=20, seed=42, progress=None):
+        """(mask, densepose, agnostic_image) of a resized 768x1024 person image: every stage but the try-on."""
+        values, self.last_trace = self.graph.run(
+            ["mask", "densepose", "agnostic_image"],
+            {
+                **self.mask_inputs(src_image, control_type),
+                "src_image": src_image,
+                "vt_model_type": vt_model_type,
+                "vt_garment_type": vt_garment_type,
+                "step": step,
+                "seed": seed,
+            },
+            on_stage=progress,
+        )
+        observe_trace(self.last_trace, vt_model_type=vt_model_type, vt_garment_type=vt_garment_type)
+        return values["mask"], values["densepose"], values["agnostic_image"]
+
+    def predict_batch(self, requests):
+        """
+        Several leffa_predict calls (dicts of its keyword arguments) with one denoising
+        run per group of requests that share the model type, steps, seed and sampler
+        options. The person-side stages still run per request. Returns
+        (gen_image, mask, densepose, agnostic_image) per request, in order, or the
+        exception that request failed with: a bad input only fails its own slot (and
+        a failed denoising run only the requests of its group).
+        """
+        prepared = []
+        for request in requests:
+            try:
+                request = {**LEFFA_PREDICT_DEFAULTS, **request}
+                assert request["control_type"] in ["virtual_tryon", "pose_transfer"], \
+                    f"Invalid control type: {request['control_type']}"
+                progress = TryonProgress(request["progress"]) if request["progress"] is not None else None
+                src_image = resize_and_center(load_image(request["src_image_path"]), 768, 1024)
+                ref_image = reference_image(request["ref_image_path"])
+                side = self.person_side(
+                    src_image, request["control_type"], request["vt_model_type"], request["vt_garment_type"],
+                    step=request["step"], seed=request["seed"], progress=progress,
+                )
+                prepared.append((request, ref_image, side, progress))
+            except Exception as e:
+                logger.exception("Preprocessing a request of the batch failed")
+                prepared.append(e)
+
+        results = [None] * len(prepared)
+        groups = {}
+        for index, item in enumerate(prepared):
+            if isinstance(item, Exception):
+                results[index] = item
+                continue
+            request = item[0]
+            key = tuple(
+                json.dumps(request[name], sort_keys=True)
+                for name in ("vt_model_type", "step", "seed", "ref_acceleration", "cross_attention_kwargs", "vt_repaint")
+            )
+            groups.setdefault(key, []).append(index)
+
+        for indices in groups.values():
+            first = prepared[indices[0]][0]
+            try:
+                gen_images = self.tryon_batch(
+                    [prepared[i][2][2] for i in indices],
+                    [prepared[i][1] for i in indices],
+                    [prepared[i][2][0] for i in indices],
+                    [prepared[i][2][1] for i in indices],
+                    first["vt_model_type"],
+                    step=first["step"],
+                    seed=first["seed"],
+                    ref_acceleration=first["ref_acceleration"],
+                    cross_attention_kwargs=first["cross_attention_kwargs"],
+                    vt_repaint=first["vt_repaint"],
+                )
+            except Exception as e:
+                logger.exception(f"Try-on of a group of {len(indices)} failed")
+                for i in indices:
+                    results[i] = e
+                continue
+            garment_types = {prepared[i][0]["vt_garment_type"] for i in indices}
+            observe_stages(
+                self.last_pipeline_timings, vt_model_type=first["vt_model_type"],
+                vt_garment_type=garment_types.pop() if len(garment_types) == 1 else "mixed",
+            )
+            for i, gen_image in zip(indices, gen_images):
+                request, _, (mask, densepose, agnostic_image), progress = prepared[i]
+                if progress is not None:
+                    progress.tryon_done()
+                if request["src_mask_path"] and request["control_type"] == "virtual_tryon":
+                    mask.save(request["src_mask_path"])
+                if request["output_path"]:
+                    gen_image.save(request["output_path"])
+                results[i] = (gen_image, mask, densepose, agnostic_image)
+        return results
+
+    def predict_many(self, *args, **kwargs):
+        """
+        One person against many garments. Yields (index into ref_image_paths,
+        gen_image, mask, densepose, agnostic_image) as each denoising batch finishes,
+        so results arrive in batches of `batch_size`, roughly in input order.
+        Takes the arguments of predict_many_batches.
+        """
+        for batch in self.predict_many_batches(*args, **kwargs):
+            yield from batch
+
+    def predict_many_batches(
+        self,
+        src_image_path,
+        ref_image_paths,
+        vt_garment_type="upper_body",
+        batch_size=4,
+        control_type="virtual_tryon",
+        ref_acceleration=False,
+        step=20,
+        cross_attention_kwargs={"scale": 3},
+        seed=42,
+        vt_model_type="viton_hd",
+        vt_repaint=False,
+        progress=None,
+    ):
+        """
+        One person against many garments, one denoising batch per step: yields a list
+        of (index into ref_image_paths, gen_image, mask, densepose, agnostic_image) per
+        batch of `batch_size` garments, roughly in input order. Nothing runs between
+        steps, so a caller can interleave other work (see api_main).
+
+        The person-side stages (parsing, OpenPose, skin, DensePose, masks) run once per
+        distinct garment type, each garment is loaded once, and repeated
+        (garment, garment type) pairs share one diffusion run.
+
+        vt_garment_type: one type for all garments or a list parallel to ref_image_paths.
+        progress: optional callback, called as progress("tryon", "end", finished, total)
+            after every batch.
+        """
+        assert control_type in ["virtual_tryon", "pose_transfer"], f"Invalid control type: {control_type}"
+        garment_types = (
+            [vt_garment_type] * len(ref_image_paths) if isinstance(vt_garment_type, str) else list(vt_garment_type)
+        )
+        assert len(garment_types) == len(ref_image_paths), "vt_garment_type must match ref_image_paths"
+
+        src_image = resize_and_center(load_image(src_image_path), 768, 1024)
+
+        # distinct (garment, garment type) pairs -> the indices that asked for them
+        refs = {}
+        pairs = {}
+        for index, (ref_path, garment_type) in enumerate(zip(ref_image_paths, garment_types)):
+            ref_image = reference_image(ref_path)
+            digest = image_digest(ref_image)
+            refs.setdefault(digest, ref_image)
+            pairs.setdefault((digest, garment_type), []).append(index)
+
+        person = {}
+
+        def person_side(garment_type):
+            if garment_type not in person:
+                person[garment_type] = self.person_side(
+                    src_image, control_type, vt_model_type, garment_type, step=step, seed=seed
+                )
+            return person[garment_type]
+
+        keys = list(pairs)
+        finished = 0
+        for start in range(0, len(keys), batch_size):
+            batch = keys[start:start + batch_size]
+            sides = [person_side(garment_type) for _, garment_type in batch]
+            gen_images = self.tryon_batch(
+                [agnostic_image for _, _, agnostic_image in sides],
+                [refs[digest] for digest, _ in batch],
+                [mask for mask, _, _ in sides],
+                [densepose for _, densepose, _ in sides],
+                vt_model_type,
+                step=step,
+                seed=seed,
+                ref_acceleration=ref_acceleration,
+                cross_attention_kwargs=cross_attention_kwargs,
+                vt_repaint=vt_repaint,
+            )
+            batch_types = {garment_type for _, garment_type in batch}
+            observe_stages(
+                self.last_pipeline_timings, vt_model_type=vt_model_type,
+                vt_garment_type=batch_types.pop() if len(batch_types) == 1 else "mixed",
+            )
+            finished += len(batch)
+            if progress is not None:
+                progress("tryon", "end", finished, len(keys))
+            yield [
+                (index, gen_image, mask, densepose, agnostic_image)
+                for key, gen_image, (mask, densepose, agnostic_image) in zip(batch, gen_images, sides)
+                for index in pairs[key]
+            ]
+
     def leffa_predict_old(
         self,
         src_image_path,
@@ -394,8 +916,8 @@ class LeffaVirtualTryOn:
     ):
         assert control_type in ["virtual_tryon", "pose_transfer"], f"Invalid control type: {control_type}"
         
-        src_image = Image.open(src_image_path).convert("RGB")
-        ref_image = Image.open(ref_image_path).convert("RGB")
+        src_image = load_image(src_image_path)
+        ref_image = load_image(ref_image_path)
 
         src_image = resize_and_center(src_image, 768, 1024)
         ref_image = resize_and_center(ref_image, 768, 1024)
@@ -414,7 +936,7 @@ class LeffaVirtualTryOn:
             else:
                 raise ValueError(f"Invalid vt_garment_type: {vt_garment_type}")
 
-            mask = self.mask_predictor(src_image, garment_type_hd)["mask"]
+            mask = self.agnostic_mask(src_image, garment_type_hd, prefetch_next=[self.vt_model_name(vt_model_type)])
 
             if src_mask_path:
                 mask.save(src_mask_path)
@@ -423,11 +945,7 @@ class LeffaVirtualTryOn:
             mask = Image.fromarray(np.ones_like(src_image_array, dtype=np.uint8) * 255)
 
         # DensePose
-        if vt_model_type == "viton_hd":
-            seg = self.densepose_predictor.predict_seg(src_image_array)[:, :, ::-1]
-        else:
-            iuv = self.densepose_predictor.predict_iuv(src_image_array)
-            seg = np.concatenate([iuv[:, :, :1]] * 3, axis=-1)
+        seg = self.densepose_condition(src_image_array, vt_model_type)
         densepose = Image.fromarray(seg)
 
         # Transform 및 inference
@@ -441,14 +959,15 @@ class LeffaVirtualTryOn:
         data = transform(data)
 
         inference = self.vt_inference_hd if vt_model_type == "viton_hd" else self.vt_inference_dc
-        result = inference(
-            data,
-            ref_acceleration=ref_acceleration,
-            num_inference_steps=step,
-            cross_attention_kwargs={"scale": cross_attention_kwargs},  # scale을 cross_attention_kwargs로 전달
-            seed=seed,
-            repaint=vt_repaint
-        )
+        with self.use_models(self.vt_model_name(vt_model_type)), self.variant_session(vt_model_type):
+            result = inference(
+                data,
+                ref_acceleration=ref_acceleration,
+                num_inference_steps=step,
+                cross_attention_kwargs={"scale": cross_attention_kwargs},  # scale을 cross_attention_kwargs로 전달
+                seed=seed,
+                repaint=vt_repaint
+            )
 
         gen_image = result["generated_image"][0]
 